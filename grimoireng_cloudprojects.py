@@ -68,6 +68,20 @@ def parse_args ():
                         help = "Output directory")
     parser.add_argument("--deleteold", action = 'store_true',
                         help = "Delete old contents in output system")
+    parser.add_argument("--rebuild", action = 'store_true',
+                        help = "Upload to a new index, and when done move " + \
+                        "to it an alias with the name of the index " + \
+                        "(old content is available meanwhile)")
+    parser.add_argument("--syncstate", default = None,
+                        help = "File with the state of documents uploaded " + \
+                        "to ElasticSearch, to upload only changes " + \
+                        "(default: upload everything)")
+    parser.add_argument("--spooldir", default = None,
+                        help = "Directory to spool batches uploaded to " + \
+                        "ElasticSearch, to resume failed uploads")
+    parser.add_argument("--resume", action = 'store_true',
+                        help = "Upload batches pending in the spool " + \
+                        "directory, and do nothing else")
     parser.add_argument("--verbose", action = 'store_true',
                         help = "Be verbose")
     parser.add_argument("--debug", action = 'store_true',
@@ -81,10 +95,66 @@ def parse_args ():
     parser.add_argument("--batchsize",  type = int, default = 10000,
                         help = "Size of batches for uploading data" + \
                         "(default: 10,000 items)")
+    parser.add_argument("--chunksize",  type = int, default = 0,
+                        help = "Retrieve commits and events from the " + \
+                        "database in chunks of this many rows " + \
+                        "(default: 0, all at once)")
+    parser.add_argument("--batchbytes",  type = int, default = 0,
+                        help = "Initial size of batches for uploading data, " + \
+                        "adapted to the server load (default: 0, batch only " + \
+                        "by number of items)")
+    parser.add_argument("--compress",  type = int, default = 0,
+                        choices = range(10),
+                        help = "Level of gzip compression for uploads " + \
+                        "to ElasticSearch (default: 0, no compression)")
+    parser.add_argument("--uploadworkers",  type = int, default = 1,
+                        help = "Number of concurrent uploads to ElasticSearch" + \
+                        "(default: 1)")
+    parser.add_argument("--dbworkers",  type = int, default = 1,
+                        help = "Maximum number of concurrent queries " + \
+                        "to each MySQL server (default: 1)")
+    parser.add_argument("--scmpartitions",  type = int, default = 1,
+                        help = "Extract commits in this many partitions " + \
+                        "(by repository), in parallel processes, " + \
+                        "each with its own connection, not counted " + \
+                        "in --dbworkers (default: 1, no partitions)")
+    parser.add_argument("--cachedir",
+                        help = "Directory for caching results of queries, " + \
+                        "reused while the databases do not change " + \
+                        "(default: no cache)")
+    parser.add_argument("--cachesize",  type = int, default = 2048,
+                        help = "Maximum size of the cache of results " + \
+                        "of queries, in MB (default: 2048)")
+    parser.add_argument("--nocache", action = 'store_true',
+                        help = "Do not use the cache of results of queries")
+    parser.add_argument("--cacheclear", action = 'store_true',
+                        help = "Remove all results in the cache of results " + \
+                        "of queries, before running")
+    parser.add_argument("--incremental",
+                        help = "Directory for incremental extraction state: " + \
+                        "retrieve only commits and changes added since " + \
+                        "the previous run; changes rewritten in place " + \
+                        "by Bicho are noticed only for reviews with " + \
+                        "new changes (default: retrieve all)")
+    parser.add_argument("--stagingdb",
+                        help = "Scratch database, for staging tables " + \
+                        "with the branches and lines of commits, rebuilt " + \
+                        "only when commits change (default: no staging " + \
+                        "tables)")
+    parser.add_argument("--fields",
+                        help = "Fields of documents uploaded to " + \
+                        "ElasticSearch, separated by commas, for all " + \
+                        "types (default: all fields in mappings)")
     parser.add_argument("--config", default = "grimoireng_config.py",
                         help = "Configuration file")
 
     args = parser.parse_args()
+    if args.resume and not args.spooldir:
+        parser.error("--resume requires --spooldir")
+    if args.spooldir and not args.resume \
+            and grimoireng_data.spool_pending(args.spooldir):
+        parser.error("uploads pending in spool " + args.spooldir \
+                     + ": run with --resume first, or remove it")
     return args
 
 
@@ -112,6 +182,16 @@ if __name__ == "__main__":
         for dashboard in dashboards:
             print dashboard
         sys.exit()
+    # Resume uploads, if asked to do so
+    if args.resume:
+        grimoireng_data.resume_upload (
+            es = grimoireng_data.es_client(elasticsearch[0], args.esauth),
+            spooldir = args.spooldir,
+            workers = args.uploadworkers,
+            compression = args.compress)
+        sys.exit()
+    if args.cacheclear and args.cachedir:
+        grimoireng_data.ResultCache(args.cachedir).clear()
     # Which dashboards should we produce?
     dashboards_produce = []
     if "all" in args.dashboards:
@@ -124,50 +204,91 @@ if __name__ == "__main__":
                 logging.info("No configuration for " + dashboard \
                              + ", not producing it")
     # Go and produce them!!
-    for dashboard, params in dashboards_produce:
-        logging.info("** Producing data for " + dashboard)
-        if "port" in params:
-            port = params["port"]
-        else:
-            port = args.port
-        if params["scmdb"]:
-            if elasticsearch:
-                elasticsearch[1] = dashboard.lower() + "-scm"
-            grimoireng_data.process_all (
-                user = args.user, passwd = args.passwd,
-                host = args.host, port = port,
-                scmdb = params["scmdb"],
-                shdb = params["shdb"],
-                prjdb = params["prjdb"],
-                allbranches = allbranches,
-                since = args.since,
-                output = args.output,
-                elasticsearch = elasticsearch,
-                esauth = args.esauth,
-                dateformat = dateformat,
-                dashboard = dashboard,
-                batchsize = args.batchsize,
-                deleteold = args.deleteold,
-                verbose = args.verbose,
-                debug = args.debug
-            )
-        if params["scrdb"]:
-            if elasticsearch:
-                elasticsearch[1] = dashboard.lower() + "-scr"
-            grimoireng_data.process_all (
-                user = args.user, passwd = args.passwd,
-                host = args.host, port = port,
-                scrdb = params["scrdb"],
-                shdb = params["shdb"],
-                prjdb = params["prjdb"],
-                since = args.since,
-                output = args.output,
-                elasticsearch = elasticsearch,
-                esauth = args.esauth,
-                dateformat = dateformat,
-                dashboard = dashboard,
-                batchsize = args.batchsize,
-                deleteold = args.deleteold,
-                verbose = args.verbose,
-                debug = args.debug
-            )
+    # Uploads for a dashboard run while data for the next one is produced
+    pipeline = grimoireng_data.Pipeline()
+    try:
+        for dashboard, params in dashboards_produce:
+            # Stop before producing more data, if some upload failed
+            pipeline.check()
+            logging.info("** Producing data for " + dashboard)
+            if "port" in params:
+                port = params["port"]
+            else:
+                port = args.port
+            if params["scmdb"]:
+                if elasticsearch:
+                    elasticsearch[1] = dashboard.lower() + "-scm"
+                grimoireng_data.process_all (
+                    user = args.user, passwd = args.passwd,
+                    host = args.host, port = port,
+                    scmdb = params["scmdb"],
+                    shdb = params["shdb"],
+                    prjdb = params["prjdb"],
+                    allbranches = allbranches,
+                    since = args.since,
+                    output = args.output,
+                    elasticsearch = elasticsearch,
+                    esauth = args.esauth,
+                    dateformat = dateformat,
+                    dashboard = dashboard,
+                    batchsize = args.batchsize,
+                    batchbytes = args.batchbytes,
+                    upload_workers = args.uploadworkers,
+                    db_workers = args.dbworkers,
+                    scm_partitions = args.scmpartitions,
+                    cachedir = None if args.nocache else args.cachedir,
+                    cachesize = args.cachesize,
+                    incremental = args.incremental,
+                    stagingdb = args.stagingdb,
+                    fields = args.fields.split(",") if args.fields else None,
+                    compression = args.compress,
+                    rebuild = args.rebuild,
+                    syncstate = args.syncstate,
+                    spooldir = args.spooldir,
+                    pipeline = pipeline,
+                    chunksize = args.chunksize,
+                    deleteold = args.deleteold,
+                    verbose = args.verbose,
+                    debug = args.debug
+                )
+            if params["scrdb"]:
+                if elasticsearch:
+                    elasticsearch[1] = dashboard.lower() + "-scr"
+                grimoireng_data.process_all (
+                    user = args.user, passwd = args.passwd,
+                    host = args.host, port = port,
+                    scrdb = params["scrdb"],
+                    shdb = params["shdb"],
+                    prjdb = params["prjdb"],
+                    since = args.since,
+                    output = args.output,
+                    elasticsearch = elasticsearch,
+                    esauth = args.esauth,
+                    dateformat = dateformat,
+                    dashboard = dashboard,
+                    batchsize = args.batchsize,
+                    batchbytes = args.batchbytes,
+                    upload_workers = args.uploadworkers,
+                    db_workers = args.dbworkers,
+                    scm_partitions = args.scmpartitions,
+                    cachedir = None if args.nocache else args.cachedir,
+                    cachesize = args.cachesize,
+                    incremental = args.incremental,
+                    stagingdb = args.stagingdb,
+                    fields = args.fields.split(",") if args.fields else None,
+                    compression = args.compress,
+                    rebuild = args.rebuild,
+                    syncstate = args.syncstate,
+                    spooldir = args.spooldir,
+                    pipeline = pipeline,
+                    chunksize = args.chunksize,
+                    deleteold = args.deleteold,
+                    verbose = args.verbose,
+                    debug = args.debug
+                )
+    except Exception:
+        exc_info = sys.exc_info()
+        # Let uploads already submitted finish, before raising
+        pipeline.close()
+        raise exc_info[0], exc_info[1], exc_info[2]
+    pipeline.join()
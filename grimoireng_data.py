@@ -33,15 +33,33 @@
 
 import argparse
 import MySQLdb
+import MySQLdb.cursors
 import _mysql_exceptions
 import logging
 import pandas
+import numpy
 from collections import OrderedDict
 import codecs
 import json
 from os.path import join
 import datetime
-import urllib2
+import re
+import os
+import errno
+import fcntl
+import hashlib
+import mmap
+import functools
+import httplib
+import urlparse
+import socket
+import threading
+import Queue
+import multiprocessing
+import sys
+import time
+import random
+import zlib
 import base64
 
 description = """
@@ -58,7 +76,7 @@ def parse_args ():
     """
 
     parser = argparse.ArgumentParser(description = description)
-    parser.add_argument("--user", required = True,
+    parser.add_argument("--user",
                         help = "User to access the databases")
     parser.add_argument("--passwd", default = "",
                         help = "Password to access the databases " + \
@@ -73,7 +91,7 @@ def parse_args ():
                         help = "SCM (git) database")
     parser.add_argument("--scrdb", required = False, default = None,
                         help = "SCR (Gerrit) database")
-    parser.add_argument("--shdb", required = True, default = None,
+    parser.add_argument("--shdb", default = None,
                         help = "SortingHat database")
     parser.add_argument("--prjdb", required = False, default = None,
                         help = "Projects database (if not specified, same as SCM database)")
@@ -83,6 +101,20 @@ def parse_args ():
                         help = "Date format ('utime' or 'iso')")
     parser.add_argument("--deleteold", action = 'store_true',
                         help = "Delete old contents in output system")
+    parser.add_argument("--rebuild", action = 'store_true',
+                        help = "Upload to a new index, and when done move " + \
+                        "to it an alias with the name of the index " + \
+                        "(old content is available meanwhile)")
+    parser.add_argument("--syncstate", default = None,
+                        help = "File with the state of documents uploaded " + \
+                        "to ElasticSearch, to upload only changes " + \
+                        "(default: upload everything)")
+    parser.add_argument("--spooldir", default = None,
+                        help = "Directory to spool batches uploaded to " + \
+                        "ElasticSearch, to resume failed uploads")
+    parser.add_argument("--resume", action = 'store_true',
+                        help = "Upload batches pending in the spool " + \
+                        "directory, and do nothing else")
     parser.add_argument("--verbose", action = 'store_true',
                         help = "Be verbose")
     parser.add_argument("--debug", action = 'store_true',
@@ -102,10 +134,69 @@ def parse_args ():
     parser.add_argument("--batchsize",  type = int, default = 10000,
                         help = "Size of batches for uploading data" + \
                         "(default: 10,000 items)")
+    parser.add_argument("--chunksize",  type = int, default = 0,
+                        help = "Retrieve commits and events from the " + \
+                        "database in chunks of this many rows " + \
+                        "(default: 0, all at once)")
+    parser.add_argument("--batchbytes",  type = int, default = 0,
+                        help = "Initial size of batches for uploading data, " + \
+                        "adapted to the server load (default: 0, batch only " + \
+                        "by number of items)")
+    parser.add_argument("--compress",  type = int, default = 0,
+                        choices = range(10),
+                        help = "Level of gzip compression for uploads " + \
+                        "to ElasticSearch (default: 0, no compression)")
+    parser.add_argument("--uploadworkers",  type = int, default = 1,
+                        help = "Number of concurrent uploads to ElasticSearch" + \
+                        "(default: 1)")
+    parser.add_argument("--dbworkers",  type = int, default = 1,
+                        help = "Maximum number of concurrent queries " + \
+                        "to each MySQL server (default: 1)")
+    parser.add_argument("--scmpartitions",  type = int, default = 1,
+                        help = "Extract commits in this many partitions " + \
+                        "(by repository), in parallel processes, " + \
+                        "each with its own connection, not counted " + \
+                        "in --dbworkers (default: 1, no partitions)")
+    parser.add_argument("--cachedir",
+                        help = "Directory for caching results of queries, " + \
+                        "reused while the databases do not change " + \
+                        "(default: no cache)")
+    parser.add_argument("--cachesize",  type = int, default = 2048,
+                        help = "Maximum size of the cache of results " + \
+                        "of queries, in MB (default: 2048)")
+    parser.add_argument("--nocache", action = 'store_true',
+                        help = "Do not use the cache of results of queries")
+    parser.add_argument("--cacheclear", action = 'store_true',
+                        help = "Remove all results in the cache of results " + \
+                        "of queries, before running")
+    parser.add_argument("--incremental",
+                        help = "Directory for incremental extraction state: " + \
+                        "retrieve only commits and changes added since " + \
+                        "the previous run; changes rewritten in place " + \
+                        "by Bicho are noticed only for reviews with " + \
+                        "new changes (default: retrieve all)")
+    parser.add_argument("--stagingdb",
+                        help = "Scratch database, for staging tables " + \
+                        "with the branches and lines of commits, rebuilt " + \
+                        "only when commits change (default: no staging " + \
+                        "tables)")
+    parser.add_argument("--fields",
+                        help = "Fields of documents uploaded to " + \
+                        "ElasticSearch, separated by commas, for all " + \
+                        "types (default: all fields in mappings)")
     parser.add_argument("--dashboard", required = False, default = "Dashboard",
                         help = "Dashboard name (default: 'Dashboard'")
 
     args = parser.parse_args()
+    if args.resume:
+        if not (args.spooldir and args.elasticsearch):
+            parser.error("--resume requires --spooldir and --elasticsearch")
+    elif not (args.user and args.shdb):
+        parser.error("--user and --shdb are required")
+    elif args.spooldir and args.elasticsearch \
+            and spool_pending(args.spooldir):
+        parser.error("uploads pending in spool " + args.spooldir \
+                     + ": run with --resume first, or remove it")
     return args
 
 
@@ -180,9 +271,15 @@ def json_dumps(data, compact = True, dateformat = "iso"):
                           indent=4, separators=(',', ': '),
                           default=serializer)
 
-def write_file_json (filename, data, compact = True, dateformat = "utime"):
+def write_file_json (filename, data, compact = True, dateformat = "utime",
+                     chunksize = 10000):
     """Write JSON content (a dataframe) into a file (filename).
 
+    The content is {"names": [columns], "values": [rows]}. Compact
+    content is written as it is serialized, chunksize rows at a time,
+    so that neither all rows as lists nor the whole JSON string are
+    ever in memory. The result is the same as serializing all at once.
+
     :param filename: Name of file to write the content.
     :type filename: str or unicode
     :param data: dataframe  to serialize
@@ -191,15 +288,28 @@ def write_file_json (filename, data, compact = True, dateformat = "utime"):
     :type compact: bool
     :param dateformat: format for datetime objects ("iso" or "utime")
     :type dateformat: str or unicode
+    :param chunksize: number of rows to serialize at a time
+    :type chunksize: int
 
     """
 
-    json_dict = OrderedDict()
-    json_dict['names'] = list(data.columns.values)
-    json_dict['values'] = data.values.tolist()
-    data_json = json_dumps(json_dict, compact, dateformat = dateformat)
+    names = list(data.columns.values)
     with codecs.open(filename, "w", "utf-8") as file:
-        file.write(data_json)
+        if not compact:
+            json_dict = OrderedDict()
+            json_dict['names'] = names
+            json_dict['values'] = data.values.tolist()
+            file.write(json_dumps(json_dict, compact, dateformat = dateformat))
+            return
+        file.write('{"names":' + json_dumps(names, dateformat = dateformat) \
+                   + ',"values":[')
+        for start in xrange(0, len(data.index), chunksize):
+            if start:
+                file.write(",")
+            rows = data.iloc[start:start + chunksize].values.tolist()
+            # Rows in the chunk, without the enclosing brackets
+            file.write(json_dumps(rows, dateformat = dateformat)[1:-1])
+        file.write("]}")
 
 
 def create_report (report_files, destdir, dateformat = "utime"):
@@ -257,7 +367,7 @@ scm_mapping_commit = """
                       "index":"not_analyzed"},
        "bot":{"type":"long"},
        "added":{"type":"long"},
-       "deleted":{"type":"long"},
+       "removed":{"type":"long"},
        "org_id":{"type":"long"},
        "org_name":{"type":"string",
                    "index":"not_analyzed"},
@@ -349,514 +459,3263 @@ scr_mapping_event = """
   }
 """
 
-def http_delete (url, auth):
-    """Perform HTTP DELETE on url.
+def mapping_fields (mapping):
+    """Get the names of the fields (properties) in a mapping, in order.
 
-    :param url: url
-    :type url: str
-    :param auth: authentication data (list with user and password)
-    :type auth: list of str
-    :returns body of the HTTP response
-    :rtype str
+    :param mapping: mapping, as JSON (see scm_mapping_commit)
+    :type mapping: str
+    :returns: names of fields
+    :rtype: list of str
 
     """
 
-    opener = urllib2.build_opener(urllib2.HTTPHandler)
-    request = urllib2.Request(url)
-    if auth:
-        user = auth[0]
-        passwd = auth[1]
-        base64string = base64.encodestring(
-            '%s:%s' % (user, passwd))[:-1]
-        authheader =  "Basic %s" % base64string
-        request.add_header("Authorization", authheader)
-    request.get_method = lambda: 'DELETE'
-    try:
-        response = opener.open(request)
-        result = response.read()
-        logging.debug(result)
-    except urllib2.HTTPError as e:
-        if e.code == 404:
-            logging.info("ElasticSearch: resource to DELETE didn't exist")
-        else:
-            logging.info("ElasticSearch: error DELETEing: " + str(e.code))
-        logging.info(e.read())
-        result = ""
-    return result
+    (doc_type, properties) = \
+        json.loads(mapping, object_pairs_hook = OrderedDict).items()[0]
+    return [str(name) for name in properties["properties"]]
 
-def http_put (url, body, auth):
-    """Perform HTTP PUT on url.
+def document_fields (mapping, fields = None):
+    """Get the fields to produce for documents of a mapping.
 
-    :param url: url
-    :type url: str
-    :param body: body of the HTTP request (content to upload)
-    :type body: str
-    :param auth: authentication data (list with user and password)
-    :type auth: list of str
-    :returns body of the HTTP response
-    :rtype str
+    They are the fields in the mapping, in order, and if fields is
+    specified, only those also in it. The id field is always included.
+
+    :param mapping: mapping, as JSON (see scm_mapping_commit)
+    :type mapping: str
+    :param fields: names of fields requested, or None for all
+    :type fields: list of str
+    :returns: names of fields
+    :rtype: list of str
 
     """
 
-    opener = urllib2.build_opener(urllib2.HTTPHandler)
-    request = urllib2.Request(url, data=body)
-    if auth:
-        user = auth[0]
-        passwd = auth[1]
-        base64string = base64.encodestring(
-            '%s:%s' % (user, passwd))[:-1]
-        authheader =  "Basic %s" % base64string
-        request.add_header("Authorization", authheader)
-    request.get_method = lambda: 'PUT'
-    try:
-        response = opener.open(request)
-        result = response.read()
+    return [name for name in mapping_fields(mapping)
+            if fields is None or name in fields or name == "id"]
+
+class ElasticSearchError (Exception):
+    """Error answered by ElasticSearch to some HTTP request.
+
+    """
+
+    def __init__ (self, method, url, code, body):
+
+        Exception.__init__(self, "ElasticSearch: error " + method + "ing " \
+                           + url + ": " + str(code))
+        self.code = code
+        self.body = body
+
+class ElasticSearch:
+    """Client for an ElasticSearch server, reusing HTTP/1.1 connections.
+
+    Connections to the server are kept open (keep-alive) in a pool,
+    so that the TCP (and TLS) handshake is performed only when no idle
+    connection is available. The authorization header is computed once.
+    The client can be used from several threads.
+
+    """
+
+    def __init__ (self, url, auth = None, poolsize = 8, timeout = 300):
+        """Init state.
+
+        :param url: elasticsearch url
+        :type url: str
+        :param auth: authentication data (list with user and password)
+        :type auth: list of str
+        :param poolsize: maximum number of idle connections kept
+        :type poolsize: int
+        :param timeout: timeout for HTTP connections (in seconds)
+        :type timeout: int
+
+        """
+
+        self.url = url.rstrip("/")
+        parsed = urlparse.urlsplit(self.url)
+        if parsed.scheme == "https":
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = parsed.netloc
+        self.prefix = parsed.path
+        self.headers = {"Connection": "keep-alive"}
+        if auth:
+            self.headers["Authorization"] = "Basic " + \
+                base64.b64encode('%s:%s' % (auth[0], auth[1]))
+        self.poolsize = poolsize
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _acquire (self):
+        """Get a connection from the pool, or a new one if none is idle.
+
+        :returns: connection, and whether it was reused
+        :rtype: tuple (httplib.HTTPConnection, bool)
+
+        """
+
+        with self.lock:
+            if self.idle:
+                return (self.idle.pop(), True)
+        logging.debug("ElasticSearch: opening connection to " + self.netloc)
+        return (self.connection_class(self.netloc, timeout = self.timeout),
+                False)
+
+    def _release (self, connection):
+        """Return a connection to the pool.
+
+        """
+
+        with self.lock:
+            if len(self.idle) < self.poolsize:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def close (self):
+        """Close all idle connections.
+
+        """
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    def request (self, method, path, body = None, headers = {}):
+        """Perform an HTTP request on path (relative to the url).
+
+        Requests on a reused connection which was closed by the server
+        while idle are retried once on a new connection.
+
+        :param method: HTTP method
+        :type method: str
+        :param path: path, starting with "/"
+        :type path: str
+        :param body: body of the HTTP request (content to upload)
+        :type body: str
+        :param headers: additional HTTP headers
+        :type headers: dict
+        :returns: body of the HTTP response
+        :rtype: str
+        :raises ElasticSearchError: if the answer is not successful
+
+        """
+
+        all_headers = dict(self.headers)
+        all_headers.update(headers)
+        while True:
+            (connection, reused) = self._acquire()
+            try:
+                connection.request(method, self.prefix + path,
+                                   body, all_headers)
+                response = connection.getresponse()
+                result = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    logging.debug("ElasticSearch: stale connection, retrying")
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            if response.status >= 300:
+                raise ElasticSearchError(method, self.url + path,
+                                         response.status, result)
+            return result
+
+    def put (self, path, body = "", headers = {}):
+        """Perform HTTP PUT on path.
+
+        """
+
+        try:
+            result = self.request("PUT", path, body, headers)
+            logging.debug(result)
+            return result
+        except ElasticSearchError as e:
+            logging.info("ElasticSearch: error PUTing: " + str(e.code))
+            logging.info(e.body)
+            raise
+
+    def get (self, path):
+        """Perform HTTP GET on path.
+
+        """
+
+        return self.request("GET", path)
+
+    def post (self, path, body = ""):
+        """Perform HTTP POST on path.
+
+        """
+
+        result = self.request("POST", path, body)
         logging.debug(result)
         return result
-    except urllib2.HTTPError as e:
-        logging.info("ElasticSearch: error PUTing: " + str(e.code))
-        logging.info(e.read())
-        raise
 
+    def delete (self, path):
+        """Perform HTTP DELETE on path.
 
-def es_put_bulk (url, index, type, data, id, mapping = None, auth = None,
-                 batchsize = 10000):
-    """Use HTTP PUT, via bulk API, to upload documents to Elasticsearch.
+        Errors are logged, but not raised: the body of the response is
+        empty in that case.
 
-    Uploads a dataframe, assuming each row is a document, to the specified
-    index and type.
+        """
+
+        try:
+            result = self.request("DELETE", path)
+            logging.debug(result)
+        except ElasticSearchError as e:
+            if e.code == 404:
+                logging.info("ElasticSearch: resource to DELETE didn't exist")
+            else:
+                logging.info("ElasticSearch: error DELETEing: " + str(e.code))
+            logging.info(e.body)
+            result = ""
+        return result
+
+# ElasticSearch clients, by url and user, to share them in a run
+es_clients = {}
+es_clients_lock = threading.Lock()
+
+def es_client (url, auth = None):
+    """Get the client for an ElasticSearch server, creating it if needed.
 
     :param url: elasticsearch url
     :type url: str
-    :param index: index name
-    :type index: str
-    :param type: type name
-    :type type: str
-    :param data: dataframe to upload to elasticsearch
-    :type data: pandas.dataframe
-    :param id: dataframe field to use as document id
-    :type id: str
-    :param mapping: mapping JSON for index
-    :type mapping: str
     :param auth: authentication data (list with user and password)
     :type auth: list of str
-    :param batchsize: size of batches to upload (in number of items)
-    :type batchsize: int
+    :returns: client
+    :rtype: ElasticSearch
 
     """
 
-    if mapping:
-        logging.debug("Creating mappings for index/type " + index + "/" + type)
-        response = http_put (url + "/" + index + "/_mapping/" + type,
-                             mapping, auth = auth)
-        logging.debug(response)
-    index_line = '{{ "index" : {{ "_index" : "{index}", "_type" : "{type}", "_id" : "{id}" }} }}'
-    # Upload data using the bulk API
-    batch_pos = 0
-    batch_count = 1
-    batch = ""
-    for i, row in data.iterrows():
-        batch_item = index_line.format (index = index,
-                                        type = type,
-                                        id = row[id]) + '\n'
-        batch_item = batch_item + json_dumps(OrderedDict(row),
-                                             compact = True,
-                                             dateformat = "iso") + '\n'
-        batch = batch + batch_item
-        batch_pos = batch_pos + 1
-        if batch_pos % batchsize == 0:
-            logging.info("PUT to " + url + " " + index + "/" + type \
-                + " (batch no: " + str(batch_count) \
-                         + ", " + str(batch_pos) + " items, " \
-                         + str(len(batch)) + " bytes).")
-            http_put (url + "/_bulk", batch, auth = auth)
-            batch_pos = 0
-            batch_count = batch_count + 1
-            batch = ""
-    if batch_pos > 0:
-        logging.info("PUT to " + url + " " + index + "/" + type \
-            + " (batch no: " + str(batch_count) \
-            + ", " + str(batch_pos) + " items).")
-        http_put (url + "/_bulk", batch, auth = auth)
-
-
-def upload_elasticsearch (url, index, data, deleteold, auth, batchsize):
-    """Upload reviews data (dataframe) to elasticsearch in url.
-
-    The data to upload is a dictionary, with ElasticSearch types as keys,
-    and dataframes to upload for each of those types as vaules. For example:
-      {'reviews': reviews_df, 'commits': commits_df}
+    key = (url.rstrip("/"), tuple(auth) if auth else None)
+    with es_clients_lock:
+        if key not in es_clients:
+            es_clients[key] = ElasticSearch(url, auth = auth)
+        return es_clients[key]
 
-    :param url: elasticsearch url
-    :type url: str
+def json_encoder (dateformat = "iso"):
+    """Produce a compact JSON encoder, reusable for many values.
+
+    :param dateformat: format for datetime objects ("iso" or "utime")
+    :type dateformat: str or unicode
+    :returns: encoder
+    :rtype: json.JSONEncoder
+
+    """
+
+    if dateformat == "iso":
+        serializer = json_serial_iso
+    elif dateformat == "utime":
+        serializer = json_serial_utime
+    else:
+        raise ValueError ("Unknown format for datetime: " + str(dateformat))
+    return json.JSONEncoder(sort_keys=False, separators=(',',':'),
+                            default=serializer)
+
+def es_bulk_lines (data, index, type, id, blocksize = 1000):
+    """Produce bulk API lines (action and document) for a dataframe.
+
+    The dataframe is serialized by blocks of rows, encoding each column
+    of the block at once, and then gluing the encoded values of each row
+    into a document. Each item produced is a tuple (id, lines), with
+    lines being the action and document lines for the row, newline
+    terminated.
+
+    :param data: dataframe to serialize, or iterable of dataframes (chunks)
+    :type data: pandas.dataframe
     :param index: index name
     :type index: str
-    :param data: dictionary with dataframes to upload
-    :type data: dictionary (keys: type, values: pandas.dataframe)
-    :param deleteold: whether old content (index) should be deleted
-    :type dedleteold: bool
-    :param auth: authentication data (list with user and password)
-    :type auth: list of str
-    :param batchsize: size of batches to upload (in number of items)
-    :type batchsize: int
+    :param type: type name
+    :type type: str
+    :param id: dataframe field to use as document id
+    :type id: str
+    :param blocksize: number of rows to serialize at once
+    :type blocksize: int
 
     """
 
-    if deleteold:
-        logging.info("ElasticSearch: deleting index.")
-        response = http_delete (url = url + "/" + index, auth = auth)
-        logging.debug(response)
-    # Create index
-    logging.info("ElasticSearch: creating index " + index)
-    try:
-        response = http_put (url + "/" + index, "", auth = auth)
-        logging.debug("Elasticsearch index creation, response: " + response)
-    except urllib2.HTTPError as e:
-        logging.info("ElasticSearch: error creating index: " + str(e.code))
-    # Upload data to indices
-    for type, to_upload in data.iteritems():
-        es_put_bulk (url = url, index = index, type = type,
-                     data = to_upload['df'], id = to_upload['id'],
-                     mapping = to_upload['mapping'],
-                     auth = auth, batchsize = batchsize)
+    encoder = json_encoder(dateformat = "iso")
+    action = '{{ "index" : {{ "_index" : "{index}", "_type" : "{type}", ' \
+        + '"_id" : "{id}" }} }}\n'
+    if isinstance(data, pandas.DataFrame):
+        chunks = [data]
+    else:
+        chunks = data
+    for chunk in chunks:
+        # Keys are the same for all documents: encode them only once
+        keys = [encoder.encode(unicode(column)) + ':'
+                for column in chunk.columns]
+        for start in xrange(0, len(chunk.index), blocksize):
+            block = chunk.iloc[start:start + blocksize]
+            # astype(object) converts datetime64 to Timestamp (a datetime)
+            columns = [[encoder.encode(value) for value
+                        in block[column].astype(object).tolist()]
+                       for column in block.columns]
+            ids = block[id].tolist()
+            for doc_id, values in zip(ids, zip(*columns)):
+                doc = '{' + ','.join([key + value for key, value
+                                      in zip(keys, values)]) + '}\n'
+                yield (doc_id, action.format(index = index, type = type,
+                                             id = doc_id) + doc)
+
+class BatchController:
+    """Adapt the size (in bytes) of bulk batches to the server behaviour.
+
+    The target size grows while batches are accepted quickly, and
+    shrinks when they are slow, or rejected because the server is
+    overloaded (429, 503) or finds them too large (413).
 
-class Database:
-    """To work with a database (likely including several schemas).
     """
 
-    def __init__ (self, user, passwd, host, port, maindb, shdb, prjdb):
+    def __init__ (self, target, minimum = 256 * 1024,
+                  maximum = 64 * 1024 * 1024, latency = (2, 15)):
         """Init state.
 
-        :param user: user for accessing the MySQL database
-        :type user: str or unicode
-        :param passwd: password for the user accessing the MySQL database
-        :type passwd: str or unicode
-        :param host: hostname of the MySQL host
-        :type passwd: str or unicode
-        :param port: port to access MySQL
-        :type port: int
-        :param maindb: main database schema name (scm, src, etc.)
-        :type db: str or unicode
-        :param shdb: SortingHat database schema name
-        :type shdb: str or unicode
-        :param prjdb: projects database schema name
-        :type prjdb: str or unicode
+        :param target: initial target size for batches (in bytes)
+        :type target: int
+        :param minimum: minimum target size (in bytes)
+        :type minimum: int
+        :param maximum: maximum target size (in bytes)
+        :type maximum: int
+        :param latency: range of latencies (in seconds) considered normal
+        :type latency: tuple of float
 
         """
 
-        self.user = user
-        self.passwd = passwd
-        self.host = host
-        self.port = port
-        self.maindb = maindb
-        self.shdb = shdb
-        self.prjdb = prjdb
-        self.db, self.cursor = self._connect()
+        self.minimum = min(minimum, target)
+        self.maximum = max(maximum, target)
+        self.target = target
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def _resize (self, factor):
+
+        with self.lock:
+            self.target = int(min(self.maximum,
+                                  max(self.minimum, self.target * factor)))
+
+    def accepted (self, seconds):
+        """Adapt to a batch accepted by the server after some seconds.
 
-    def _connect(self):
-        """Connect to the MySQL database.
         """
 
-        try:
-            db = MySQLdb.connect(user = self.user, passwd = self.passwd,
-                                 host = self.host, port = self.port,
-                                 use_unicode = True)
-            return db, db.cursor()
-        except:
-            logging.error("Database connection error")
-            raise
+        if seconds < self.latency[0]:
+            self._resize(1.25)
+        elif seconds > self.latency[1]:
+            self._resize(0.75)
 
-    def execute(self, query):
-        """Execute an SQL query with the corresponding database.
+    def rejected (self):
+        """Adapt to a batch rejected by the server.
 
-        The query can be "templated" with {main_db} and {sh_db}.
         """
 
-        sql = query.format(main_db = self.maindb,
-                           sh_db = self.shdb,
-                           prj_db = self.prjdb)
-        logging.debug(sql)
-        result_length = int (self.cursor.execute(sql))
-        fields = [i[0] for i in self.cursor.description]
-        if result_length > 0:
-            results = self.cursor.fetchall()
-        else:
-            results = []
-        return (results, fields)
+        self._resize(0.5)
+        logging.info("ElasticSearch: batch target size reduced to " \
+                     + str(self.target) + " bytes.")
 
-    def execute_df(self, query, name = "", other = []):
-        """Execute an SQL query with the corresponding database, return dataframe.
+def es_bulk_batches (lines, batchsize = 10000, controller = None):
+    """Group bulk API lines in batches, ready to be uploaded.
 
-        The query can be "templated" with {main_db} and {sh_db}.
+    Batches are closed when they reach batchsize items or, if there is
+    a controller, its target size in bytes. Each batch is produced as a
+    list of (id, lines) tuples, which will be joined only when sending.
 
-        The "other" parameter is a list with rows to be added to the dataframe,
-        in addition to those obtained from the database. Each element in
-        that list is a tuple with the fields (in the same order than they
-        are received from the database) in the row.
+    :param lines: bulk API lines, as produced by es_bulk_lines
+    :type lines: iterable of (id, str) tuples
+    :param batchsize: maximum size of batches (in number of items)
+    :type batchsize: int
+    :param controller: controller for the size of batches (in bytes)
+    :type controller: BatchController
 
-        :param query: SQL query to execute
-        :type query: str
-        :param name: name of the results (for humans)
-        :type name: str
-        :param other: list of other rows that should be inclued in the dataframe
-        :type other: list of rows
+    """
+
+    batch = []
+    size = 0
+    for item in lines:
+        batch.append(item)
+        size = size + len(item[1])
+        if len(batch) == batchsize or \
+           (controller and size >= controller.target):
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+class BulkStats:
+    """Results of uploading items with the bulk API.
+
+    """
+
+    def __init__ (self, label):
+
+        self.label = label
+        self.succeeded = 0
+        self.failed = []
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.lock = threading.Lock()
+
+    def update (self, succeeded, failed = []):
+        """Account for some succeeded items, and some failed items (ids).
 
         """
 
-        logging.debug(name + " querying...")
-        (results, fields) = self.execute(query)
-        results_df = pandas.DataFrame(other + list(results),
-                                      columns = fields)
-        logging.info(name + ": " + str(len(results_df.index)))
-        return results_df
+        with self.lock:
+            self.succeeded = self.succeeded + succeeded
+            self.failed.extend(failed)
 
+    def sent (self, raw_bytes, sent_bytes):
+        """Account for a body sent, with its raw and sent (compressed) sizes.
 
-sql_reviews = """SELECT i.id AS id,
-  i.issue AS review,
-  i.summary AS summary,
-  i.submitted_by as submitter,
-  i.status AS status,
-  pu.uuid AS uuid
-FROM {main_db}.issues i
-  JOIN {main_db}.trackers t ON i.tracker_id = t.id
-  JOIN {main_db}.people_uidentities pu ON i.submitted_by = pu.people_id
-GROUP BY i.issue
-"""
+        """
 
-sql_reviews_extra = """SELECT branch,
-  url,
-  change_id AS githash,
-  project,
-  issue_id AS id
-FROM {main_db}.issues_ext_gerrit
-"""
+        with self.lock:
+            self.raw_bytes = self.raw_bytes + raw_bytes
+            self.sent_bytes = self.sent_bytes + sent_bytes
 
-sql_reviews_opened = """SELECT issue_id AS id,
-  MAX(changed_on) AS opened
-FROM {main_db}.changes
-WHERE (field='status' AND new_value='UPLOADED' AND old_value=1) OR
-  (field='Upload')
-GROUP BY issue_id
-"""
+    def report (self):
+        """Log results.
 
-sql_reviews_closed = """SELECT issue_id AS id,
-  MAX(changed_on) AS closed
-FROM {main_db}.changes
-WHERE field='status' AND (new_value='ABANDONED' OR new_value='MERGED')
-GROUP BY issue_id
-"""
+        """
 
-sql_reviews_patchsets = """SELECT issue_id AS id,
-  COUNT(DISTINCT(changes.old_value)) AS patchsets
-FROM {main_db}.changes
-WHERE changes.old_value != ""
-GROUP BY issue_id
-"""
+        logging.info("ElasticSearch: " + self.label + ": " \
+                     + str(self.succeeded) + " items uploaded, " \
+                     + str(len(self.failed)) + " items failed.")
+        if self.sent_bytes < self.raw_bytes:
+            logging.info("ElasticSearch: " + self.label + ": " \
+                         + str(self.raw_bytes) + " bytes compressed to " \
+                         + str(self.sent_bytes) + " (ratio: " \
+                         + str(round(float(self.raw_bytes) / self.sent_bytes, 1)) \
+                         + ", saved " + str(self.raw_bytes - self.sent_bytes) \
+                         + " bytes).")
+        if self.failed:
+            logging.info("ElasticSearch: " + self.label \
+                         + ": failed items (first 100): " \
+                         + ", ".join([str(id) for id in self.failed[:100]]))
 
-sql_reviews_persons = """SELECT uidentities.uuid AS uuid,
-  profiles.name AS name,
-  profiles.is_bot AS bot
-FROM {main_db}.issues
-  JOIN {main_db}.people_uidentities
-    ON people_uidentities.people_id = issues.submitted_by
-  JOIN {sh_db}.uidentities
-    ON uidentities.uuid = people_uidentities.uuid
-  LEFT JOIN {sh_db}.profiles
-    ON uidentities.uuid = profiles.uuid
-  GROUP BY uidentities.uuid
-"""
+bulk_item_decoder = json.JSONDecoder()
 
-sql_reviews_events = """SELECT c.id AS id,
-  i.issue AS review,
-  pup.uuid AS uuid,
-  c.field AS field,
-  c.old_value AS patchset,
-  c.new_value AS tag,
-  c.changed_on AS event_date
-FROM {main_db}.changes c
-  JOIN {main_db}.issues i ON i.id = c.issue_id
-  JOIN {main_db}.people_uidentities pup ON c.changed_by = pup.people_id
-WHERE field <> 'Upload'
-ORDER BY review, patchset, event_date
-"""
+def es_bulk_results (response):
+    """Parse the response of the bulk API, item by item.
 
-sql_reviews_events_persons = """SELECT uidentities.uuid AS uuid,
-  profiles.name AS name,
-  profiles.is_bot AS bot
-FROM {main_db}.changes
-  JOIN {main_db}.people_uidentities
-    ON people_uidentities.people_id = changes.changed_by
-  JOIN {sh_db}.uidentities
-    ON uidentities.uuid = people_uidentities.uuid
-  LEFT JOIN {sh_db}.profiles
-    ON uidentities.uuid = profiles.uuid
-  GROUP BY uidentities.uuid
-"""
+    Items in the response are decoded one by one, as they are
+    requested, instead of decoding the whole response at once.
+    For each item, a tuple (status, error) is produced, in the same
+    order as items were in the request.
 
-def query_review_retrieval (db):
-    """ Execute query to find out the newest time for data retrieval.
+    :param response: body of the response to a bulk request
+    :type response: str
 
     """
 
-    sql = """SELECT MAX(retrieved_on) as date
-FROM {main_db}.trackers
-"""
-
-    (date, fields) = db.execute(sql)
-    return date[0][0]
+    start = response.find('"items"')
+    if start < 0:
+        return
+    pos = response.index('[', start) + 1
+    end = len(response)
+    while True:
+        while pos < end and response[pos] in ' \t\r\n,':
+            pos = pos + 1
+        if pos >= end or response[pos] == ']':
+            return
+        (item, pos) = bulk_item_decoder.raw_decode(response, pos)
+        result = item.values()[0]
+        yield (result.get("status", 0), result.get("error"))
 
+def es_bulk_retryable (status, error):
+    """Is an item failed in a bulk request worth retrying?
 
-def analyze_scr (db, output, elasticsearch, dateformat, dashboard):
-    """Analyze SCR database.
+    Only items rejected because the server is overloaded are retryable.
 
     """
 
-    logging.debug("Starting SCR analysis")
-    retrieval_date = query_review_retrieval(db)
-    logging.info("Retrieval date: " + retrieval_date.isoformat())
+    if status == 429:
+        return True
+    # Errors are strings in ES 1.x, objects with a type later on
+    error = json.dumps(error).lower()
+    return "rejected_execution" in error or "rejectedexecution" in error
 
-    reviews_df = db.execute_df(sql_reviews, "Reviews")
-    extra_df = db.execute_df(sql_reviews_extra, "Reviews (extra)")
-    opened_df = db.execute_df(sql_reviews_opened, "Reviews (opened)")
-    closed_df = db.execute_df(sql_reviews_closed, "Reviews (closed)")
-    patchsets_df = db.execute_df(sql_reviews_patchsets, "Reviews (no. patchsets)")
-    persons_df = db.execute_df(sql_reviews_persons, "Persons (submitting reviews)")
-    events_df = db.execute_df(sql_reviews_events, "Events involving reviews")
-    persons_events_df = db.execute_df(sql_reviews_events_persons,
-                              "Persons (producing events)")
+def es_bulk_check (batch, response, stats = None, final = False):
+    """Check the response of the bulk API, finding failed items.
 
-    logging.debug("Merging into extended reviews dataframe.")
-    times_df = pandas.merge (opened_df, closed_df, on="id", how="left")
-    times_df["closed"].fillna(retrieval_date, inplace=True)
-    times_df["timeopen"] = (times_df["closed"] - times_df["opened"]) / (3600 * 24)
-#    times_df["timeopen"] = times_df["closed"] - times_df["opened"]
-#    times_df["timeopen"].apply(lambda x: x.item() / (3600 * 24.0 * 1e9))
-    logging.info("Reviews with timing: " + str(len(times_df.index)))
+    Failed items which are retryable are returned, unless this is the
+    final attempt. Other failed items are logged, and accounted as failed
+    in stats.
 
-    extended_df = pandas.merge (reviews_df, extra_df, on="id", how="left")
-    extended_df = pandas.merge (extended_df, times_df, on="id", how="left")
-    extended_df = pandas.merge (extended_df, patchsets_df, on="id", how="left")
-    extended_df = pandas.merge (extended_df, persons_df, on="uuid", how="left")
-    extended_df["dashboard"] = [dashboard] * len(extended_df.index)
+    :param batch: batch sent, as produced by es_bulk_batches
+    :type batch: list of (id, str) tuples
+    :param response: body of the response to the bulk request
+    :type response: str
+    :param stats: statistics to update
+    :type stats: BulkStats
+    :param final: whether this is the final attempt
+    :type final: bool
+    :returns: items to retry
+    :rtype: list of (id, str) tuples
 
-    logging.info("Reviews with extended info: " + str(len(extended_df.index)))
-    logging.debug("extended_df with NaN: " \
-                  + str(extended_df[extended_df.isnull().any(axis=1)]))
+    """
 
-    events_extended_df = pandas.merge (events_df, persons_events_df,
-                                       on="uuid", how="left")
-    events_extended_df = pandas.merge (events_extended_df,
-                                       extended_df[["review","opened","closed",
-                                                   "branch","project",
-                                                   "patchsets","status",
-                                                   "timeopen"]],
-                                       on="review", how="left")
-    events_extended_df["dashboard"] = [dashboard] * len(events_extended_df.index)
-    logging.info("Events with extended info: " \
-                 + str(len(events_extended_df.index)))
-    logging.info("events_extended_df with NaN (will be dropped): " \
-                  + str(events_extended_df[events_extended_df.isnull().any(axis=1)]))
-    events_extended_df = events_extended_df.dropna()
-    es_data = {}
-    if output:
-        logging.info("Producing JSON files in directory: " + output)
-        prefix = join (output, "scr-")
-        report = OrderedDict()
-        report[prefix + 'reviews.json'] = extended_df
-        create_report (report_files = report, destdir = './',
-                       dateformat = dateformat)
+    # Fast path: no errors (field usually in the first bytes)
+    if '"errors":false' in response[:128]:
+        if stats:
+            stats.update(len(batch))
+        return []
+    retry = []
+    failed = []
+    succeeded = 0
+    for (item, (status, error)) in zip(batch, es_bulk_results(response)):
+        if status < 300 or \
+           (status == 404 and item[1].startswith('{ "delete"')):
+            succeeded = succeeded + 1
+        elif not final and es_bulk_retryable(status, error):
+            retry.append(item)
+        else:
+            logging.debug("ElasticSearch: item " + str(item[0]) \
+                          + " failed: " + json.dumps(error))
+            failed.append(item[0])
+    if stats:
+        stats.update(succeeded, failed)
+    return retry
 
-    if elasticsearch:
-        es_data['review'] = {'df': extended_df, 'id': 'id',
-                             'mapping': scr_mapping_review}
-        es_data['event'] = {'df': events_extended_df, 'id': 'id',
-                             'mapping': scr_mapping_event}
-    return es_data
+def es_bulk_body (batch, compression = 0):
+    """Produce the body for a bulk request with a batch.
 
-def sql_commits_persons (allbranches, since):
-    """ Execute query to select persons."""
+    If compression is requested, the lines in the batch are compressed
+    (gzip) one after the other, so that the uncompressed body is never
+    built. The lines themselves are still held (in the batch) while the
+    compressed body is sent: they are needed to retry items rejected
+    individually (see es_bulk_check), to split batches too large, and
+    for the spool, and are already in memory when batches are produced.
 
-    sql = """SELECT uidentities.uuid AS uuid,
-  profiles.name AS name,
-  profiles.is_bot AS bot
-FROM {main_db}.scmlog
+    :param batch: batch to send, as produced by es_bulk_batches
+    :type batch: list of (id, str) tuples
+    :param compression: gzip compression level (0: no compression)
+    :type compression: int
+    :returns: body and its size before compression
+    :rtype: tuple (str, int)
+
+    """
+
+    if not compression:
+        body = ''.join([line for (doc_id, line) in batch])
+        return (body, len(body))
+    compressor = zlib.compressobj(compression, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    chunks = []
+    raw_size = 0
+    for (doc_id, line) in batch:
+        if isinstance(line, unicode):
+            line = line.encode("utf-8")
+        raw_size = raw_size + len(line)
+        chunks.append(compressor.compress(line))
+    chunks.append(compressor.flush())
+    return (''.join(chunks), raw_size)
+
+class SpooledBatch (list):
+    """Batch stored in a spool, with the name it has there.
+
+    """
+
+    def __init__ (self, name, items):
+
+        list.__init__(self, items)
+        self.name = name
+
+class Spool:
+    """Directory with batches for the bulk API, to resume failed uploads.
+
+    Each batch is written to its own NDJSON file, as it would be sent.
+    A manifest (manifest.json) lists batches not yet acknowledged by
+    ElasticSearch. It also lists aliases to swap once batches for
+    rebuilt indexes are uploaded, and mappings not put because some
+    upload failed before. Acknowledged batches are removed from it,
+    and their files deleted. Batch files and the manifest are synced
+    to disk before being relied on, and the manifest is replaced
+    atomically.
+
+    Once some upload failed, the rest of the batches are only stored,
+    so that all of them can be uploaded when resuming. Until then,
+    the spool cannot be used for new uploads (see spool_pending).
+
+    """
+
+    def __init__ (self, directory):
+        """Init state, reading the manifest in directory, if any.
+
+        :param directory: spool directory
+        :type directory: str or unicode
+
+        """
+
+        self.directory = directory
+        self.manifest_file = join (directory, "manifest.json")
+        self.lock = threading.Lock()
+        self.failed = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.manifest = spool_manifest(directory)
+        pending = len(self.pending())
+        if pending:
+            logging.info("Spool " + directory + ": " + str(pending) \
+                         + " batches pending from previous uploads.")
+
+    def _save (self):
+        """Save manifest (with lock acquired).
+
+        """
+
+        with open(self.manifest_file + ".tmp", "w") as file:
+            json.dump(self.manifest, file, separators = (',', ':'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(self.manifest_file + ".tmp", self.manifest_file)
+        # Sync the directory too, so that the rename is durable
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def pending (self):
+        """Get entries in the manifest for batches not acknowledged.
+
+        """
+
+        return list(self.manifest["batches"])
+
+    def store (self, label, batches):
+        """Store batches, producing them as spooled batches.
+
+        :param label: description of the batches
+        :type label: str
+        :param batches: batches, as produced by es_bulk_batches,
+            or by replay (which are not stored again)
+        :type batches: iterable of lists of (id, str) tuples
+
+        """
+
+        for batch in batches:
+            if isinstance(batch, SpooledBatch):
+                # Already in the spool (being replayed)
+                yield batch
+                continue
+            with self.lock:
+                self.manifest["last"] = self.manifest["last"] + 1
+                name = "%08d.ndjson" % self.manifest["last"]
+                with open(join (self.directory, name), "wb") as file:
+                    for (doc_id, line) in batch:
+                        if isinstance(line, unicode):
+                            line = line.encode("utf-8")
+                        file.write(line)
+                    file.flush()
+                    os.fsync(file.fileno())
+                self.manifest["batches"].append({"file": name,
+                                                 "label": label,
+                                                 "items": len(batch)})
+                self._save()
+            yield SpooledBatch(name, batch)
+
+    def fail (self, batches):
+        """Account for a failed upload, storing the rest of batches.
+
+        :param batches: batches not uploaded, as produced by store
+        :type batches: iterable of lists of (id, str) tuples
+
+        """
+
+        self.failed = True
+        logging.info("Spool " + self.directory + ": upload failed, " \
+                     + "storing the rest of batches to resume later.")
+        for batch in batches:
+            pass
+
+    def ack (self, name):
+        """Remove an acknowledged batch, and its file.
+
+        """
+
+        with self.lock:
+            self.manifest["batches"] = [entry for entry
+                                        in self.manifest["batches"]
+                                        if entry["file"] != name]
+            self._save()
+        os.remove(join (self.directory, name))
+
+    def replay (self):
+        """Produce pending batches, reading them from their files.
+
+        """
+
+        id_pattern = re.compile(r'"_id" : "(.*?)"')
+        for entry in self.pending():
+            with open(join (self.directory, entry["file"]), "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+                items = []
+                line = data.readline()
+                while line:
+                    doc_id = id_pattern.search(line).group(1)
+                    if not line.startswith('{ "delete"'):
+                        line = line + data.readline()
+                    items.append((doc_id, line))
+                    line = data.readline()
+                data.close()
+            yield SpooledBatch(entry["file"], items)
+
+    def add_swap (self, alias, index):
+        """Record an alias to swap, once all batches are acknowledged.
+
+        """
+
+        with self.lock:
+            self.manifest["swaps"].append([alias, index])
+            self._save()
+
+    def swaps (self):
+        """Get aliases to swap, as a list of (alias, index) tuples.
+
+        """
+
+        return [tuple(swap) for swap in self.manifest["swaps"]]
+
+    def remove_swap (self, alias, index):
+        """Remove an alias to swap, once it was done.
+
+        """
+
+        with self.lock:
+            self.manifest["swaps"].remove([alias, index])
+            self._save()
+
+    def add_mapping (self, index, type, mapping):
+        """Record a mapping to put before uploading batches for it.
+
+        """
+
+        with self.lock:
+            self.manifest["mappings"].append([index, type, mapping])
+            self._save()
+
+    def mappings (self):
+        """Get mappings to put, as a list of (index, type, mapping) tuples.
+
+        """
+
+        return [tuple(mapping) for mapping in self.manifest["mappings"]]
+
+    def remove_mapping (self, index, type, mapping):
+        """Remove a mapping to put, once it was done.
+
+        """
+
+        with self.lock:
+            self.manifest["mappings"].remove([index, type, mapping])
+            self._save()
+
+def spool_manifest (directory):
+    """Read the manifest of a spool directory (see Spool).
+
+    Entries for batches acknowledged, kept by manifests written
+    by previous versions, are dropped.
+
+    :param directory: spool directory
+    :type directory: str or unicode
+    :returns: manifest
+    :rtype: dict
+
+    """
+
+    filename = join (directory, "manifest.json")
+    if not os.path.exists(filename):
+        return {"batches": [], "swaps": [], "mappings": [], "last": 0}
+    with open(filename) as file:
+        manifest = json.load(file)
+    manifest["batches"] = [entry for entry in manifest["batches"]
+                           if not entry.get("acked")]
+    manifest.setdefault("mappings", [])
+    return manifest
+
+def spool_pending (directory):
+    """Is some upload pending in a spool directory (see Spool)?
+
+    Batches, mappings or alias swaps left by a failed upload are
+    pending until the upload is resumed (see resume_upload). New uploads
+    should not use the spool until then: batches spooled by them could
+    be overwritten by older ones when resuming, and aliases moved
+    to older indexes.
+
+    :param directory: spool directory
+    :type directory: str or unicode
+    :returns: whether some upload is pending
+    :rtype: bool
+
+    """
+
+    manifest = spool_manifest(directory)
+    return bool(manifest["batches"] or manifest["swaps"] \
+                or manifest["mappings"])
+
+def resume_upload (es, spooldir, workers = 1, compression = 0):
+    """Upload pending batches in a spool, and swap pending aliases.
+
+    Mappings not put when batches were spooled are put before
+    uploading any batch, so that documents are not indexed with
+    dynamic mappings.
+
+    :param es: elasticsearch client
+    :type es: ElasticSearch
+    :param spooldir: spool directory
+    :type spooldir: str or unicode
+    :param workers: number of concurrent uploads
+    :type workers: int
+    :param compression: gzip compression level (0: no compression)
+    :type compression: int
+
+    """
+
+    spool = Spool(spooldir)
+    for (index, type, mapping) in spool.mappings():
+        logging.debug("Creating mappings for index/type " + index + "/" + type)
+        response = es.put ("/" + index + "/_mapping/" + type, mapping)
+        logging.debug(response)
+        spool.remove_mapping(index, type, mapping)
+    stats = BulkStats("spool " + spooldir)
+    es_send_batches (es, spool.replay(), label = es.url + " (spool)",
+                     workers = workers, stats = stats,
+                     compression = compression, spool = spool)
+    stats.report()
+    for (alias, index) in spool.swaps():
+        es_swap_alias (es, alias, index)
+        spool.remove_swap(alias, index)
+
+# HTTP codes for the server pushing back: too large, too many, overloaded
+es_pushback_codes = (413, 429, 503)
+
+def es_send_batches (es, batches, label, workers = 1, controller = None,
+                     stats = None, compression = 0, spool = None,
+                     retries = 8, backoff = 1):
+    """Send batches to the bulk API, maybe with several concurrent senders.
+
+    When the server pushes back, the batch is sent again after an
+    exponential backoff, up to retries times. Batches too large (413)
+    are split in halves, and single documents too large fail at once. Items rejected individually because the server
+    is overloaded are sent again in the same way, but not the rest of
+    the batch. The controller, if any, is informed of latencies
+    and rejections.
+
+    If there is a spool, batches are stored in it before being sent,
+    and marked as acknowledged once the server answered for all their
+    items.
+
+    With more than one worker, batches are produced (serialized) in
+    the calling thread while being sent by the workers. Batches waiting
+    to be sent are kept in a bounded queue (as many as workers), so that
+    at most twice the number of workers batches are in memory. On the
+    first failure no more batches are queued, and after all workers
+    finish, the error for the lowest batch number is raised.
+
+    :param es: elasticsearch client
+    :type es: ElasticSearch
+    :param batches: batches to send, as produced by es_bulk_batches
+    :type batches: iterable of lists of (id, str) tuples
+    :param label: description of the batches, for logging
+    :type label: str
+    :param workers: number of concurrent senders
+    :type workers: int
+    :param controller: controller for the size of batches (in bytes)
+    :type controller: BatchController
+    :param stats: statistics to update with the result of each item
+    :type stats: BulkStats
+    :param compression: gzip compression level for bodies (0: no compression)
+    :type compression: int
+    :param spool: spool to store batches before sending them
+    :type spool: Spool
+    :param retries: maximum number of retries for a batch
+    :type retries: int
+    :param backoff: seconds to wait before the first retry
+    :type backoff: float
+
+    """
+
+    if compression:
+        headers = {"Content-Encoding": "gzip"}
+    else:
+        headers = {}
+
+    def send_batch (number, batch):
+        (body, raw_size) = es_bulk_body (batch, compression)
+        if compression:
+            size = str(raw_size) + " bytes, gzipped to " + str(len(body))
+        else:
+            size = str(raw_size)
+        logging.info("PUT to " + label \
+            + " (batch no: " + str(number) \
+            + ", " + str(len(batch)) + " items, " \
+            + size + " bytes).")
+        delay = backoff
+        for attempt in range(retries + 1):
+            start = time.time()
+            try:
+                response = es.put ("/_bulk", body, headers)
+                if stats:
+                    stats.sent(raw_size, len(body))
+            except ElasticSearchError as e:
+                if e.code == 413 and len(batch) == 1:
+                    # A single document too large will never be accepted
+                    raise ElasticSearchError("PUT", es.url + "/_bulk " \
+                                             + "(document " + str(batch[0][0]) \
+                                             + ", " + str(raw_size) \
+                                             + " bytes, too large)",
+                                             e.code, e.body)
+                if e.code not in es_pushback_codes or attempt == retries:
+                    raise
+                if controller:
+                    controller.rejected()
+                if e.code == 413 and len(batch) > 1:
+                    half = len(batch) // 2
+                    send_batch (number, batch[:half])
+                    send_batch (number, batch[half:])
+                    return
+            else:
+                if controller:
+                    controller.accepted(time.time() - start)
+                retry = es_bulk_check (batch, response, stats,
+                                       final = (attempt == retries))
+                if not retry:
+                    return
+                # Some items were rejected by an overloaded server
+                if controller:
+                    controller.rejected()
+                batch = retry
+                (body, raw_size) = es_bulk_body (batch, compression)
+            wait = random.uniform(delay / 2.0, delay)
+            logging.info("ElasticSearch: pushing back, retrying " \
+                         + str(len(batch)) + " items of batch no. " \
+                         + str(number) + " in " + str(round(wait, 1)) + " s.")
+            time.sleep(wait)
+            delay = delay * 2
+
+    def send (number, batch):
+        send_batch (number, batch)
+        if spool:
+            spool.ack(batch.name)
+
+    if spool:
+        batches = spool.store(label, batches)
+        if spool.failed:
+            # Some upload failed, just spool batches, to resume later
+            for batch in batches:
+                pass
+            return
+    if workers <= 1:
+        try:
+            for number, batch in enumerate(batches, 1):
+                send (number, batch)
+        except Exception:
+            exc_info = sys.exc_info()
+            if spool:
+                spool.fail(batches)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return
+    pending = Queue.Queue(maxsize = workers)
+    errors = []
+
+    def sender ():
+        while True:
+            job = pending.get()
+            if job is None:
+                return
+            if errors:
+                # Some batch failed, just drain the queue
+                continue
+            try:
+                send (*job)
+            except Exception:
+                errors.append((job[0], sys.exc_info()))
+
+    threads = [threading.Thread(target = sender) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for number, batch in enumerate(batches, 1):
+            if errors:
+                break
+            pending.put((number, batch))
+    finally:
+        for thread in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+    if errors and spool:
+        spool.fail(batches)
+    if errors:
+        (number, exc_info) = min(errors, key = lambda error: error[0])
+        logging.info("ElasticSearch: batch no. " + str(number) + " failed.")
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+class SyncState:
+    """State of documents uploaded to ElasticSearch, to upload only changes.
+
+    For each index and type, a hash of the contents of each document
+    is kept, by document id. The state is stored in a JSON file.
+
+    """
+
+    def __init__ (self, filename):
+        """Init state, reading it from filename, if it exists.
+
+        :param filename: name of the file with the state
+        :type filename: str or unicode
+
+        """
+
+        self.filename = filename
+        if os.path.exists(filename):
+            with open(filename) as file:
+                self.state = json.load(file)
+        else:
+            logging.info("No synchronization state in " + filename \
+                         + ", uploading everything.")
+            self.state = {}
+
+    def hashes (self, index, type):
+        """Get hashes of documents already in index and type.
+
+        :returns: hashes of documents, by document id (as str)
+        :rtype: dict
+
+        """
+
+        return self.state.get(index, {}).get(type, {})
+
+    def update (self, index, type, hashes):
+        """Set hashes of documents in index and type.
+
+        """
+
+        self.state.setdefault(index, {})[type] = hashes
+
+    def save (self):
+        """Save the state to its file.
+
+        """
+
+        with open(self.filename + ".tmp", "w") as file:
+            json.dump(self.state, file, separators=(',',':'))
+        os.rename(self.filename + ".tmp", self.filename)
+
+def es_bulk_changes (lines, index, type, known, current):
+    """Select bulk API lines for new or modified documents, and deletions.
+
+    Documents (lines) with the same hash that in known are skipped.
+    After all lines, delete actions are produced for documents in known
+    which were not found in lines. The hashes for all documents in lines
+    are stored in current.
+
+    :param lines: bulk API lines, as produced by es_bulk_lines
+    :type lines: iterable of (id, str) tuples
+    :param index: index name
+    :type index: str
+    :param type: type name
+    :type type: str
+    :param known: hashes of documents already uploaded, by id
+    :type known: dict
+    :param current: dictionary to fill with hashes of documents, by id
+    :type current: dict
+
+    """
+
+    unchanged = 0
+    for (doc_id, line) in lines:
+        key = unicode(doc_id)
+        # Hash only the document, not the action (which includes the index)
+        digest = hashlib.md5(line[line.index('\n') + 1:]).hexdigest()
+        current[key] = digest
+        if known.get(key) == digest:
+            unchanged = unchanged + 1
+        else:
+            yield (doc_id, line)
+    logging.info("ElasticSearch: " + index + "/" + type + ": " \
+                 + str(unchanged) + " documents unchanged.")
+    action = '{{ "delete" : {{ "_index" : "{index}", "_type" : "{type}", ' \
+        + '"_id" : "{id}" }} }}\n'
+    for key in known:
+        if key not in current:
+            yield (key, action.format(index = index, type = type, id = key))
+
+def es_put_bulk (es, index, type, data, id, mapping = None,
+                 batchsize = 10000, batchbytes = 0, workers = 1,
+                 compression = 0, hashes = None, spool = None):
+    """Use HTTP PUT, via bulk API, to upload documents to Elasticsearch.
+
+    Uploads a dataframe, assuming each row is a document, to the specified
+    index and type.
+
+    Returns statistics about the uploaded items, including the
+    ids of those that failed.
+
+    If hashes of documents already uploaded are specified, only
+    documents new or modified are uploaded, and those not in data are
+    deleted. The statistics include then the hashes of documents after
+    the upload (failed documents are left to be uploaded next time).
+
+    :param es: elasticsearch client
+    :type es: ElasticSearch
+    :param index: index name
+    :type index: str
+    :param type: type name
+    :type type: str
+    :param data: dataframe to upload to elasticsearch, or iterable
+        of dataframes (chunks)
+    :type data: pandas.dataframe
+    :param id: dataframe field to use as document id
+    :type id: str
+    :param mapping: mapping JSON for index
+    :type mapping: str
+    :param batchsize: size of batches to upload (in number of items)
+    :type batchsize: int
+    :param batchbytes: initial target size of batches to upload (in bytes),
+        adapted to the server behaviour (0 to use only batchsize)
+    :type batchbytes: int
+    :param workers: number of concurrent uploads
+    :type workers: int
+    :param compression: gzip compression level (0: no compression)
+    :type compression: int
+    :param hashes: hashes of documents already uploaded, by id
+    :type hashes: dict
+    :param spool: spool to store batches before sending them
+    :type spool: Spool
+    :returns: statistics of the upload
+    :rtype: BulkStats
+
+    """
+
+    # If some upload failed, batches are just spooled (see Spool),
+    # and so is the mapping, to put it when resuming
+    if mapping and spool and spool.failed:
+        spool.add_mapping(index, type, mapping)
+    elif mapping:
+        logging.debug("Creating mappings for index/type " + index + "/" + type)
+        response = es.put ("/" + index + "/_mapping/" + type, mapping)
+        logging.debug(response)
+    # Upload data using the bulk API
+    lines = es_bulk_lines (data, index = index, type = type, id = id)
+    if hashes is not None:
+        current = {}
+        lines = es_bulk_changes (lines, index, type, hashes, current)
+    if batchbytes:
+        controller = BatchController(batchbytes)
+    else:
+        controller = None
+    batches = es_bulk_batches (lines, batchsize = batchsize,
+                               controller = controller)
+    label = es.url + " " + index + "/" + type
+    stats = BulkStats(index + "/" + type)
+    es_send_batches (es, batches, label = label,
+                     workers = workers, controller = controller,
+                     stats = stats, compression = compression,
+                     spool = spool)
+    if hashes is not None:
+        for doc_id in stats.failed:
+            key = unicode(doc_id)
+            if key in current:
+                del current[key]
+            else:
+                # Failed deletion
+                current[key] = hashes[key]
+        stats.hashes = current
+    return stats
+
+
+# Settings for indexes being loaded in bulk, restored once they are loaded
+es_bulk_settings = {"refresh_interval": "-1", "number_of_replicas": 0}
+# Defaults for those settings, for indexes which had them unset
+es_default_settings = {"refresh_interval": "1s", "number_of_replicas": 1}
+
+def es_create_rebuild_index (es, alias, data):
+    """Create a new index, ready to be loaded in bulk, for an alias.
+
+    The new index is named after the alias and the current time
+    (eg: openstack-scm-20151020103000), has refresh and replicas disabled,
+    and the mappings for all types in data.
+
+    :param es: elasticsearch client
+    :type es: ElasticSearch
+    :param alias: name of the alias that will point to the index
+    :type alias: str
+    :param data: dictionary with data to upload, including mappings
+    :type data: dictionary (keys: type, values: dict with 'mapping')
+    :returns: name of the new index
+    :rtype: str
+
+    """
+
+    index = alias + "-" + datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    mappings = {}
+    for type, to_upload in data.iteritems():
+        if to_upload['mapping']:
+            mappings.update(json.loads(to_upload['mapping']))
+    logging.info("ElasticSearch: creating index " + index + " for " + alias)
+    es.put ("/" + index, json.dumps({"settings": {"index": es_bulk_settings},
+                                     "mappings": mappings}))
+    return index
+
+def es_swap_alias (es, alias, index, keep = 0):
+    """Move an alias to an index, and delete the indexes it pointed to.
+
+    The settings changed for bulk loading (see es_bulk_settings) are
+    restored to those of the index the alias pointed to, or to the
+    defaults (see es_default_settings) if it had none, or there was no
+    such index. The alias is moved atomically, except if there is an
+    index with the name of the alias (produced before using aliases),
+    which has to be deleted first. Once moved, the indexes the alias
+    pointed to are deleted, except for the keep most recent ones.
+    Other indexes named like rebuilt ones are left alone, since they
+    could still be loaded by other uploads.
+
+    :param es: elasticsearch client
+    :type es: ElasticSearch
+    :param alias: name of the alias
+    :type alias: str
+    :param index: name of the index the alias will point to
+    :type index: str
+    :param keep: number of old indexes to keep
+    :type keep: int
+
+    """
+
+    try:
+        current = json.loads(es.get ("/" + alias + "/_settings"))
+    except ElasticSearchError as e:
+        if e.code != 404:
+            raise
+        current = {}
+    settings = dict(es_default_settings)
+    if current:
+        previous = current[sorted(current.keys())[-1]]["settings"]["index"]
+        for name in settings:
+            settings[name] = previous.get(name, settings[name])
+    logging.info("ElasticSearch: restoring settings for index " + index)
+    es.put ("/" + index + "/_settings", json.dumps({"index": settings}))
+    es.post ("/" + index + "/_refresh")
+    if alias in current:
+        logging.info("ElasticSearch: replacing index " + alias \
+                     + " by an alias")
+        es.delete ("/" + alias)
+        del current[alias]
+    actions = [{"remove": {"index": old, "alias": alias}} for old in current]
+    actions.append({"add": {"index": index, "alias": alias}})
+    logging.info("ElasticSearch: moving alias " + alias + " to " + index)
+    es.post ("/_aliases", json.dumps({"actions": actions}))
+    old = sorted([name for name in current if name != index], reverse = True)
+    for name in old[keep:]:
+        logging.info("ElasticSearch: deleting old index " + name)
+        es.delete ("/" + name)
+
+class IndexUpload:
+    """Upload of data to an ElasticSearch index, maybe in several parts.
+
+    Data is uploaded by calling upload (as many times as needed, with
+    data for different types), and then finish. The index is prepared
+    (deleted, created) on the first upload.
+
+    If rebuild is requested, data is uploaded to a new index, created
+    with settings for bulk loading, and index is made an alias for it
+    when finishing. The index being used until then remains
+    available during the upload.
+
+    If syncstate is specified, only documents changed since the upload
+    recorded in it are uploaded, and documents no longer present are
+    deleted (unless the index is new, in which case everything is
+    uploaded).
+
+    """
+
+    def __init__ (self, es, index, deleteold, batchsize,
+                  batchbytes = 0, workers = 1, compression = 0,
+                  rebuild = False, syncstate = None, spooldir = None):
+        """Init state.
+
+        :param es: elasticsearch client
+        :type es: ElasticSearch
+        :param index: index name
+        :type index: str
+        :param deleteold: whether old content (index) should be deleted
+        :type dedleteold: bool
+        :param batchsize: size of batches to upload (in number of items)
+        :type batchsize: int
+        :param batchbytes: initial target size of batches to upload (in bytes)
+        :type batchbytes: int
+        :param workers: number of concurrent uploads
+        :type workers: int
+        :param compression: gzip compression level (0: no compression)
+        :type compression: int
+        :param rebuild: rebuild in a new index, and move alias index to it
+        :type rebuild: bool
+        :param syncstate: name of the file with the synchronization state
+        :type syncstate: str or unicode
+        :param spooldir: directory to spool batches, to resume failed uploads
+        :type spooldir: str or unicode
+
+        """
+
+        self.es = es
+        self.index = index
+        self.deleteold = deleteold
+        self.batchsize = batchsize
+        self.batchbytes = batchbytes
+        self.workers = workers
+        self.compression = compression
+        self.rebuild = rebuild
+        self.alias = None
+        self.syncstate = syncstate
+        self.state = None
+        self.state_index = index
+        self.spooldir = spooldir
+        self.spool = None
+        self.started = False
+        # Mappings already set for the index
+        self.mapped = set()
+        self.stats = OrderedDict()
+        self.error = None
+
+    def _start (self, data):
+        """Prepare the index, before uploading data to it.
+
+        Synchronization state and spool are read now, and not when
+        initializing, since previous uploads could be updating them.
+
+        """
+
+        es = self.es
+        if self.syncstate:
+            self.state = SyncState(self.syncstate)
+        if self.spooldir:
+            if spool_pending(self.spooldir):
+                raise ValueError ("Spool " + self.spooldir + " has uploads " \
+                                  + "pending: resume them first, " \
+                                  + "or remove the spool")
+            self.spool = Spool(self.spooldir)
+        if self.rebuild:
+            self.alias = self.index
+            self.index = es_create_rebuild_index (es, self.alias, data)
+            self.mapped.update(data.keys())
+            if self.spool:
+                self.spool.add_swap(self.alias, self.index)
+        else:
+            if self.deleteold:
+                logging.info("ElasticSearch: deleting index.")
+                response = es.delete ("/" + self.index)
+                logging.debug(response)
+            # Create index
+            logging.info("ElasticSearch: creating index " + self.index)
+            try:
+                response = es.put ("/" + self.index, "")
+                logging.debug("Elasticsearch index creation, response: " \
+                              + response)
+            except ElasticSearchError as e:
+                logging.info("ElasticSearch: error creating index: " \
+                             + str(e.code))
+        self.started = True
+
+    def upload (self, data):
+        """Upload data.
+
+        The data to upload is a dictionary, with ElasticSearch types as keys,
+        and dataframes to upload for each of those types as vaules.
+        For example:
+          {'reviews': reviews_df, 'commits': commits_df}
+
+        :param data: dictionary with dataframes to upload
+        :type data: dictionary (keys: type, values: pandas.dataframe)
+
+        """
+
+        if not self.started:
+            self._start(data)
+        for type, to_upload in data.iteritems():
+            if type in self.mapped:
+                mapping = None
+            else:
+                mapping = to_upload['mapping']
+            if not self.state:
+                hashes = None
+            elif self.rebuild or self.deleteold:
+                hashes = {}
+            else:
+                hashes = self.state.hashes(self.state_index, type)
+            try:
+                stats = es_put_bulk (es = self.es, index = self.index,
+                                     type = type,
+                                     data = to_upload['df'],
+                                     id = to_upload['id'],
+                                     mapping = mapping,
+                                     batchsize = self.batchsize,
+                                     batchbytes = self.batchbytes,
+                                     workers = self.workers,
+                                     compression = self.compression,
+                                     hashes = hashes, spool = self.spool)
+            except Exception:
+                if not self.spool:
+                    raise
+                # Go on, spooling the rest of the types, to resume later
+                self.error = self.error or sys.exc_info()
+                continue
+            self.stats[type] = stats
+
+    def finish (self):
+        """Finish the upload, reporting, and moving the alias if rebuilding.
+
+        """
+
+        if self.error:
+            error = self.error
+            raise error[0], error[1], error[2]
+        for stats in self.stats.values():
+            stats.report()
+        if self.rebuild and self.started:
+            es_swap_alias (self.es, self.alias, self.index)
+            if self.spool:
+                self.spool.remove_swap(self.alias, self.index)
+        if self.state:
+            for (type, stats) in self.stats.iteritems():
+                self.state.update(self.state_index, type, stats.hashes)
+            self.state.save()
+
+    def abort (self):
+        """Abort the upload, after failing to produce the rest of the data.
+
+        If rebuilding, the alias is not moved to the new index, which is
+        left incomplete, and the swap is not left pending in the spool.
+
+        """
+
+        if self.rebuild and self.started:
+            logging.info("ElasticSearch: upload aborted, index " \
+                         + self.index + " left incomplete.")
+            if self.spool:
+                self.spool.remove_swap(self.alias, self.index)
+
+class Pipeline:
+    """Run jobs (such as uploads) in a thread, while others are prepared.
+
+    Jobs are run in the same order they were submitted. At most
+    maxsize jobs may be waiting to run (submit blocks until then),
+    so that memory used by data for them is bounded. Once a job fails,
+    the rest are not run (which is logged, with their names), and the
+    error is raised when checking, submitting, waiting or joining.
+
+    """
+
+    def __init__ (self, maxsize = 2):
+
+        self.jobs = Queue.Queue(maxsize = maxsize)
+        self.error = None
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run (self):
+
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                return
+            (job, name) = item
+            if self.error:
+                logging.info("Pipeline: not running " + name \
+                             + ", since a previous job failed.")
+            else:
+                try:
+                    job()
+                except Exception:
+                    self.error = sys.exc_info()
+                    logging.info("Pipeline: " + name + " failed: " \
+                                 + str(self.error[1]))
+            self.jobs.task_done()
+
+    def check (self):
+        """Raise the error of the job that failed, if any.
+
+        """
+
+        if self.error:
+            error = self.error
+            raise error[0], error[1], error[2]
+
+    def submit (self, job, name = "job"):
+        """Submit a job (a callable with no arguments) to be run.
+
+        :param job: job to run
+        :type job: callable
+        :param name: name of the job, for logging
+        :type name: str
+
+        """
+
+        self.check()
+        self.jobs.put((job, name))
+
+    def wait (self):
+        """Wait for all jobs submitted to run, leaving the pipeline idle.
+
+        """
+
+        self.jobs.join()
+        self.check()
+
+    def close (self):
+        """Wait for all jobs to run, without raising their errors.
+
+        For finishing the pipeline while some other error is being
+        raised (errors of jobs are logged when they fail).
+
+        """
+
+        self.jobs.put(None)
+        self.thread.join()
+
+    def join (self):
+        """Wait for all jobs to run.
+
+        """
+
+        self.close()
+        self.check()
+
+def apply_schema (df, schema):
+    """Convert columns of a dataframe to the types in a schema.
+
+    The schema is a dictionary with column names as keys, and types
+    as values. Types can be NumPy integer types (eg: "int64", "int8"),
+    "datetime" (stored as int64 nanoseconds since the epoch), or
+    "category" (for strings with few distinct values, stored as integer
+    codes to a dictionary of values). Integer columns with NULL values
+    are left as they are (there is no integer NaN). Columns not in the
+    dataframe are ignored.
+
+    :param df: dataframe to convert (modified in place)
+    :type df: pandas.dataframe
+    :param schema: types for columns
+    :type schema: dict
+    :returns: the dataframe
+    :rtype: pandas.dataframe
+
+    """
+
+    for column, kind in schema.iteritems():
+        if column not in df.columns:
+            continue
+        if kind == "category":
+            df[column] = df[column].astype("category")
+        elif kind == "datetime":
+            df[column] = pandas.to_datetime(df[column])
+        elif not df[column].isnull().any():
+            df[column] = df[column].astype(kind)
+    return df
+
+def fillna_category (series, value):
+    """Fill NaN in a series, which may be categorical.
+
+    Categorical series cannot be filled with a value which is not one
+    of their categories, so it is added if needed.
+
+    """
+
+    if str(series.dtype) == "category" and \
+       value not in series.cat.categories:
+        series = series.cat.add_categories([value])
+    return series.fillna(value)
+
+def constant_column (value, length):
+    """Produce a categorical column with the same value in all rows.
+
+    """
+
+    return pandas.Categorical.from_codes(numpy.zeros(length, dtype = "int8"),
+                                         [value])
+
+class ConnectionPool:
+    """Pool of connections to a MySQL server.
+
+    Idle connections are kept for reuse, and checked before being
+    handed out: those dropped by the server (eg, because of timeouts
+    while idle) are replaced by new ones. Each connection remembers
+    the schema it is using, so that it is only switched when needed.
+
+    The number of queries running at the same time in the server is
+    limited to workers (acquire the slots semaphore before running one).
+
+    """
+
+    def __init__ (self, user, passwd, host, port, poolsize = 8, workers = 1):
+        """Init state.
+
+        :param user: user for accessing the MySQL database
+        :type user: str or unicode
+        :param passwd: password for the user accessing the MySQL database
+        :type passwd: str or unicode
+        :param host: hostname of the MySQL host
+        :type passwd: str or unicode
+        :param port: port to access MySQL
+        :type port: int
+        :param poolsize: maximum number of idle connections kept
+        :type poolsize: int
+        :param workers: maximum number of queries running at the same time
+        :type workers: int
+
+        """
+
+        self.user = user
+        self.passwd = passwd
+        self.host = host
+        self.port = port
+        self.poolsize = max(poolsize, workers)
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _open (self):
+        """Open a new connection.
+
+        """
+
+        logging.debug("MySQL: opening connection to " + str(self.host) \
+                      + ":" + str(self.port))
+        try:
+            return MySQLdb.connect(user = self.user, passwd = self.passwd,
+                                   host = self.host, port = self.port,
+                                   use_unicode = True)
+        except:
+            logging.error("Database connection error")
+            raise
+
+    def acquire (self, schema = None):
+        """Get a connection from the pool, or a new one if none is idle.
+
+        :param schema: schema to use in the connection (None for any)
+        :type schema: str or unicode
+        :returns: connection, and whether it was reused
+        :rtype: tuple (MySQLdb.connection, bool)
+
+        """
+
+        connection = None
+        with self.lock:
+            if self.idle:
+                (connection, current) = self.idle.pop()
+        if connection is not None:
+            try:
+                connection.ping()
+                reused = True
+            except MySQLdb.Error:
+                logging.debug("MySQL: dropped connection, reconnecting")
+                self.discard(connection)
+                connection = None
+        if connection is None:
+            (connection, current, reused) = (self._open(), None, False)
+        if schema and schema != current:
+            connection.select_db(schema)
+            current = schema
+        connection.schema = current
+        return (connection, reused)
+
+    def release (self, connection):
+        """Return a connection to the pool.
+
+        """
+
+        with self.lock:
+            if len(self.idle) < self.poolsize:
+                self.idle.append((connection, connection.schema))
+                return
+        self.discard(connection)
+
+    def discard (self, connection):
+        """Close a connection, which will not be used any more.
+
+        """
+
+        try:
+            connection.close()
+        except MySQLdb.Error:
+            pass
+
+    def close (self):
+        """Close all idle connections.
+
+        """
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for (connection, schema) in idle:
+            self.discard(connection)
+
+db_pools = {}
+db_pools_lock = threading.Lock()
+# Pools inherited from the parent, in worker processes (see scm_partition_init)
+db_pools_inherited = {}
+
+def db_pool (user, passwd, host, port, workers = 1):
+    """Get the connection pool for a MySQL server, creating it if needed.
+
+    Pools are shared by all Database objects accessing the same server
+    with the same user. The limit of concurrent queries (workers) is
+    the one specified when the pool is created.
+
+    :returns: pool of connections
+    :rtype: ConnectionPool
+
+    """
+
+    key = (host, port, user)
+    with db_pools_lock:
+        if key not in db_pools:
+            db_pools[key] = ConnectionPool(user, passwd, host, port,
+                                           workers = workers)
+        return db_pools[key]
+
+def write_frame (filename, df):
+    """Write a dataframe to a columnar file (NumPy .npz).
+
+    The file has an array per column (codes and categories for
+    categorical columns), and the names and kinds of columns. It is
+    written to a temporary file first, and then renamed.
+
+    :param filename: name of the file
+    :type filename: str or unicode
+    :param df: dataframe to write
+    :type df: pandas.dataframe
+
+    """
+
+    arrays = {}
+    columns = []
+    for number, name in enumerate(df.columns):
+        prefix = "c" + str(number)
+        values = df[name].values
+        if isinstance(values, pandas.Categorical):
+            arrays[prefix + "codes"] = values.codes
+            arrays[prefix + "categories"] = \
+                numpy.asarray(values.categories, dtype = object)
+            columns.append((name, "category"))
+        else:
+            arrays[prefix] = values
+            columns.append((name, "array"))
+    arrays["columns"] = numpy.array(json.dumps(columns))
+    # Temporary name unique to the writer (process and thread)
+    tmpname = "%s.%d.%d.tmp" % (filename, os.getpid(),
+                                threading.current_thread().ident)
+    # numpy.savez adds .npz to names not ending in it, use a file object
+    with open(tmpname, "wb") as file:
+        numpy.savez(file, **arrays)
+    os.rename(tmpname, filename)
+
+def read_frame (filename):
+    """Read a dataframe from a columnar file (see write_frame).
+
+    :param filename: name of the file
+    :type filename: str or unicode
+    :returns: dataframe
+    :rtype: pandas.dataframe
+
+    """
+
+    with numpy.load(filename, allow_pickle = True) as arrays:
+        columns = OrderedDict()
+        for number, (name, kind) in \
+                enumerate(json.loads(str(arrays["columns"]))):
+            prefix = "c" + str(number)
+            if kind == "category":
+                columns[name] = pandas.Categorical.from_codes(
+                    arrays[prefix + "codes"],
+                    arrays[prefix + "categories"])
+            else:
+                columns[name] = arrays[prefix]
+    return pandas.DataFrame(columns)
+
+class ResultCache:
+    """Local cache of query results, stored as columnar files.
+
+    Each result is a file in the cache directory (see write_frame).
+    Results are found by a key, which should change when the data in
+    the database changes (see Database.execute_df). When the cache grows
+    over maxbytes, the least recently used results are removed.
+
+    The cache may be shared by several threads and processes. Eviction
+    is serialized with a lock file in the directory, and results removed
+    by someone else meanwhile are ignored.
+
+    """
+
+    def __init__ (self, directory, maxbytes = 2 * 1024 ** 3):
+        """Init state, creating the directory if needed.
+
+        :param directory: directory for the cache
+        :type directory: str or unicode
+        :param maxbytes: maximum size of the cache, in bytes
+        :type maxbytes: int
+
+        """
+
+        self.directory = directory
+        self.maxbytes = maxbytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _filename (self, key):
+        """Name of the file for the result for key.
+
+        """
+
+        return join (self.directory, key + ".npz")
+
+    def get (self, key):
+        """Get the result for key, or None if it is not in the cache.
+
+        :param key: key of the result
+        :type key: str
+        :returns: result
+        :rtype: pandas.dataframe
+
+        """
+
+        filename = self._filename(key)
+        try:
+            df = read_frame(filename)
+            # Used now, for evicting least recently used results
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            logging.info("Cache: ignoring unreadable result " + filename)
+            return None
+        return df
+
+    def put (self, key, df):
+        """Store the result for key, and evict results if needed.
+
+        :param key: key of the result
+        :type key: str
+        :param df: result
+        :type df: pandas.dataframe
+
+        """
+
+        write_frame(self._filename(key), df)
+        self.evict()
+
+    def _locked (self):
+        """Open and lock (exclusively) the lock file of the cache.
+
+        The lock is released when the file returned is closed.
+
+        """
+
+        lock = open(join(self.directory, "lock"), "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _remove (self, name):
+        """Remove a file, unless it was already removed.
+
+        """
+
+        try:
+            os.remove(join(self.directory, name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def evict (self):
+        """Remove least recently used results, until under maxbytes.
+
+        Errors are logged, but not raised: the cache is just not
+        evicted this time.
+
+        """
+
+        try:
+            with self._locked():
+                entries = []
+                for name in os.listdir(self.directory):
+                    if name.endswith(".npz"):
+                        try:
+                            stat = os.stat(join(self.directory, name))
+                        except OSError as e:
+                            if e.errno != errno.ENOENT:
+                                raise
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, name))
+                entries.sort()
+                total = sum(size for (mtime, size, name) in entries)
+                for (mtime, size, name) in entries:
+                    if total <= self.maxbytes:
+                        break
+                    logging.debug("Cache: evicting " + name)
+                    self._remove(name)
+                    total = total - size
+        except Exception as e:
+            logging.info("Cache: could not evict results: " + str(e))
+
+    def clear (self):
+        """Remove all results.
+
+        """
+
+        with self._locked():
+            for name in os.listdir(self.directory):
+                if name.endswith(".npz") or name.endswith(".tmp"):
+                    self._remove(name)
+
+class IncrementalState:
+    """State for incremental extraction of data from a database.
+
+    It includes watermarks (for example, the last commit id retrieved),
+    and the raw data (dataframes) retrieved up to them, so that only
+    rows past the watermarks have to be retrieved in the next run, and
+    merged with the raw data. Watermarks are stored in a JSON file, and
+    dataframes as columnar files (see write_frame), all in a directory
+    for each dashboard and data source.
+
+    """
+
+    def __init__ (self, directory, name):
+        """Init state, reading watermarks, if any.
+
+        :param directory: directory for all incremental states
+        :type directory: str or unicode
+        :param name: name of this state (dashboard and data source)
+        :type name: str or unicode
+
+        """
+
+        self.directory = join(directory, name)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.filename = join(self.directory, "watermarks.json")
+        if os.path.exists(self.filename):
+            with open(self.filename) as file:
+                self.watermarks = json.load(file)
+        else:
+            logging.info("No incremental state in " + self.directory \
+                         + ", retrieving everything.")
+            self.watermarks = {}
+
+    def watermark (self, name):
+        """Get a watermark, or None if there is no state.
+
+        """
+
+        return self.watermarks.get(name)
+
+    def frame (self, name):
+        """Get raw data stored with the watermarks, or None if not found.
+
+        """
+
+        if not self.watermarks:
+            return None
+        return read_frame(join(self.directory, name + ".npz"))
+
+    def save (self, frames, watermarks):
+        """Save raw data, and then the watermarks up to which it goes.
+
+        :param frames: dataframes to save, by name
+        :type frames: dict
+        :param watermarks: watermarks, by name
+        :type watermarks: dict
+
+        """
+
+        for name, df in frames.iteritems():
+            write_frame(join(self.directory, name + ".npz"), df)
+        with open(self.filename + ".tmp", "w") as file:
+            json.dump(watermarks, file)
+        os.rename(self.filename + ".tmp", self.filename)
+        self.watermarks = watermarks
+
+def incremental_name (db, source, dashboard, *settings):
+    """Produce the name of the incremental state for a data source.
+
+    The name includes the dashboard and the data source, and a hash
+    of the databases and the settings used, so that changing any of
+    them starts a new state.
+
+    """
+
+    description = repr((db.host, db.port, db.maindb, db.shdb, db.prjdb)
+                       + settings)
+    return re.sub(r"[^\w.-]", "_", dashboard) + "-" + source + "-" \
+        + hashlib.sha1(description).hexdigest()[:12]
+
+def increment_merge (old_df, new_df, key, keep = "last"):
+    """Merge raw data in an incremental state with new rows.
+
+    Rows with the same key may come from a previous run interrupted
+    after saving the raw data, but before saving the watermarks, or be
+    rows retrieved again because they may have changed (see analyze_scr),
+    or new rows for data already retrieved (see analyze_scm).
+    By default, rows in new_df replace those saved with the same key.
+
+    :param key: name of the column identifying rows
+    :type key: str
+    :param keep: "last" to keep rows in new_df, "first" to keep those
+        saved (old_df), for rows with the same key
+    :type keep: str
+    :returns: merged data
+    :rtype: pandas.dataframe
+
+    """
+
+    if old_df is None:
+        return new_df
+    merged_df = pandas.concat([old_df, new_df], ignore_index = True)
+    return merged_df.drop_duplicates(key, keep = keep) \
+                    .reset_index(drop = True)
+
+# People (identities in the database) and their unique identities
+sql_people_uidentities = """SELECT people_id, uuid
+FROM {main_db}.people_uidentities
+"""
+
+def people_fingerprint (db):
+    """Get the fingerprint of people_uidentities, for caching results.
+
+    SortingHat may rewrite the table at any time, without new data in
+    the rest of the database, so results including uuids joined from it
+    are valid only while it does not change.
+
+    :returns: checksum of the table
+    :rtype: int
+
+    """
+
+    (rows, fields) = db.execute("CHECKSUM TABLE {main_db}.people_uidentities")
+    return rows[0][1]
+
+def people_remap (db, df, people, uuid):
+    """Set uuids for people, according to the current people_uidentities.
+
+    Raw data in incremental states may have been retrieved when the
+    uuid for some person was different. People with no uuid now get
+    a missing value.
+
+    :param df: data, with people ids and uuids
+    :type df: pandas.dataframe
+    :param people: name of the column with people ids
+    :type people: str
+    :param uuid: name of the column with uuids
+    :type uuid: str
+    :returns: data, with uuids updated
+    :rtype: pandas.dataframe
+
+    """
+
+    people_df = db.execute_df(sql_people_uidentities, "People",
+                              cache = False).drop_duplicates("people_id")
+    codes = pandas.Index(people_df["people_id"]).get_indexer(df[people])
+    df[uuid] = take_codes(people_df["uuid"], codes)
+    return df
+
+# Errors for connections dropped by the server (gone away, lost)
+db_dropped_codes = (2006, 2013)
+
+# Time (seconds) the server waits for a client consuming results
+# in chunks (net_write_timeout), before dropping the connection
+db_stream_timeout = 3600
+
+class Database:
+    """To work with a database (likely including several schemas).
+
+    Connections are taken from the pool for the server (see db_pool)
+    for each query, and returned to it when done, so that Database
+    objects are cheap, and can be used from several threads.
+
+    """
+
+    def __init__ (self, user, passwd, host, port, maindb, shdb, prjdb,
+                  workers = 1, cache = None, stagingdb = None):
+        """Init state.
+
+        :param user: user for accessing the MySQL database
+        :type user: str or unicode
+        :param passwd: password for the user accessing the MySQL database
+        :type passwd: str or unicode
+        :param host: hostname of the MySQL host
+        :type passwd: str or unicode
+        :param port: port to access MySQL
+        :type port: int
+        :param maindb: main database schema name (scm, src, etc.)
+        :type db: str or unicode
+        :param shdb: SortingHat database schema name
+        :type shdb: str or unicode
+        :param prjdb: projects database schema name
+        :type prjdb: str or unicode
+        :param workers: maximum number of queries running at the same time
+            in the server (see db_pool)
+        :type workers: int
+        :param cache: cache for query results (None for no cache)
+        :type cache: ResultCache
+        :param stagingdb: scratch database schema name, for staging
+            tables (None for no staging tables)
+        :type stagingdb: str or unicode
+
+        """
+
+        self.user = user
+        self.passwd = passwd
+        self.host = host
+        self.port = port
+        self.maindb = maindb
+        self.shdb = shdb
+        self.prjdb = prjdb
+        self.stagingdb = stagingdb
+        self.pool = db_pool(user, passwd, host, port, workers)
+        self.cache = cache
+        # Fingerprint of the data in the database, to be set (for example,
+        # to the last commit id) before results can be cached
+        self.fingerprint = None
+        # Check the server is reachable, and leave a connection ready
+        (connection, reused) = self.pool.acquire(self.maindb)
+        self.pool.release(connection)
+
+    def execute(self, query):
+        """Execute an SQL query with the corresponding database.
+
+        The query can be "templated" with {main_db}, {sh_db}, {prj_db}
+        and {staging_db}.
+        """
+
+        sql = query.format(main_db = self.maindb,
+                           sh_db = self.shdb,
+                           prj_db = self.prjdb,
+                           staging_db = self.stagingdb)
+        logging.debug(sql)
+        with self.pool.slots:
+            return self._execute(sql)
+
+    def _execute(self, sql):
+        """Execute an SQL query (already formatted) in a pooled connection.
+
+        """
+
+        while True:
+            (connection, reused) = self.pool.acquire(self.maindb)
+            try:
+                cursor = connection.cursor()
+                result_length = int (cursor.execute(sql))
+                # No description for statements not producing rows
+                fields = [i[0] for i in cursor.description or []]
+                if result_length > 0:
+                    results = cursor.fetchall()
+                else:
+                    results = []
+                cursor.close()
+            except MySQLdb.OperationalError as e:
+                self.pool.discard(connection)
+                if reused and e.args[0] in db_dropped_codes:
+                    logging.debug("MySQL: connection dropped, retrying")
+                    continue
+                raise
+            except:
+                self.pool.discard(connection)
+                raise
+            self.pool.release(connection)
+            return (results, fields)
+
+    def execute_df(self, query, name = "", other = [], schema = None,
+                   cache = True):
+        """Execute an SQL query with the corresponding database, return dataframe.
+
+        The query can be "templated" with {main_db}, {sh_db}, {prj_db}
+        and {staging_db}.
+
+        The "other" parameter is a list with rows to be added to the dataframe,
+        in addition to those obtained from the database. Each element in
+        that list is a tuple with the fields (in the same order than they
+        are received from the database) in the row.
+
+        :param query: SQL query to execute
+        :type query: str
+        :param name: name of the results (for humans)
+        :type name: str
+        :param other: list of other rows that should be inclued in the dataframe
+        :type other: list of rows
+        :param schema: types for columns (see apply_schema)
+        :type schema: dict
+        :param cache: use the cache, if any, and the fingerprint is set
+            (results of queries which may change even if the fingerprint
+            does not, should not be cached)
+        :type cache: bool
+
+        """
+
+        if cache and self.cache and self.fingerprint:
+            key = self.cache_key(query, other, schema)
+            results_df = self.cache.get(key)
+            if results_df is not None:
+                logging.info(name + " (cached): " + str(len(results_df.index)))
+                return results_df
+        logging.debug(name + " querying...")
+        (results, fields) = self.execute(query)
+        if other:
+            results = other + list(results)
+        results_df = pandas.DataFrame.from_records(results, columns = fields)
+        if schema:
+            apply_schema (results_df, schema)
+        logging.info(name + ": " + str(len(results_df.index)))
+        if cache and self.cache and self.fingerprint:
+            self.cache.put(key, results_df)
+        return results_df
+
+    def cache_key(self, query, other = [], schema = None):
+        """Produce the key for the results of a query in the cache.
+
+        The key depends on the server, the schemas, the SQL query,
+        the fingerprint of the data, and the way results are produced.
+
+        """
+
+        sql = query.format(main_db = self.maindb,
+                           sh_db = self.shdb,
+                           prj_db = self.prjdb,
+                           staging_db = self.stagingdb)
+        description = repr((self.host, self.port, self.maindb, self.shdb,
+                            self.prjdb, sql, self.fingerprint, other,
+                            sorted((schema or {}).items())))
+        return hashlib.sha1(description).hexdigest()
+
+    def execute_dfs(self, queries):
+        """Execute independent SQL queries concurrently, return dataframes.
+
+        Each query is run in its own thread (and connection), but the
+        number of them running at the same time in the server is limited
+        by the workers of its connection pool. If any query fails, the
+        error for the first one failing (in the order of the list) is
+        raised, once all of them are done.
+
+        :param queries: parameters for execute_df, for each query
+        :type queries: list of dict
+        :returns: dataframes, in the same order than queries
+        :rtype: list of pandas.dataframe
+
+        """
+
+        if self.pool.workers <= 1:
+            return [self.execute_df(**query) for query in queries]
+        results = [None] * len(queries)
+        errors = {}
+        def run (number, query):
+            try:
+                results[number] = self.execute_df(**query)
+            except:
+                errors[number] = sys.exc_info()
+        threads = [threading.Thread(target = run, args = (number, query))
+                   for number, query in enumerate(queries)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            (error_type, error, traceback) = errors[min(errors)]
+            raise error_type, error, traceback
+        return results
+
+    def execute_chunks(self, query, name = "", chunksize = 100000,
+                       schema = None):
+        """Execute an SQL query, producing dataframes with chunks of results.
+
+        A server side cursor is used, so that results are retrieved from
+        the server as chunks are produced, instead of all at once. Since
+        other queries cannot be run in the connection while results are
+        being retrieved, a connection is taken from the pool for the
+        whole retrieval. If the retrieval is not completed, the connection
+        is closed, since it could still have results pending. Since
+        retrieval goes at the pace of consumers of the chunks, it does not
+        count for the limit of concurrent queries in the server. Results
+        retrieved in chunks are not cached.
+
+        Consumers may take long (for example, uploading with retries)
+        before asking for the next chunk, so the time the server waits
+        for the client is raised to db_stream_timeout while retrieving.
+
+        The query can be "templated" with {main_db}, {sh_db}, {prj_db}
+        and {staging_db}.
+
+        :param query: SQL query to execute
+        :type query: str
+        :param name: name of the results (for humans)
+        :type name: str
+        :param chunksize: number of rows per chunk
+        :type chunksize: int
+        :param schema: types for columns (see apply_schema)
+        :type schema: dict
+
+        """
+
+        sql = query.format(main_db = self.maindb,
+                           sh_db = self.shdb,
+                           prj_db = self.prjdb,
+                           staging_db = self.stagingdb)
+        logging.debug(name + " querying (in chunks)...")
+        logging.debug(sql)
+        (connection, reused) = self.pool.acquire(self.maindb)
+        done = False
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SET SESSION net_write_timeout = " \
+                           + str(db_stream_timeout))
+            cursor.close()
+            cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+            cursor.execute(sql)
+            fields = [i[0] for i in cursor.description]
+            total = 0
+            while True:
+                results = cursor.fetchmany(chunksize)
+                if not results:
+                    break
+                total = total + len(results)
+                logging.debug(name + ": chunk of " + str(len(results)))
+                chunk = pandas.DataFrame.from_records(results, columns = fields)
+                if schema:
+                    apply_schema (chunk, schema)
+                yield chunk
+            logging.info(name + ": " + str(total))
+            cursor.close()
+            cursor = connection.cursor()
+            cursor.execute("SET SESSION net_write_timeout = DEFAULT")
+            cursor.close()
+            done = True
+        finally:
+            if done:
+                self.pool.release(connection)
+            else:
+                self.pool.discard(connection)
+
+
+# SortingHat identities: unique identities with their profiles,
+# enrollments, and organizations
+sql_sh_persons = """SELECT uidentities.uuid AS uuid,
+  profiles.name AS name,
+  profiles.is_bot AS bot
+FROM {sh_db}.uidentities
+  LEFT JOIN {sh_db}.profiles
+    ON uidentities.uuid = profiles.uuid
+ORDER BY uidentities.uuid
+"""
+
+sql_sh_enrollments = """SELECT uuid,
+  organization_id AS org_id,
+  start,
+  end
+FROM {sh_db}.enrollments
+"""
+
+sql_sh_orgs = """SELECT id AS org_id,
+  name AS org_name
+FROM {sh_db}.organizations
+ORDER BY org_id
+"""
+
+sh_schema = {"org_id": "int64", "start": "datetime", "end": "datetime"}
+
+# Base and span (in seconds) for keys of enrollment intervals: dates are
+# stored as seconds since 1900, which fit in 2**33 until year 2172
+sh_base = numpy.datetime64("1900-01-01T00:00:00", "s").astype("int64")
+sh_span = 2 ** 33
+
+def sh_seconds (dates):
+    """Convert dates to seconds since 1900, clipped to [0, sh_span).
+
+    Missing dates (NaT) are converted to -1.
+
+    :param dates: dates
+    :type dates: pandas.Series or numpy.ndarray of datetime64
+    :returns: seconds
+    :rtype: numpy.ndarray of int64
+
+    """
+
+    dates = numpy.asarray(dates, dtype = "datetime64[ns]")
+    seconds = dates.astype("datetime64[s]").astype("int64") - sh_base
+    seconds = numpy.clip(seconds, 0, sh_span - 1)
+    seconds[numpy.isnat(dates)] = -1
+    return seconds
+
+class IdentityIndex:
+    """In-memory index of SortingHat identities.
+
+    Maps unique identities (uuid) to their name and bot flag, and to
+    the organizations they were enrolled in, and when. It is loaded
+    once, and then used to resolve authors, submitters and actors in
+    data from the SCM and SCR databases, instead of joining with the
+    SortingHat tables in each query.
+
+    Enrollments are kept sorted by a composite key, uuid code * sh_span
+    + start (in seconds, see sh_seconds), so that enrollments for many
+    (uuid, date) pairs can be found at once by binary search.
+
+    """
+
+    def __init__ (self, db):
+        """Load the index from the SortingHat database of db.
+
+        :param db: database, with the SortingHat schema to load
+        :type db: Database
+
+        """
+
+        logging.debug("Loading SortingHat identities from " + db.shdb)
+        # SortingHat data can change at any time, so it is not cached
+        (persons_df, enrollments_df, orgs_df) = db.execute_dfs([
+            dict(query = sql_sh_persons, name = "SortingHat identities",
+                 cache = False),
+            dict(query = sql_sh_enrollments, name = "SortingHat enrollments",
+                 schema = sh_schema, cache = False),
+            dict(query = sql_sh_orgs, name = "SortingHat organizations",
+                 schema = sh_schema, cache = False)
+            ])
+        self.persons_df = persons_df
+        self.person_index = pandas.Index(persons_df["uuid"])
+        self.orgs_df = orgs_df
+        # Sorted enrollment intervals, with uuids coded as integers
+        uuids = pandas.Categorical(enrollments_df["uuid"])
+        self.uuids = uuids.categories
+        starts = sh_seconds(enrollments_df["start"])
+        ends = sh_seconds(enrollments_df["end"])
+        # No start means since ever, no end means for ever
+        starts[starts < 0] = 0
+        ends[ends < 0] = sh_span - 1
+        keys = uuids.codes.astype("int64") * sh_span + starts
+        order = numpy.argsort(keys, kind = "mergesort")
+        self.keys = keys[order]
+        self.codes = uuids.codes[order]
+        self.ends = ends[order]
+        self.org_ids = enrollments_df["org_id"].values[order]
+        if len(self.codes):
+            self.max_enrollments = int(numpy.bincount(self.codes).max())
+        else:
+            self.max_enrollments = 0
+
+    def persons (self, uuids = None):
+        """Produce persons (uuid, name, bot), ordered by uuid.
+
+        :param uuids: uuids of persons to include (None for all)
+        :type uuids: iterable of str
+        :returns: persons
+        :rtype: pandas.dataframe
+
+        """
+
+        if uuids is None:
+            return self.persons_df.copy()
+        persons_df = self.persons_df[self.persons_df["uuid"].isin(uuids)]
+        return persons_df.reset_index(drop = True)
+
+    def person_codes (self, uuids):
+        """Code uuids as positions in persons, -1 for unknown ones.
+
+        :param uuids: uuids to code
+        :type uuids: pandas.Series
+        :returns: codes
+        :rtype: numpy.ndarray of int
+
+        """
+
+        return self.person_index.get_indexer(uuids)
+
+    def affiliate (self, df, uuid, date):
+        """Find the organization for each row, according to enrollments.
+
+        The organization is the one of the enrollment of the person
+        including the date (strictly after its start, and before its end).
+        If several enrollments include it, the one starting later is used.
+        Rows with no such enrollment get no organization (NaN).
+
+        For each row, the enrollments of the person starting before the
+        date are found by binary search on the sorted keys. Then, they are
+        checked backwards (for all rows at once) until one including the
+        date is found, which usually happens in the first step.
+
+        :param df: data with persons and dates
+        :type df: pandas.dataframe
+        :param uuid: name of the column with uuids
+        :type uuid: str
+        :param date: name of the column with dates
+        :type date: str
+        :returns: data, with org_id and org_name columns added
+        :rtype: pandas.dataframe
+
+        """
+
+        codes = self.uuids.get_indexer(df[uuid]).astype("int64")
+        seconds = sh_seconds(df[date])
+        found = numpy.full(len(codes), -1, dtype = "int64")
+        pending = numpy.flatnonzero((codes >= 0) & (seconds >= 0))
+        # Last enrollment for the same person starting before the date
+        candidates = numpy.searchsorted(self.keys,
+                                        codes[pending] * sh_span \
+                                        + seconds[pending],
+                                        side = "left") - 1
+        for step in xrange(self.max_enrollments):
+            valid = candidates >= 0
+            pending, candidates = pending[valid], candidates[valid]
+            valid = self.codes[candidates] == codes[pending]
+            pending, candidates = pending[valid], candidates[valid]
+            if not len(pending):
+                break
+            including = seconds[pending] < self.ends[candidates]
+            found[pending[including]] = candidates[including]
+            pending = pending[~including]
+            candidates = candidates[~including] - 1
+        org_ids = pandas.Series(numpy.nan, index = df.index)
+        affiliated = found >= 0
+        org_ids[affiliated] = self.org_ids[found[affiliated]]
+        org_names = self.orgs_df.set_index("org_id")["org_name"]
+        df = df.copy()
+        df["org_id"] = org_ids
+        df["org_name"] = org_ids.map(org_names)
+        return df
+
+identity_indexes = {}
+identity_indexes_lock = threading.Lock()
+
+def identity_index (db):
+    """Get the identity index for the SortingHat database of db.
+
+    Indexes are loaded once per server and SortingHat database, and
+    shared by all the analyses using it.
+
+    :param db: database
+    :type db: Database
+    :returns: identity index
+    :rtype: IdentityIndex
+
+    """
+
+    key = (db.host, db.port, db.user, db.shdb)
+    with identity_indexes_lock:
+        if key not in identity_indexes:
+            identity_indexes[key] = IdentityIndex(db)
+        return identity_indexes[key]
+
+# Types for columns obtained from the SCR database (see apply_schema)
+scr_schema = {"id": "int64", "submitter": "int64", "patchsets": "int32",
+              "opened": "datetime", "closed": "datetime",
+              "event_date": "datetime",
+              "issue_id": "int64",
+              "status": "category", "branch": "category",
+              "project": "category", "field": "category"}
+
+# SQL expressions for the columns that can be selected for reviews
+sql_reviews_columns = OrderedDict([
+    ("id", "i.id"),
+    ("review", "i.issue"),
+    ("summary", "i.summary"),
+    ("submitter", "i.submitted_by"),
+    ("status", "i.status"),
+    ("uuid", "pu.uuid")
+    ])
+
+def sql_reviews (columns = None):
+    """Produce SQL query to select reviews.
+
+    :param columns: names of columns to select (see sql_reviews_columns),
+        or None for all of them
+    :type columns: collection of str
+
+    """
+
+    return "SELECT " + sql_select(sql_reviews_columns, columns) + """
+FROM {main_db}.issues i
+  JOIN {main_db}.trackers t ON i.tracker_id = t.id
+  JOIN {main_db}.people_uidentities pu ON i.submitted_by = pu.people_id
+GROUP BY i.issue
+"""
+
+# SQL expressions for the columns that can be selected for reviews (extra)
+sql_reviews_extra_columns = OrderedDict([
+    ("branch", "branch"),
+    ("url", "url"),
+    ("githash", "change_id"),
+    ("project", "project"),
+    ("id", "issue_id")
+    ])
+
+def sql_reviews_extra (columns = None):
+    """Produce SQL query to select extra information for reviews.
+
+    :param columns: names of columns to select
+        (see sql_reviews_extra_columns), or None for all of them
+    :type columns: collection of str
+
+    """
+
+    return "SELECT " + sql_select(sql_reviews_extra_columns, columns) + """
+FROM {main_db}.issues_ext_gerrit
+"""
+
+# Columns of reviews always needed, for persons and events
+scr_reviews_required = ["id", "review", "status", "uuid", "branch", "project"]
+
+# All changes, for computing timing, patchsets and events in a single pass.
+# Events need the review and the person, timing and patchsets do not.
+def sql_reviews_changes (ids = None, reviews = False):
+    """Produce SQL query to select changes.
+
+    :param ids: range of change ids to select (see sql_ids_conditions)
+    :type ids: tuple of int
+    :param reviews: select instead all changes (up to the last id) of
+        reviews with some change in ids
+    :type reviews: bool
+
+    """
+
+    sql = """SELECT c.id AS id,
+  c.issue_id AS issue_id,
+  i.issue AS review,
+  c.changed_by AS changed_by,
+  pup.uuid AS uuid,
+  c.field AS field,
+  c.old_value AS patchset,
+  c.new_value AS tag,
+  c.changed_on AS event_date
+FROM {main_db}.changes c
+  LEFT JOIN {main_db}.issues i ON i.id = c.issue_id
+  LEFT JOIN {main_db}.people_uidentities pup ON c.changed_by = pup.people_id
+"""
+    if reviews and ids and ids[0] is not None:
+        conditions = ["c.issue_id IN (SELECT issue_id " \
+                      + "FROM {main_db}.changes WHERE " \
+                      + " AND ".join(sql_ids_conditions("id", ids)) + ")"]
+        conditions.extend(sql_ids_conditions("c.id", (None, ids[1])))
+    else:
+        conditions = sql_ids_conditions("c.id", ids)
+    if conditions:
+        sql = sql + "WHERE " + " AND ".join(conditions) + "\n"
+    sql = sql + "ORDER BY c.issue_id\n"
+    return sql
+
+# Watermarks for SCR data: last change, last retrieval
+sql_scr_watermark = """SELECT MAX(id) FROM {main_db}.changes
+"""
+
+def query_review_retrieval (db):
+    """ Execute query to find out the newest time for data retrieval.
+
+    """
+
+    sql = """SELECT MAX(retrieved_on) as date
+FROM {main_db}.trackers
+"""
+
+    (date, fields) = db.execute(sql)
+    return date[0][0]
+
+
+def scr_changes_summary (changes_df):
+    """Compute timing, patchsets and events for reviews, from their changes.
+
+    All changes for each review (issue_id) should be in changes_df. It
+    produces the same results that used to come from separate queries:
+    time of the last upload (opened), time of the last merge or abandon
+    (closed), number of distinct patchsets, and events (changes but
+    uploads, involving a known review and person).
+
+    :param changes_df: changes (see sql_reviews_changes)
+    :type changes_df: pandas.dataframe
+    :returns: opened, closed, patchsets and events dataframes
+    :rtype: tuple of pandas.dataframe
+
+    """
+
+    field = changes_df["field"].astype(object)
+    tag = changes_df["tag"].astype(object)
+    patchset = changes_df["patchset"]
+    uploaded = ((field == "status") & (tag == "UPLOADED") \
+                & (pandas.to_numeric(patchset, errors = "coerce") == 1)) \
+                | (field == "Upload")
+    opened_df = changes_df[uploaded].groupby("issue_id")["event_date"] \
+        .max().reset_index()
+    opened_df.columns = ["id", "opened"]
+    finished = (field == "status") & tag.isin(["ABANDONED", "MERGED"])
+    closed_df = changes_df[finished].groupby("issue_id")["event_date"] \
+        .max().reset_index()
+    closed_df.columns = ["id", "closed"]
+    with_patchset = patchset.notnull() & (patchset != "")
+    patchsets_df = changes_df[with_patchset].groupby("issue_id")["patchset"] \
+        .nunique().reset_index()
+    patchsets_df.columns = ["id", "patchsets"]
+    is_event = field.notnull() & (field != "Upload") \
+        & changes_df["review"].notnull() & changes_df["uuid"].notnull()
+    events_df = changes_df[is_event].drop(["issue_id", "changed_by"],
+                                          axis = 1) \
+        .sort_values(["review", "patchset", "event_date"], kind = "mergesort") \
+        .reset_index(drop = True)
+    return (opened_df, closed_df, patchsets_df, events_df)
+
+def scr_changes_chunks (chunks):
+    """Regroup chunks of changes, so that all changes for a review are in one.
+
+    Changes should be ordered by issue_id. The changes for the last review
+    in each chunk are held back, and produced with the next chunk.
+
+    :param chunks: chunks of changes
+    :type chunks: iterable of pandas.dataframe
+    :returns: chunks of changes, with all changes for each review
+    :rtype: generator of pandas.dataframe
+
+    """
+
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pandas.concat([pending, chunk], ignore_index = True)
+        last = chunk["issue_id"] == chunk["issue_id"].iat[-1]
+        pending = chunk[last]
+        if not last.all():
+            yield chunk[~last]
+    if pending is not None:
+        yield pending
+
+def scr_reviews_timing (reviews_df, opened_df, closed_df, patchsets_df,
+                        retrieval_date):
+    """Add timing (opened, closed, timeopen) and no. of patchsets to reviews.
+
+    Reviews not closed are considered open until retrieval_date.
+
+    """
+
+    times_df = pandas.merge (opened_df, closed_df, on="id", how="left")
+    times_df["closed"].fillna(retrieval_date, inplace=True)
+    times_df["timeopen"] = (times_df["closed"] - times_df["opened"]) / (3600 * 24)
+#    times_df["timeopen"] = times_df["closed"] - times_df["opened"]
+#    times_df["timeopen"].apply(lambda x: x.item() / (3600 * 24.0 * 1e9))
+    logging.debug("Reviews with timing: " + str(len(times_df.index)))
+
+    extended_df = pandas.merge (reviews_df, times_df, on="id", how="left")
+    return pandas.merge (extended_df, patchsets_df, on="id", how="left")
+
+# Columns of reviews included in events
+scr_events_reviews_columns = ["review", "opened", "closed", "branch", "project",
+                              "patchsets", "status", "timeopen"]
+
+class ReviewChanges:
+    """Single streamed pass over changes, producing events and reviews.
+
+    Changes are retrieved in chunks, ordered by review. For each chunk,
+    events are extended with the information of their reviews, which is
+    complete since all changes for a review are in the same chunk. Timing
+    and patchsets for reviews are accumulated as chunks are processed,
+    so reviews can only be produced once all events were produced.
+
+    """
+
+    def __init__ (self, chunks, reviews_df, persons_df, persons_events_df,
+                  retrieval_date, dashboard):
+        """Init state.
+
+        :param chunks: chunks of changes, ordered by issue_id
+        :type chunks: iterable of pandas.dataframe
+        :param reviews_df: reviews, with extra information
+        :type reviews_df: pandas.dataframe
+        :param persons_df: persons submitting reviews
+        :type persons_df: pandas.dataframe
+        :param persons_events_df: persons producing events
+        :type persons_events_df: pandas.dataframe
+        :param retrieval_date: date of retrieval of the data
+        :type retrieval_date: datetime.datetime
+        :param dashboard: dashboard name
+        :type dashboard: str
+
+        """
+
+        self.chunks = scr_changes_chunks(chunks)
+        self.reviews_df = reviews_df
+        self.persons_df = persons_df
+        self.persons_events_df = persons_events_df
+        self.retrieval_date = retrieval_date
+        self.dashboard = dashboard
+        self.opened = []
+        self.closed = []
+        self.patchsets = []
+
+    def events (self):
+        """Produce extended events, chunk by chunk.
+
+        """
+
+        for chunk in self.chunks:
+            (opened_df, closed_df, patchsets_df, events_df) = \
+                scr_changes_summary (chunk)
+            self.opened.append(opened_df)
+            self.closed.append(closed_df)
+            self.patchsets.append(patchsets_df)
+            reviews_df = self.reviews_df[self.reviews_df["id"] \
+                                         .isin(chunk["issue_id"].unique())]
+            reviews_df = scr_reviews_timing (reviews_df, opened_df, closed_df,
+                                             patchsets_df, self.retrieval_date)
+            yield scr_events_extended (events_df, self.persons_events_df,
+                                       reviews_df[scr_events_reviews_columns],
+                                       self.dashboard)
+
+    def reviews (self):
+        """Produce extended reviews, once all changes were processed.
+
+        If events were not produced (or not all of them), the rest of the
+        changes are processed now.
+
+        """
+
+        for events_df in self.events():
+            pass
+        opened_df = pandas.concat(self.opened, ignore_index = True)
+        closed_df = pandas.concat(self.closed, ignore_index = True)
+        patchsets_df = pandas.concat(self.patchsets, ignore_index = True)
+        yield scr_reviews_extended (self.reviews_df, opened_df, closed_df,
+                                    patchsets_df, self.persons_df,
+                                    self.retrieval_date, self.dashboard)
+
+def scr_reviews_extended (reviews_df, opened_df, closed_df, patchsets_df,
+                          persons_df, retrieval_date, dashboard):
+    """Produce extended reviews dataframe, with timing and persons info.
+
+    """
+
+    logging.debug("Merging into extended reviews dataframe.")
+    extended_df = scr_reviews_timing (reviews_df, opened_df, closed_df,
+                                      patchsets_df, retrieval_date)
+    extended_df = pandas.merge (extended_df, persons_df, on="uuid", how="left")
+    extended_df["dashboard"] = constant_column(dashboard, len(extended_df.index))
+
+    logging.info("Reviews with extended info: " + str(len(extended_df.index)))
+    logging.debug("extended_df with NaN: " \
+                  + str(extended_df[extended_df.isnull().any(axis=1)]))
+    return extended_df
+
+def scr_events_extended (events_df, persons_events_df, reviews_df, dashboard):
+    """Produce extended events dataframe, with persons and reviews info.
+
+    """
+
+    events_extended_df = pandas.merge (events_df, persons_events_df,
+                                       on="uuid", how="left")
+    events_extended_df = pandas.merge (events_extended_df, reviews_df,
+                                       on="review", how="left")
+    events_extended_df["dashboard"] = constant_column(dashboard,
+                                                      len(events_extended_df.index))
+    logging.info("Events with extended info: " \
+                 + str(len(events_extended_df.index)))
+    logging.info("events_extended_df with NaN (will be dropped): " \
+                  + str(events_extended_df[events_extended_df.isnull().any(axis=1)]))
+    return events_extended_df.dropna()
+
+def analyze_scr (db, output, elasticsearch, dateformat, dashboard,
+                 chunksize = 0, incremental = None, fields = None):
+    """Analyze SCR database.
+
+    Timing, patchsets and events for reviews are all computed from a
+    single retrieval of the changes table. If chunksize is specified, and
+    no files are to be produced, changes (the largest data) are retrieved
+    in chunks of that many rows, when they are uploaded. In that case,
+    events are uploaded before reviews.
+
+    If incremental is specified (a directory), only changes after the
+    last one retrieved in the previous run are retrieved, and merged
+    with those retrieved before (see IncrementalState). Reviews, which
+    Bicho may update in place, are still retrieved in full. If Bicho
+    retrieved data again since the previous run (trackers.retrieved_on
+    moved), all changes of reviews with new changes are retrieved
+    again, replacing those saved, since Bicho may have rewritten them.
+    Changes rewritten in place for reviews with no new changes are
+    not noticed, though.
+
+    If fields is specified, only those fields are produced in reviews
+    and events uploaded to ElasticSearch (see document_fields). If no
+    files are produced, only columns of reviews needed for them are
+    retrieved.
+
+    """
+
+    logging.debug("Starting SCR analysis")
+    retrieval_date = query_review_retrieval(db)
+    logging.info("Retrieval date: " + retrieval_date.isoformat())
+    db.fingerprint = retrieval_date.isoformat()
+    if db.cache:
+        # Reviews and changes include uuids, which change with
+        # people_uidentities
+        db.fingerprint = repr((db.fingerprint, people_fingerprint(db)))
+
+    # Changes (for timing, patchsets and events), in chunks if possible
+    if chunksize and output:
+        logging.info("Producing files, changes will not be retrieved in chunks.")
+    stream_changes = chunksize and not output
+    # Fields of reviews and events to upload, and columns needed for them
+    if elasticsearch:
+        review_fields = document_fields(scr_mapping_review, fields)
+        event_fields = document_fields(scr_mapping_event, fields)
+    else:
+        review_fields = []
+        event_fields = []
+    if output:
+        columns = None
+    else:
+        columns = set(scr_reviews_required) | set(review_fields)
+    state = None
+    sql_changes = sql_reviews_changes()
+    if incremental:
+        state = IncrementalState(incremental,
+                                 incremental_name(db, "scr", dashboard))
+        if stream_changes:
+            logging.info("Incremental extraction, changes will not be " \
+                         + "retrieved in chunks.")
+            stream_changes = False
+        last_change = db.execute(sql_scr_watermark)[0][0][0]
+        # Reviews with new changes may have been rewritten by Bicho
+        # if it retrieved data again
+        retrieved = state.watermark("trackers.retrieved_on")
+        rewritten = retrieved is not None \
+                    and retrieved != retrieval_date.isoformat()
+        if rewritten:
+            logging.info("Data retrieved again since " + retrieved \
+                         + ", retrieving all changes of reviews " \
+                         + "with new changes.")
+        sql_changes = sql_reviews_changes((state.watermark("changes.id"),
+                                           last_change),
+                                          reviews = rewritten)
+    queries = [
+        dict(query = sql_reviews(columns), name = "Reviews",
+             schema = scr_schema),
+        dict(query = sql_reviews_extra(columns), name = "Reviews (extra)",
+             schema = scr_schema)
+        ]
+    if not stream_changes:
+        queries.append(dict(query = sql_changes,
+                            name = "Changes in reviews",
+                            schema = scr_schema,
+                            cache = state is None))
+    results = db.execute_dfs(queries)
+    if state:
+        saved_df = state.frame("changes")
+        if rewritten and saved_df is not None:
+            saved_df = saved_df[~saved_df["issue_id"] \
+                                .isin(results[2]["issue_id"].unique())]
+        changes_df = increment_merge(saved_df, results[2], "id")
+        changes_df = apply_schema(changes_df.sort_values("issue_id",
+                                                         kind = "mergesort")
+                                  .reset_index(drop = True), scr_schema)
+        state.save({"changes": changes_df},
+                   {"changes.id": last_change,
+                    "trackers.retrieved_on": retrieval_date.isoformat()})
+        results[2] = people_remap(db, changes_df, "changed_by", "uuid")
+    (reviews_df, extra_df) = results[:2]
+    reviews_df = pandas.merge (reviews_df, extra_df, on="id", how="left")
+    # Submitters and actors in events are resolved with the identity index
+    persons_df = identity_index(db).persons()
+    persons_events_df = persons_df
+
+    es_data = OrderedDict()
+    if stream_changes:
+        changes = ReviewChanges (
+            chunks = db.execute_chunks(sql_changes,
+                                       "Changes in reviews",
+                                       chunksize, schema = scr_schema),
+            reviews_df = reviews_df, persons_df = persons_df,
+            persons_events_df = persons_events_df,
+            retrieval_date = retrieval_date, dashboard = dashboard)
+        if elasticsearch:
+            # Events first, since reviews need all changes processed
+            es_data['event'] = {'df': (events_df[event_fields] for
+                                       events_df in changes.events()),
+                                'id': 'id', 'mapping': scr_mapping_event}
+            es_data['review'] = {'df': (reviews_df[review_fields] for
+                                        reviews_df in changes.reviews()),
+                                 'id': 'id', 'mapping': scr_mapping_review}
+        return es_data
+
+    (opened_df, closed_df, patchsets_df, events_df) = \
+        scr_changes_summary (results[2])
+    extended_df = scr_reviews_extended (reviews_df, opened_df, closed_df,
+                                        patchsets_df, persons_df,
+                                        retrieval_date, dashboard)
+    events_extended_df = scr_events_extended (
+        events_df, persons_events_df,
+        extended_df[scr_events_reviews_columns], dashboard)
+    if output:
+        logging.info("Producing JSON files in directory: " + output)
+        prefix = join (output, "scr-")
+        report = OrderedDict()
+        report[prefix + 'reviews.json'] = extended_df
+        create_report (report_files = report, destdir = './',
+                       dateformat = dateformat)
+
+    if elasticsearch:
+        es_data['review'] = {'df': extended_df[review_fields], 'id': 'id',
+                             'mapping': scr_mapping_review}
+        es_data['event'] = {'df': events_extended_df[event_fields],
+                            'id': 'id', 'mapping': scr_mapping_event}
+    return es_data
+
+# Types for columns obtained from the SCM database (see apply_schema)
+scm_schema = {"id": "int64", "repo_id": "int64", "tz": "int8",
+              "tz_orig": "int32", "added": "int64", "removed": "int64",
+              "date": "datetime", "commit_date": "datetime",
+              "utc_author": "datetime", "utc_commit": "datetime",
+              "org_name": "category", "branch_name": "category",
+              "project_name": "category"}
+
+# SQL expressions for the columns that can be selected for commits
+sql_commits_columns = OrderedDict([
+    ("id", "scmlog.id"),
+    ("date", "scmlog.author_date"),
+    ("commit_date", "scmlog.date"),
+    ("author_id", "scmlog.author_id"),
+    ("author_uuid", "people_uidentities.uuid"),
+    ("repo_id", "scmlog.repository_id"),
+    ("message", "LEFT(LTRIM(scmlog.message), 30)"),
+    ("hash", "scmlog.rev"),
+    ("tz", "(((scmlog.author_date_tz DIV 3600) + 36) % 24) - 12"),
+    ("tz_orig", "scmlog.author_date_tz"),
+    ("utc_author",
+     "DATE_SUB(scmlog.author_date, INTERVAL scmlog.author_date_tz SECOND)"),
+    ("utc_commit", "DATE_SUB(scmlog.date, INTERVAL scmlog.date_tz SECOND)"),
+    ("branch_name", "branches.name")
+    ])
+
+def sql_commits (allbranches, since, repos = None, ids = None,
+                 staging = False, columns = None):
+    """Produce SQL query to select commits.
+
+    Branches are joined only if needed for the columns, or for selecting
+    commits in master. Otherwise, only commits with some action are
+    selected, as the join would do, but without its fan-out.
+
+    :param repos: range of repository ids to select (first, last),
+        or None for all of them
+    :type repos: tuple of int
+    :param ids: range of commit ids to select (after, last), after
+        being excluded, and None for no limit, or None for all of them
+    :type ids: tuple of int
+    :param staging: use branches from staging tables (see sql_scm_staging)
+    :type staging: bool
+    :param columns: names of columns to select (see sql_commits_columns),
+        or None for all of them
+    :type columns: collection of str
+
+    """
+
+    sql = "SELECT " + sql_select(sql_commits_columns, columns) + """
+FROM {main_db}.scmlog
   JOIN {main_db}.people_uidentities
     ON people_uidentities.people_id = scmlog.author_id
-  JOIN {sh_db}.uidentities
-    ON uidentities.uuid = people_uidentities.uuid
-  LEFT JOIN {sh_db}.profiles
-    ON uidentities.uuid = profiles.uuid
-  JOIN {main_db}.actions
-    ON scmlog.id = actions.commit_id
 """
-    where = False
+    conditions = []
+    if staging or (not allbranches) \
+            or columns is None or "branch_name" in columns:
+        sql = sql + sql_scm_branches(staging)
+    else:
+        conditions.append("EXISTS (SELECT 1 FROM {main_db}.actions " \
+                          + "WHERE actions.commit_id = scmlog.id)")
     if not allbranches:
-        sql = sql + """JOIN {main_db}.branches
-    ON branches.id = actions.branch_id
-WHERE branches.name IN ("master")
-"""
-        where = True
+        conditions.append(sql_scm_master(staging))
     if since:
-        if where:
-            sql = sql + 'AND scmlog.author_date >= "' + since + '" '
-        else:
-            sql = sql + 'WHERE scmlog.author_date >= "' + since + '" '
-    sql = sql + "GROUP BY uidentities.uuid"
+        conditions.append('scmlog.author_date >= "' + since + '"')
+    if repos:
+        conditions.append("scmlog.repository_id BETWEEN %d AND %d" % repos)
+    conditions.extend(sql_ids_conditions("scmlog.id", ids))
+    if conditions:
+        sql = sql + "WHERE " + " AND ".join(conditions) + "\n"
+    sql = sql + "GROUP BY scmlog.rev ORDER BY scmlog.author_date\n"
     return sql
 
-def sql_commits (allbranches, since):
-    """Produce SQL query to select commits."""
+def sql_scm_branches (staging):
+    """Produce SQL joins for the branches of commits (in scmlog).
 
-    sql = """SELECT scmlog.id AS id,
-  scmlog.author_date AS date,
-  scmlog.date AS commit_date,
-  uidentities.uuid AS author_uuid,
-  profiles.name AS name,
-  enrollments.organization_id AS org_id,
-  scmlog.repository_id AS repo_id,
-  LEFT(LTRIM(scmlog.message), 30) as message,
-  scmlog.rev as hash,
-  (((scmlog.author_date_tz DIV 3600) + 36) % 24) - 12 AS tz,
-  scmlog.author_date_tz AS tz_orig,
-  DATE_SUB(scmlog.author_date, INTERVAL scmlog.author_date_tz SECOND)
-    AS utc_author,
-  DATE_SUB(scmlog.date, INTERVAL scmlog.date_tz SECOND) AS utc_commit,
-  organizations.name AS org_name,
-  branches.name AS branch_name
-FROM {main_db}.scmlog
-  JOIN {main_db}.people_uidentities
-    ON people_uidentities.people_id = scmlog.author_id
-  JOIN {sh_db}.uidentities
-    ON uidentities.uuid = people_uidentities.uuid
-  LEFT JOIN {sh_db}.enrollments
-    ON uidentities.uuid = enrollments.uuid
-  LEFT JOIN {sh_db}.organizations
-    ON enrollments.organization_id = organizations.id
-  LEFT JOIN {sh_db}.profiles
-    ON uidentities.uuid = profiles.uuid
-  JOIN {main_db}.actions
+    With staging tables, a single row (branch) per commit is joined.
+    Otherwise, a row per action (file) and branch is joined, to be
+    collapsed by grouping.
+
+    """
+
+    if staging:
+        return """  JOIN {staging_db}.`{main_db}_commits_branches` branches
+    ON scmlog.id = branches.commit_id
+"""
+    return """  JOIN {main_db}.actions
     ON scmlog.id = actions.commit_id
   JOIN {main_db}.branches
     ON branches.id = actions.branch_id
 """
-    if allbranches:
-        sql = sql + "WHERE "
-    else:
-        sql = sql + 'WHERE branches.name IN ("master") AND '
+
+def sql_scm_master (staging):
+    """Produce SQL condition for commits landed in master.
+
+    """
+
+    if staging:
+        return "branches.in_master = 1"
+    return 'branches.name IN ("master")'
+
+def sql_scm_staging (since, ids = None):
+    """Produce SQL statements to build staging tables for commits.
+
+    Tables are built in the staging database schema, with names
+    prefixed by the main database name, replacing previous ones.
+    They have a row per commit (selected by since and ids), with:
+
+    * commits_branches: whether it landed in master, and its branch
+      (master, if it landed there, or the first branch by name)
+    * commits_lines: lines added and removed, and whether it landed
+      in master
+
+    so that the fan-out of joining actions (a row per file changed)
+    is paid only once per run, when building them.
+
+    :param ids: range of commit ids to select (see sql_commits)
+    :type ids: tuple of int
+    :returns: SQL statements, to run in order
+    :rtype: list of str
+
+    """
+
+    conditions = []
     if since:
-        sql = sql + 'scmlog.author_date >= "' + since + '" AND '
-    sql = sql + \
-"""        (enrollments.start IS NULL OR
-    (scmlog.date > enrollments.start AND scmlog.date < enrollments.end))
-GROUP BY scmlog.rev ORDER BY scmlog.author_date
-"""
-    return sql
+        conditions.append('scmlog.author_date >= "' + since + '"')
+    conditions.extend(sql_ids_conditions("scmlog.id", ids))
+    selection = ""
+    if conditions:
+        selection = """  JOIN {main_db}.scmlog
+    ON scmlog.id = actions.commit_id
+WHERE """ + " AND ".join(conditions) + "\n"
+    return [
+        "DROP TABLE IF EXISTS {staging_db}.`{main_db}_commits_lines`",
+        "DROP TABLE IF EXISTS {staging_db}.`{main_db}_commits_branches`",
+        """CREATE TABLE {staging_db}.`{main_db}_commits_branches`
+  (PRIMARY KEY (commit_id))
+SELECT actions.commit_id AS commit_id,
+  MAX(branches.name = "master") AS in_master,
+  IF(MAX(branches.name = "master"), "master", MIN(branches.name))
+    AS name
+FROM {main_db}.actions
+  JOIN {main_db}.branches
+    ON branches.id = actions.branch_id
+""" + selection + "GROUP BY actions.commit_id",
+        """CREATE TABLE {staging_db}.`{main_db}_commits_lines`
+  (PRIMARY KEY (commit_id))
+SELECT commits_lines.commit_id AS commit_id,
+  MAX(commits_lines.added) AS added,
+  MAX(commits_lines.removed) AS removed,
+  MAX(branches.in_master) AS in_master
+FROM {main_db}.commits_lines
+  JOIN {staging_db}.`{main_db}_commits_branches` branches
+    ON commits_lines.commit_id = branches.commit_id
+GROUP BY commits_lines.commit_id"""
+        ]
+
+# Table in the staging schema with the state staging tables were built for
+sql_scm_staging_state = "SELECT state FROM {staging_db}.`{main_db}_staging`"
 
-def sql_lines (allbranches, since):
+def scm_staging (db, since, ids = None):
+    """Build staging tables for commits (see sql_scm_staging).
+
+    Tables are not built again if they were built for the same
+    SCM fingerprint (see sql_scm_fingerprint), since and ids, which
+    are recorded with them in the staging schema.
+
+    """
+
+    state = repr((db.fingerprint, since, ids))
+    try:
+        (rows, fields) = db.execute(sql_scm_staging_state)
+    except _mysql_exceptions.ProgrammingError, e:
+        if e[0] != 1146:
+            raise
+        rows = []
+    if db.fingerprint and [row[0] for row in rows] == [state]:
+        logging.info("Staging tables in " + db.stagingdb + " are up to date.")
+        return
+    logging.info("Building staging tables in " + db.stagingdb + ".")
+    db.execute("DROP TABLE IF EXISTS {staging_db}.`{main_db}_staging`")
+    for sql in sql_scm_staging(since, ids):
+        db.execute(sql)
+    db.execute("CREATE TABLE {staging_db}.`{main_db}_staging`\n" \
+               + 'SELECT "' + state + '" AS state')
+
+def sql_select (expressions, columns = None):
+    """Produce the list of columns to select in an SQL query.
+
+    :param expressions: SQL expressions for all columns that can be
+        selected, by name, in order
+    :type expressions: OrderedDict
+    :param columns: names of the columns to select, or None for all
+    :type columns: collection of str
+    :returns: SQL list of columns
+    :rtype: str
+
+    """
+
+    return ",\n  ".join(expression + " AS " + name
+                        for (name, expression) in expressions.iteritems()
+                        if columns is None or name in columns)
+
+def sql_ids_conditions (column, ids):
+    """Produce SQL conditions for selecting a range of ids.
+
+    :param column: column with the ids
+    :type column: str
+    :param ids: range of ids (after, last), after being excluded,
+        and None for no limit, or None for all of them
+    :type ids: tuple of int
+    :returns: conditions
+    :rtype: list of str
+
+    """
+
+    conditions = []
+    if ids:
+        (after, last) = ids
+        if after is not None:
+            conditions.append(column + " > " + str(int(after)))
+        if last is not None:
+            conditions.append(column + " <= " + str(int(last)))
+    return conditions
+
+def sql_lines (allbranches, since, ids = None, staging = False):
     """Produce SQL query to select lines per commit.
 
+    :param ids: range of commit ids to select (see sql_commits)
+    :type ids: tuple of int
+    :param staging: use staging tables (see sql_scm_staging)
+    :type staging: bool
+
     """
 
+    if staging:
+        sql = """SELECT commits_lines.commit_id AS id,
+  commits_lines.added AS added,
+  commits_lines.removed AS removed
+FROM {staging_db}.`{main_db}_commits_lines` commits_lines
+  JOIN {main_db}.scmlog
+    ON commits_lines.commit_id = scmlog.id
+"""
+        conditions = []
+        if not allbranches:
+            conditions.append("commits_lines.in_master = 1")
+        if since:
+            conditions.append('scmlog.author_date >= "' + since + '"')
+        conditions.extend(sql_ids_conditions("scmlog.id", ids))
+        if conditions:
+            sql = sql + "WHERE " + " AND ".join(conditions) + "\n"
+        sql = sql + "GROUP BY scmlog.rev ORDER BY scmlog.author_date"
+        return sql
+
     sql = """SELECT commits_lines.commit_id AS id,
   commits_lines.added AS added,
   commits_lines.removed AS removed
@@ -868,37 +3727,18 @@ FROM {main_db}.commits_lines
   JOIN {main_db}.branches
     ON branches.id = actions.branch_id
 """
-    if (not allbranches) or since:
-        sql = sql + "WHERE "
+    conditions = []
     if not allbranches:
-        sql = sql + 'WHERE branches.name IN ("master") '
-    if (not allbranches) and since:
-        sql = sql + "AND "
+        conditions.append('branches.name IN ("master")')
     if since:
-        sql = sql + 'scmlog.author_date >= "' + since + '" '
+        conditions.append('scmlog.author_date >= "' + since + '"')
+    conditions.extend(sql_ids_conditions("scmlog.id", ids))
+    if conditions:
+        sql = sql + "WHERE " + " AND ".join(conditions) + "\n"
     sql = sql + "GROUP BY scmlog.rev ORDER BY scmlog.author_date"
     return sql
 
 # Query to select organizations
-sql_commits_orgs = """SELECT enrollments.organization_id AS org_id,
-  {sh_db}.organizations.name AS org_name
-FROM {main_db}.scmlog
-  JOIN {main_db}.people_uidentities
-    ON people_uidentities.people_id = scmlog.author_id
-  JOIN {sh_db}.uidentities
-    ON uidentities.uuid = people_uidentities.uuid
-  JOIN {sh_db}.enrollments
-    ON uidentities.uuid = enrollments.uuid
-  JOIN {sh_db}.organizations
-    ON enrollments.organization_id = organizations.id
-  JOIN {main_db}.actions
-    ON scmlog.id = actions.commit_id
-  JOIN {main_db}.branches
-    ON branches.id = actions.branch_id
-WHERE enrollments.start IS NULL OR
-  (scmlog.date > enrollments.start AND scmlog.date < enrollments.end)
-GROUP BY org_id"""
-
 #  ORDER BY repo_id should not be needed, but there are some double
 #  entries in project_repositories table, at least in OpenStack, which
 #  cause dupped entries for repositories.
@@ -922,10 +3762,301 @@ sql_commits_repos_noproj = """SELECT repositories.id AS repo_id,
 FROM {main_db}.repositories
 ORDER BY repo_id"""
 
+# Fingerprint of SCM data: last commit and repository
+sql_scm_fingerprint = """SELECT (SELECT MAX(id) FROM {main_db}.scmlog),
+  (SELECT MAX(id) FROM {main_db}.repositories)
+"""
+
+def scm_commits_prepare (commits_df, identities, dashboard):
+    """Complete commits dataframe, as obtained from the database.
+
+    Authors are resolved with the identity index: commits by authors
+    not in it are dropped, and names and organizations are added.
+    Commits by authors not enrolled in any organization at the time
+    of the commit are assigned to organization 0 ("Unknown").
+
+    """
+
+    persons = identities.person_codes(commits_df["author_uuid"])
+    known = persons >= 0
+    commits_df = commits_df[known].reset_index(drop = True)
+    commits_df["name"] = identities.persons_df["name"].values[persons[known]]
+    commits_df = identities.affiliate (commits_df, "author_uuid", "commit_date")
+    commits_df["org_id"].fillna(0, inplace=True)
+    # None (NaN) is treated as float, making all the column float, convert to int
+    commits_df["org_id"] = commits_df["org_id"].astype("int")
+    commits_df["org_name"] = fillna_category(commits_df["org_name"], "Unknown")
+    commits_df["author_name"] = commits_df["name"]
+    commits_df["name"] = commits_df["name"] + " (" \
+        + commits_df["org_name"].astype(object) + ")"
+    commits_df["dashboard"] = constant_column(dashboard, len(commits_df.index))
+    return commits_df
+
+def scm_partition_init ():
+    """Initialize a worker process for extracting commits in partitions.
+
+    Connections inherited from the parent process cannot be used, so new
+    pools are started. Inherited pools are kept referenced, so that their
+    connections are never closed (which would close them for the parent
+    too), since workers end without garbage collection. The identity
+    indexes inherited are still valid, and are used.
+
+    """
+
+    global db_pools_inherited
+    db_pools_inherited = dict(db_pools)
+    db_pools.clear()
+
+def scm_partition (task):
+    """Extract and prepare commits for a partition, in a worker process.
+
+    :param task: parameters for Database, fingerprint, allbranches, since,
+        range of repository ids, dashboard name, and columns to select
+    :type task: tuple
+    :returns: prepared commits (see scm_commits_prepare)
+    :rtype: pandas.dataframe
+
+    """
+
+    (params, fingerprint, allbranches, since, repos, dashboard, columns) = task
+    db = Database (**params)
+    db.fingerprint = fingerprint
+    commits_df = db.execute_df(sql_commits(allbranches, since, repos,
+                                           staging = bool(db.stagingdb),
+                                           columns = columns),
+                               "Commits (repositories %d to %d)" % repos,
+                               schema = scm_schema)
+    return scm_commits_prepare (commits_df, identity_index(db), dashboard)
+
+def scm_commits_partitioned (db, allbranches, since, repo_ids, dashboard,
+                             partitions, columns = None):
+    """Extract and prepare commits in partitions, using a process pool.
+
+    Repository ids are split in ranges with similar number of repositories,
+    and commits for each range are extracted and prepared in a worker
+    process. Results are merged in author date order. Since the same
+    commit (hash) can be in several repositories, only the first one
+    is kept, as the query for all repositories does.
+
+    Worker processes are forked, so no other thread should be running
+    (for example, uploading) when calling this (see Pipeline.wait).
+    Each worker opens its own connection, in addition to those limited
+    by the workers of the database pool.
+
+    :param db: database
+    :type db: Database
+    :param repo_ids: repository ids
+    :type repo_ids: iterable of int
+    :param partitions: number of partitions (and worker processes)
+    :type partitions: int
+    :param columns: columns to select (see sql_commits)
+    :type columns: collection of str
+    :returns: prepared commits (see scm_commits_prepare)
+    :rtype: pandas.dataframe
+
+    """
+
+    # Load the identity index now, for workers to inherit it
+    identity_index(db)
+    params = dict(user = db.user, passwd = db.passwd,
+                  host = db.host, port = db.port,
+                  maindb = db.maindb, shdb = db.shdb, prjdb = db.prjdb,
+                  workers = 1, cache = db.cache,
+                  stagingdb = db.stagingdb)
+    tasks = [(params, db.fingerprint, allbranches, since,
+              (int(ids[0]), int(ids[-1])), dashboard, columns)
+             for ids in numpy.array_split(numpy.unique(repo_ids), partitions)
+             if len(ids)]
+    logging.info("Extracting commits in " + str(len(tasks)) + " partitions.")
+    pool = multiprocessing.Pool(processes = len(tasks),
+                                initializer = scm_partition_init)
+    try:
+        results = pool.map(scm_partition, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    commits_df = pandas.concat(results, ignore_index = True)
+    commits_df = commits_df.sort_values("date", kind = "mergesort")
+    commits_df = commits_df.drop_duplicates("hash").reset_index(drop = True)
+    logging.info("Commits: " + str(len(commits_df.index)))
+    return commits_df
+
+def scm_commits_persons_orgs (commits_df, identities):
+    """Produce persons and organizations authoring commits.
+
+    Persons are ordered by uuid, and get as id their position in that
+    order. Organizations are ordered by org_id, after "Unknown" (0),
+    which is always included.
+
+    :param commits_df: commits (see scm_commits_prepare)
+    :type commits_df: pandas.dataframe
+    :param identities: identity index
+    :type identities: IdentityIndex
+    :returns: persons and organizations
+    :rtype: tuple of pandas.dataframe
+
+    """
+
+    uuids = pandas.unique(commits_df["author_uuid"])
+    persons_df = identities.persons(uuids)
+    persons_df["id"] = persons_df.index
+    logging.info("Persons (authoring commits): " + str(len(persons_df.index)))
+    org_ids = pandas.unique(commits_df["org_id"])
+    orgs_df = identities.orgs_df[identities.orgs_df["org_id"].isin(org_ids)]
+    orgs_df = pandas.concat([pandas.DataFrame({"org_id": [0],
+                                               "org_name": ["Unknown"]}),
+                             orgs_df], ignore_index = True)
+    logging.info("Organizations (authoring commits): " \
+                 + str(len(orgs_df.index)))
+    return (persons_df, orgs_df)
+
+def take_codes (values, codes):
+    """Gather values by integer codes (positions), -1 producing missing values.
+
+    Integer values are converted to float only if some are missing.
+
+    :param values: values to gather from
+    :type values: pandas.Series
+    :param codes: positions of the values to gather
+    :type codes: numpy.ndarray of int
+    :returns: gathered values
+    :rtype: numpy.ndarray or pandas.Categorical
+
+    """
+
+    values = values.values
+    if isinstance(values, pandas.Categorical):
+        return values.take(codes, allow_fill = True)
+    return pandas.api.extensions.take(values, codes, allow_fill = True)
+
+class ScmDimensions:
+    """Dimensions for completing commits: lines, repos, and persons.
+
+    Each dimension is indexed by its key (commit id, repo_id, uuid), so
+    that commits can be coded as positions in it, and its columns can be
+    gathered with take_codes, instead of merging dataframes.
+
+    """
+
+    def __init__ (self, lines_df, repos_df, persons_df):
+        """Init state.
+
+        :param lines_df: lines added and removed per commit
+        :type lines_df: pandas.dataframe
+        :param repos_df: repositories, with their projects
+        :type repos_df: pandas.dataframe
+        :param persons_df: persons authoring commits
+        :type persons_df: pandas.dataframe
+
+        """
+
+        self.lines_df = lines_df.drop_duplicates("id")
+        self.lines = pandas.Index(self.lines_df["id"])
+        self.repos_df = repos_df
+        self.repos = pandas.Index(repos_df["repo_id"])
+        self.persons_df = persons_df
+        self.persons = pandas.Index(persons_df["uuid"])
+
+    def codes (self, commits_df):
+        """Code commits as positions in lines, repos and persons.
+
+        :returns: codes for lines, repos, and persons (-1 if not found)
+        :rtype: tuple of numpy.ndarray
+
+        """
+
+        return (self.lines.get_indexer(commits_df["id"]),
+                self.repos.get_indexer(commits_df["repo_id"]),
+                self.persons.get_indexer(commits_df["author_uuid"]))
+
+# Columns of commits (see sql_commits_columns) always needed,
+# for preparing and completing them
+scm_commits_required = ["id", "date", "commit_date", "author_uuid", "repo_id"]
+# Columns of commits needed only for fields of comprehensive commits
+# with the same name
+scm_commits_optional = ["message", "hash", "tz", "utc_author", "utc_commit",
+                        "branch_name"]
+# Columns of commits needed for producing files
+scm_commits_files = ["tz", "message", "hash"]
+
+def scm_commits_comprehensive (commits_df, dimensions, fields = None):
+    """Produce comprehensive commits dataframe, to upload to ElasticSearch.
+
+    :param commits_df: commits (see scm_commits_prepare)
+    :type commits_df: pandas.dataframe
+    :param dimensions: dimensions to complete commits
+    :type dimensions: ScmDimensions
+    :param fields: fields to produce (see document_fields), or None
+        for all of them
+    :type fields: list of str
+
+    """
+
+    if fields is None:
+        fields = mapping_fields(scm_mapping_commit)
+    (lines, repos, persons) = dimensions.codes(commits_df)
+    gathered = {'bot': (dimensions.persons_df, persons),
+                'added': (dimensions.lines_df, lines),
+                'removed': (dimensions.lines_df, lines),
+                'repo_name': (dimensions.repos_df, repos),
+                'project_id': (dimensions.repos_df, repos),
+                'project_name': (dimensions.repos_df, repos)}
+    columns = OrderedDict()
+    for name in fields:
+        if name in gathered:
+            (df, codes) = gathered[name]
+            columns[name] = take_codes(df[name], codes)
+        elif name == 'author_date':
+            columns[name] = commits_df['date'].values
+        else:
+            columns[name] = commits_df[name].values
+    return pandas.DataFrame(columns)
+
+def scm_commits_packed (commits_df, dimensions):
+    """Produce packed (minimal) commits dataframe, for scm-commits.json.
+
+    Authors are the ids of persons in the persons dimension.
+
+    """
+
+    (lines, repos, persons) = dimensions.codes(commits_df)
+    columns = OrderedDict()
+    columns['id'] = commits_df['id'].values
+    columns['date'] = commits_df['date'].values
+    columns['author'] = take_codes(dimensions.persons_df['id'], persons)
+    columns['org'] = commits_df['org_id'].values
+    columns['repo'] = commits_df['repo_id'].values
+    columns['tz'] = commits_df['tz'].values
+    return pandas.DataFrame(columns)
+
 def analyze_scm (db, allbranches, since, output, elasticsearch,
-                 dateformat, dashboard):
+                 dateformat, dashboard, chunksize = 0, partitions = 1,
+                 incremental = None, fields = None, pipeline = None):
     """Analyze SCM database.
 
+    If chunksize is specified, and no files are to be produced, commits
+    (the largest data) are retrieved and completed in chunks of that many
+    rows, when they are uploaded.
+
+    If partitions is more than one, commits are instead extracted and
+    prepared in that many worker processes, each for a range of
+    repositories (see scm_commits_partitioned). Jobs in pipeline, if
+    any, are waited for before starting them.
+
+    If the database has a staging schema, staging tables with the
+    branches and lines of commits are built first, unless they are
+    up to date (see scm_staging), and commits and lines are retrieved
+    from them.
+
+    If incremental is specified (a directory), only commits after the
+    last one retrieved in the previous run are retrieved, and merged
+    with those retrieved before (see IncrementalState). Authors are
+    always resolved again, since identities may have changed.
+
+    If fields is specified, only those fields are produced in commits
+    uploaded to ElasticSearch (see document_fields), and only columns
+    and joins needed for them, and for files, are retrieved.
+
     """
 
     if allbranches:
@@ -939,27 +4070,9 @@ def analyze_scm (db, allbranches, since, output, elasticsearch,
     else:
         logging.info("Analyzing since the first commit.")
 
-    # Lines per commit
-    lines_df = db.execute_df(sql_lines(allbranches, since),
-                               "Lines per commit")
-    # Commits
-    commits_df = db.execute_df(sql_commits(allbranches, since),
-                               "Commits")
-    commits_df["org_id"].fillna(0, inplace=True)
-    # None (NaN) is treated as float, making all the column float, convert to int
-    commits_df["org_id"] = commits_df["org_id"].astype("int")
-    commits_df["org_name"].fillna("Unknown", inplace=True)
-    commits_df["author_name"] = commits_df["name"]
-    commits_df["name"] = commits_df["name"] + " (" + commits_df["org_name"] + ")"
-    commits_df["dashboard"] = [dashboard] * len(commits_df.index)
-    # Persons
-    persons_df = db.execute_df(sql_commits_persons(allbranches, since),
-                               "Persons (authoring commits)")
-    persons_df["id"] = persons_df.index
-    # Organizations
-    orgs_df = db.execute_df(query = sql_commits_orgs,
-                            name = "Organizations (authoring commits)",
-                            other = [(0,"Unknown"),])
+    if db.cache or incremental or db.stagingdb:
+        fingerprint = db.execute(sql_scm_fingerprint)[0]
+        db.fingerprint = repr(tuple(fingerprint[0]))
     # Produce repos data, with or without projects, depending
     # on the availability of the projects table
     try:
@@ -972,27 +4085,125 @@ def analyze_scm (db, allbranches, since, output, elasticsearch,
             sql_repos = sql_commits_repos_noproj
         else:
             raise
-    repos_df = db.execute_df(sql_repos, "Projects (commits)")
+    # Commits (files need all of them at once)
+    if chunksize and output:
+        logging.info("Producing files, commits will not be retrieved in chunks.")
+    if chunksize and partitions > 1:
+        logging.info("Extracting in partitions, commits will not be " \
+                     + "retrieved in chunks.")
+    stream_commits = chunksize and not output and partitions <= 1
+    # Fields of commits to upload, and columns needed for them and files
+    if elasticsearch:
+        commit_fields = document_fields(scm_mapping_commit, fields)
+    else:
+        commit_fields = []
+    columns = set(scm_commits_required)
+    columns.update(set(scm_commits_optional) & set(commit_fields))
+    if output:
+        columns.update(scm_commits_files)
+    if incremental or partitions > 1:
+        # For merging increments or partitions
+        columns.add("hash")
+    if incremental:
+        columns.add("author_id")
+    columns = [column for column in sql_commits_columns if column in columns]
+    with_lines = "added" in commit_fields or "removed" in commit_fields
+    state = None
+    ids = None
+    if incremental:
+        state = IncrementalState(incremental,
+                                 incremental_name(db, "scm", dashboard,
+                                                  allbranches, since,
+                                                  columns, with_lines))
+        if stream_commits:
+            logging.info("Incremental extraction, commits will not be " \
+                         + "retrieved in chunks.")
+        if partitions > 1:
+            logging.info("Incremental extraction, commits will not be " \
+                         + "extracted in partitions.")
+        stream_commits = False
+        partitions = 1
+        last_commit = fingerprint[0][0]
+        ids = (state.watermark("scmlog.id"), last_commit)
+    staging = bool(db.stagingdb)
+    if staging:
+        scm_staging(db, since, ids)
+    if db.cache:
+        # Commits include uuids, which change with people_uidentities
+        db.fingerprint = repr((db.fingerprint, people_fingerprint(db)))
+    # Repos, and maybe lines per commit, and commits
+    queries = [
+        # Not cached: the fingerprint covers only the SCM database,
+        # not the projects database
+        dict(query = sql_repos, name = "Projects (commits)",
+             schema = scm_schema, cache = False)
+        ]
+    if with_lines:
+        queries.append(dict(query = sql_lines(allbranches, since, ids = ids,
+                                              staging = staging),
+                            name = "Lines per commit", schema = scm_schema,
+                            cache = state is None))
+    if not stream_commits and partitions <= 1:
+        queries.append(dict(query = sql_commits(allbranches, since, ids = ids,
+                                                staging = staging,
+                                                columns = columns),
+                            name = "Commits", schema = scm_schema,
+                            cache = state is None))
+    results = db.execute_dfs(queries)
+    repos_df = results.pop(0)
+    if with_lines:
+        lines_df = results.pop(0)
+    else:
+        lines_df = pandas.DataFrame({"id": [], "added": [], "removed": []})
+    if state:
+        lines_df = increment_merge(state.frame("lines"), lines_df, "id")
+        # Commits are unique by hash, as in the query (GROUP BY rev):
+        # the same commit may appear later, with a new id, in another
+        # repository, but the one saved is kept
+        commits_df = increment_merge(state.frame("commits"), results[0],
+                                     "hash", keep = "first")
+        commits_df = apply_schema(commits_df.sort_values("date",
+                                                         kind = "mergesort")
+                                  .reset_index(drop = True), scm_schema)
+        state.save({"lines": lines_df, "commits": commits_df},
+                   {"scmlog.id": last_commit})
+        results[0] = people_remap(db, commits_df, "author_id", "author_uuid")
+    # Persons and organizations are resolved with the identity index
+    identities = identity_index(db)
+    if stream_commits:
+        # Only needed for completing commits (bot flag)
+        persons_df = identities.persons()
+    else:
+        if partitions > 1:
+            if pipeline:
+                logging.info("Waiting for uploads before extracting " \
+                             + "in partitions.")
+                pipeline.wait()
+            commits_df = scm_commits_partitioned (db, allbranches, since,
+                                                  repos_df["repo_id"],
+                                                  dashboard, partitions,
+                                                  columns)
+        else:
+            commits_df = scm_commits_prepare (results[0], identities,
+                                              dashboard)
+        (persons_df, orgs_df) = scm_commits_persons_orgs (commits_df,
+                                                          identities)
     repos_df["project_id"].fillna(0, inplace=True)
     # None (NaN) is treated as float, making all the column float, convert to int
     repos_df["project_id"] = repos_df["project_id"].astype("int")
-    repos_df["project_name"].fillna("Unclassified", inplace=True)
+    repos_df["project_name"] = fillna_category(repos_df["project_name"],
+                                               "Unclassified")
     # Capitalizing could be a good idea, but not by default.
     # repos_df["repo_name"] = repos_df["repo_name"].str.capitalize()
     # repos_df["project_name"] = repos_df["project_name"].str.capitalize()
 
-    # Produce packed (minimal) commits dataframe
-    commits_pkd_df = pandas.merge (commits_df, persons_df,
-                                   left_on="author_uuid", right_on="uuid",
-                                   how="left")
-    commits_pkd_df = commits_pkd_df[["id_x", "date", "id_y", "org_id",
-                                     "repo_id", "tz"]]
-    commits_pkd_df.columns = ["id", "date", "author", "org", "repo", "tz"]
-    # Produce messages and hashes dataframe for commits
-    commits_messages_df = commits_df[["id", "message", "hash"]]
-
+    dimensions = ScmDimensions (lines_df, repos_df, persons_df)
     es_data = {}
     if output:
+        # Produce packed (minimal) commits dataframe
+        commits_pkd_df = scm_commits_packed (commits_df, dimensions)
+        # Produce messages and hashes dataframe for commits
+        commits_messages_df = commits_df[["id", "message", "hash"]]
         logging.info("Producing JSON files in directory: " + output)
         prefix = join (output, "scm-")
         report = OrderedDict()
@@ -1006,31 +4217,22 @@ def analyze_scm (db, allbranches, since, output, elasticsearch,
                        dateformat = dateformat)
 
     if elasticsearch:
-        (esurl, esindex) = elasticsearch
         # Produce comprehensive commits dataframe
-        commits_comp_df = pandas.merge (commits_df, lines_df,
-                                        left_on="id", right_on="id",
-                                        how="left")
-        commits_comp_df = pandas.merge (commits_comp_df, repos_df,
-                                        left_on="repo_id", right_on="repo_id",
-                                        how="left")
-        commits_comp_df = pandas.merge (commits_comp_df, persons_df,
-                                        left_on="author_uuid", right_on="uuid",
-                                        how="left")
-        commits_comp_df = \
-            commits_comp_df [['id_x', 'date', 'commit_date',
-                              'utc_author', 'utc_commit', 'message', 'hash', 'tz',
-                              'author_uuid', 'author_name', 'bot',
-                              'added', 'removed',
-                              'org_id', 'org_name', 'repo_id', 'repo_name',
-                              'project_id', 'project_name', 'branch_name', 'dashboard']]
-        commits_comp_df.columns = [['id', 'author_date', 'commit_date',
-                                    'utc_author', 'utc_commit',
-                                    'message', 'hash', 'tz',
-                                    'author_uuid', 'author_name', 'bot',
-                                    'added', 'removed',
-                                    'org_id', 'org_name', 'repo_id', 'repo_name',
-                                    'project_id', 'project_name', 'branch_name', 'dashboard']]
+        if stream_commits:
+            commits_comp_df = (
+                scm_commits_comprehensive (scm_commits_prepare (chunk,
+                                                                identities,
+                                                                dashboard),
+                                           dimensions, commit_fields)
+                for chunk in db.execute_chunks(sql_commits(allbranches, since,
+                                                           staging = staging,
+                                                           columns = columns),
+                                               "Commits", chunksize,
+                                               schema = scm_schema))
+        else:
+            commits_comp_df = scm_commits_comprehensive (commits_df,
+                                                         dimensions,
+                                                         commit_fields)
         es_data['repo'] = {'df': repos_df, 'id': 'repo_id',
                            'mapping': scm_mapping_repo}
         es_data['commit'] = {'df': commits_comp_df, 'id': 'id',
@@ -1041,12 +4243,33 @@ def process_all (user, passwd = "", host = "127.0.0.1", port = 3306,
                  scmdb = None, scrdb = None, shdb = None, prjdb = None,
                  allbranches = False, since = None,
                  output = "", elasticsearch = None, esauth = None,
-                 batchsize = 10000,
+                 batchsize = 10000, batchbytes = 0, upload_workers = 1,
+                 compression = 0, rebuild = False, syncstate = None,
+                 spooldir = None, pipeline = None, chunksize = 0,
+                 db_workers = 1, scm_partitions = 1,
+                 cachedir = None, cachesize = 2048, incremental = None,
+                 stagingdb = None, fields = None,
                  dateformat = "utime",
                  dashboard = "Dashboard",
                  deleteold = False, verbose = False, debug = False):
     """Process all databases found, and produce results in files or ElasticSearch.
 
+    If cachedir is specified, results of queries are cached there
+    (up to cachesize MB), and reused while the databases do not change.
+    If incremental is specified, commits and changes are retrieved
+    incrementally, keeping state there (see IncrementalState).
+    If stagingdb is specified, staging tables for commits are built in
+    that (scratch) database schema (see sql_scm_staging). If fields
+    is specified, only those fields are produced in documents uploaded
+    to ElasticSearch (see document_fields).
+
+    Uploads to ElasticSearch are run in a pipeline, so that SCM data is
+    uploaded while SCR data is being produced. If a pipeline is specified,
+    uploads are submitted to it, and may still be running when returning
+    (the caller should join the pipeline). Otherwise, a pipeline is
+    created, and joined before returning, also if producing data fails
+    (so that uploads already submitted are done, or spooled).
+
     """
 
     if debug:
@@ -1059,50 +4282,100 @@ def process_all (user, passwd = "", host = "127.0.0.1", port = 3306,
         logging.info("No projects database specified, using SCM database instead.")
         prjdb = scmdb
 
-    # Data to upload to ElasticSearch
-    es_data = {}
-    if scmdb:
-        logging.info("SCM database specified, analyzing it.")
-        db = Database (user = user, passwd = passwd,
-                       host = host, port = port,
-                       maindb = scmdb, shdb = shdb,
-                       prjdb = prjdb)
-        es_scm = analyze_scm(db = db,
-                             allbranches = allbranches,
-                             since = since,
-                             output = output,
-                             elasticsearch = elasticsearch,
-                             dateformat = dateformat,
-                             dashboard = dashboard)
-        for index, to_upload in es_scm.iteritems():
-            es_data[index] = to_upload
-    if scrdb:
-        logging.info("SCR database specified, analyzing it.")
-        db = Database (user = user, passwd = passwd,
-                       host = host, port = port,
-                       maindb = scrdb, shdb = shdb,
-                       prjdb = prjdb)
-        es_scr = analyze_scr(db = db,
-                             output = output,
-                             elasticsearch = elasticsearch,
-                             dateformat = dateformat,
-                             dashboard = dashboard)
-        for index, to_upload in es_scr.iteritems():
-            es_data[index] = to_upload
     if elasticsearch:
         (esurl, esindex) = elasticsearch
         logging.info("Feeding data to elasticsearch at: " + esurl + "/" + esindex)
-        upload_elasticsearch (url = esurl,
+        upload_name = " for " + dashboard + " to " + esindex
+        upload = IndexUpload (es = es_client(esurl, esauth),
                               index = esindex,
-                              data = es_data,
                               deleteold = deleteold,
-                              auth = esauth,
-                              batchsize = batchsize)
+                              batchsize = batchsize,
+                              batchbytes = batchbytes,
+                              workers = upload_workers,
+                              compression = compression,
+                              rebuild = rebuild,
+                              syncstate = syncstate,
+                              spooldir = spooldir)
+    if cachedir:
+        cache = ResultCache (cachedir, maxbytes = cachesize * 1024 ** 2)
+    else:
+        cache = None
+    if pipeline:
+        own_pipeline = False
+    else:
+        pipeline = Pipeline()
+        own_pipeline = True
+    try:
+        if scmdb:
+            logging.info("SCM database specified, analyzing it.")
+            db = Database (user = user, passwd = passwd,
+                           host = host, port = port,
+                           maindb = scmdb, shdb = shdb,
+                           prjdb = prjdb, workers = db_workers,
+                           cache = cache, stagingdb = stagingdb)
+            es_scm = analyze_scm(db = db,
+                                 allbranches = allbranches,
+                                 since = since,
+                                 output = output,
+                                 elasticsearch = elasticsearch,
+                                 dateformat = dateformat,
+                                 dashboard = dashboard,
+                                 chunksize = chunksize,
+                                 partitions = scm_partitions,
+                                 incremental = incremental,
+                                 fields = fields,
+                                 pipeline = pipeline)
+            if elasticsearch:
+                pipeline.submit(functools.partial(upload.upload, es_scm),
+                                "upload of SCM data" + upload_name)
+        if scrdb:
+            logging.info("SCR database specified, analyzing it.")
+            db = Database (user = user, passwd = passwd,
+                           host = host, port = port,
+                           maindb = scrdb, shdb = shdb,
+                           prjdb = prjdb, workers = db_workers,
+                           cache = cache)
+            es_scr = analyze_scr(db = db,
+                                 output = output,
+                                 elasticsearch = elasticsearch,
+                                 dateformat = dateformat,
+                                 dashboard = dashboard,
+                                 chunksize = chunksize,
+                                 incremental = incremental,
+                                 fields = fields)
+            if elasticsearch:
+                pipeline.submit(functools.partial(upload.upload, es_scr),
+                                "upload of SCR data" + upload_name)
+        if elasticsearch:
+            pipeline.submit(upload.finish, "finishing upload" + upload_name)
+    except Exception:
+        exc_info = sys.exc_info()
+        if elasticsearch and not pipeline.error:
+            pipeline.submit(upload.abort, "aborting upload" + upload_name)
+        if own_pipeline:
+            # Let uploads already submitted finish, before raising
+            pipeline.close()
+        raise exc_info[0], exc_info[1], exc_info[2]
+    if own_pipeline:
+        pipeline.join()
 
 if __name__ == "__main__":
 
     args = parse_args()
 
+    if args.resume:
+        if args.debug:
+            logging.basicConfig(level=logging.DEBUG)
+        elif args.verbose:
+            logging.basicConfig(level=logging.INFO)
+        resume_upload (es = es_client(args.elasticsearch[0], args.esauth),
+                       spooldir = args.spooldir,
+                       workers = args.uploadworkers,
+                       compression = args.compress)
+        sys.exit()
+
+    if args.cacheclear and args.cachedir:
+        ResultCache(args.cachedir).clear()
 
     process_all (
         user = args.user, passwd = args.passwd,
@@ -1117,6 +4390,20 @@ if __name__ == "__main__":
         elasticsearch = args.elasticsearch,
         esauth = args.esauth,
         batchsize = args.batchsize,
+        batchbytes = args.batchbytes,
+        upload_workers = args.uploadworkers,
+        db_workers = args.dbworkers,
+        scm_partitions = args.scmpartitions,
+        cachedir = None if args.nocache else args.cachedir,
+        cachesize = args.cachesize,
+        incremental = args.incremental,
+        stagingdb = args.stagingdb,
+        fields = args.fields.split(",") if args.fields else None,
+        compression = args.compress,
+        rebuild = args.rebuild,
+        syncstate = args.syncstate,
+        spooldir = args.spooldir,
+        chunksize = args.chunksize,
         dateformat = args.dateformat,
         dashboard = args.dashboard,
         deleteold = args.deleteold,
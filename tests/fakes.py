@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Fake servers and data, shared by tests
+
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+def bulk_lines (ids, index = "i", type = "t"):
+    """Bulk API lines for indexing a document for each id.
+
+    """
+
+    action = '{{ "index" : {{ "_index" : "{index}", "_type" : "{type}", ' \
+        + '"_id" : "{id}" }} }}\n'
+    return [(id, action.format(index = index, type = type, id = id) \
+             + json.dumps({"id": id}) + "\n")
+            for id in ids]
+
+class FakeElasticSearch:
+    """ElasticSearch client answering requests in memory.
+
+    Requests are recorded in requests, as (method, path, body) tuples.
+    Answers for some requests can be set in answers, by (method, path):
+    a str is the body of the answer, an int the code of an error (which
+    is raised), and a list, answers for successive requests. Requests
+    to the bulk API are answered as successful for all items, and
+    other requests as acknowledged, unless answers say otherwise.
+
+    """
+
+    url = "http://fake:9200"
+
+    def __init__ (self, answers = None):
+
+        self.answers = answers or {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def request (self, method, path, body = None, headers = {}):
+
+        with self.lock:
+            self.requests.append((method, path, body))
+            answer = self.answers.get((method, path))
+            if isinstance(answer, list):
+                answer = answer.pop(0) if answer else None
+        if isinstance(answer, int):
+            raise grimoireng_data.ElasticSearchError(method, self.url + path,
+                                                     answer, "")
+        if answer is not None:
+            return answer
+        if path.endswith("/_bulk"):
+            items = [{"index": {"status": 201}}
+                     for line in body.splitlines()
+                     if line.startswith('{ "index"')]
+            return json.dumps({"took": 1, "errors": False, "items": items})
+        if method == "GET":
+            raise grimoireng_data.ElasticSearchError(method, self.url + path,
+                                                     404, "")
+        return '{"acknowledged":true}'
+
+    def put (self, path, body = "", headers = {}):
+
+        return self.request("PUT", path, body, headers)
+
+    def get (self, path):
+
+        return self.request("GET", path)
+
+    def post (self, path, body = ""):
+
+        return self.request("POST", path, body)
+
+    def delete (self, path):
+
+        try:
+            return self.request("DELETE", path)
+        except grimoireng_data.ElasticSearchError:
+            return ""
+
+    def paths (self, method = None):
+        """Paths of requests done (with method, if specified).
+
+        """
+
+        return [path for (request_method, path, body) in self.requests
+                if method is None or request_method == method]
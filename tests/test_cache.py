@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for caching query results (no database needed)
+##   python -m unittest discover -s tests
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+class FakeDatabase (grimoireng_data.Database):
+    """Database answering queries with fixed results, counting them.
+
+    """
+
+    def __init__ (self, cache):
+
+        self.host = "localhost"
+        self.port = 3306
+        self.maindb = "scm"
+        self.shdb = "sh"
+        self.prjdb = "prj"
+        self.stagingdb = None
+        self.cache = cache
+        self.fingerprint = None
+        self.queries = []
+        self.checksum = 1
+
+    def execute (self, query):
+
+        self.queries.append(query)
+        if query.startswith("CHECKSUM TABLE"):
+            return ([("scm.people_uidentities", self.checksum)],
+                    ["Table", "Checksum"])
+        return ([(1, "u1"), (2, "u2")], ["id", "uuid"])
+
+class TestResultCache (unittest.TestCase):
+
+    def setUp (self):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown (self):
+
+        shutil.rmtree(self.directory)
+
+    def test_put_get (self):
+
+        cache = grimoireng_data.ResultCache(self.directory)
+        df = pandas.DataFrame({
+            "id": [1, 2, 3],
+            "name": [u"Jesús", None, "Bob"],
+            "added": [1.5, numpy.nan, 3.0],
+            "date": [datetime.datetime(2015, 1, 1), pandas.NaT,
+                     datetime.datetime(2016, 2, 1)]
+            })[["id", "name", "added", "date"]]
+        df["org"] = pandas.Categorical(["a", "b", "a"])
+        cache.put("key", df)
+        cached_df = cache.get("key")
+        self.assertEqual(list(cached_df.columns), list(df.columns))
+        for column in ["id", "added", "date", "org"]:
+            self.assertEqual(cached_df[column].dtype, df[column].dtype)
+        self.assertTrue(cached_df.equals(df))
+        self.assertEqual(cache.get("other"), None)
+
+    def test_evict (self):
+
+        cache = grimoireng_data.ResultCache(self.directory)
+        df = pandas.DataFrame({"id": range(1000)})
+        cache.put("old", df)
+        size = os.path.getsize(os.path.join(self.directory, "old.npz"))
+        # Least recently used
+        past = time.time() - 100
+        os.utime(os.path.join(self.directory, "old.npz"), (past, past))
+        cache.maxbytes = size * 3 // 2
+        cache.put("new", df)
+        self.assertEqual(cache.get("old"), None)
+        self.assertTrue(cache.get("new") is not None)
+
+    def test_evict_removed (self):
+
+        cache = grimoireng_data.ResultCache(self.directory, maxbytes = 0)
+        # Result removed by someone else while evicting: nothing raised
+        remove = cache._remove
+        def remove_twice (name):
+            remove(name)
+            remove(name)
+        cache._remove = remove_twice
+        cache.put("key", pandas.DataFrame({"id": [1]}))
+        self.assertEqual(cache.get("key"), None)
+
+    def test_clear (self):
+
+        cache = grimoireng_data.ResultCache(self.directory)
+        cache.put("key", pandas.DataFrame({"id": [1]}))
+        cache.clear()
+        self.assertEqual(cache.get("key"), None)
+
+class TestCachedQueries (unittest.TestCase):
+
+    def setUp (self):
+
+        self.directory = tempfile.mkdtemp()
+        self.db = FakeDatabase(grimoireng_data.ResultCache(self.directory))
+
+    def tearDown (self):
+
+        shutil.rmtree(self.directory)
+
+    def query (self, cache = True):
+
+        return self.db.execute_df("SELECT id, uuid FROM {main_db}.people",
+                                  "People", cache = cache)
+
+    def test_cached_while_fingerprint (self):
+
+        self.db.fingerprint = "(10L, 2L)"
+        self.query()
+        df = self.query()
+        self.assertEqual(len(self.db.queries), 1)
+        self.assertEqual(list(df["uuid"]), ["u1", "u2"])
+        self.query(cache = False)
+        self.assertEqual(len(self.db.queries), 2)
+
+    def test_not_cached_without_fingerprint (self):
+
+        self.query()
+        self.query()
+        self.assertEqual(len(self.db.queries), 2)
+
+    def test_invalidated_by_identities (self):
+
+        # As set by analyze_scm and analyze_scr
+        fingerprint = "(10L, 2L)"
+        people = grimoireng_data.people_fingerprint(self.db)
+        self.db.fingerprint = repr((fingerprint, people))
+        self.query()
+        self.query()
+        self.assertEqual(len(self.db.queries), 2)
+        # SortingHat rewrote people_uidentities
+        self.db.checksum = 2
+        people = grimoireng_data.people_fingerprint(self.db)
+        self.db.fingerprint = repr((fingerprint, people))
+        self.query()
+        self.assertEqual(len(self.db.queries), 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for the ElasticSearch client (no server needed)
+##   python -m unittest discover -s tests
+
+import httplib
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+class FakeResponse:
+
+    def __init__ (self, status, body, will_close = False):
+
+        self.status = status
+        self.body = body
+        self.will_close = will_close
+
+    def read (self):
+
+        return self.body
+
+class FakeConnection:
+    """HTTP connection answering from a list of answers for its requests.
+
+    An answer is a FakeResponse, or an exception to raise when getting
+    the response (eg, the server closed the connection while idle).
+
+    """
+
+    def __init__ (self, answers):
+
+        self.answers = answers
+        self.requests = []
+        self.closed = False
+
+    def request (self, method, path, body, headers):
+
+        self.requests.append((method, path, body, headers))
+
+    def getresponse (self):
+
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def close (self):
+
+        self.closed = True
+
+class TestElasticSearch (unittest.TestCase):
+
+    def client (self, connections, **options):
+        """Client opening connections with answers in connections.
+
+        """
+
+        es = grimoireng_data.ElasticSearch("http://es:9200/prefix/",
+                                           **options)
+        self.opened = []
+
+        def connect (netloc, timeout):
+            connection = FakeConnection(connections.pop(0))
+            self.opened.append(connection)
+            return connection
+        es.connection_class = connect
+        return es
+
+    def test_reused (self):
+
+        es = self.client([[FakeResponse(200, "a"), FakeResponse(200, "b")]])
+        self.assertEqual(es.get("/x"), "a")
+        self.assertEqual(es.put("/y", "body"), "b")
+        self.assertEqual(len(self.opened), 1)
+        (method, path, body, headers) = self.opened[0].requests[1]
+        self.assertEqual((method, path, body), ("PUT", "/prefix/y", "body"))
+        self.assertEqual(headers["Connection"], "keep-alive")
+
+    def test_stale (self):
+
+        es = self.client([[FakeResponse(200, "a"),
+                           httplib.BadStatusLine("")],
+                          [FakeResponse(200, "b")]])
+        es.get("/x")
+        # Closed by the server while idle: retried on a new connection
+        self.assertEqual(es.get("/x"), "b")
+        self.assertEqual(len(self.opened), 2)
+        self.assertTrue(self.opened[0].closed)
+
+    def test_new_connection_failing (self):
+
+        es = self.client([[socket.error("refused")]])
+        self.assertRaises(socket.error, es.get, "/x")
+        self.assertEqual(len(self.opened), 1)
+
+    def test_error (self):
+
+        es = self.client([[FakeResponse(404, "missing"),
+                           FakeResponse(200, "a")]])
+        try:
+            es.get("/x")
+        except grimoireng_data.ElasticSearchError as e:
+            self.assertEqual((e.code, e.body), (404, "missing"))
+        else:
+            self.fail("no error for 404")
+        # The connection is still usable
+        self.assertEqual(es.get("/x"), "a")
+        self.assertEqual(len(self.opened), 1)
+
+    def test_will_close (self):
+
+        es = self.client([[FakeResponse(200, "a", will_close = True)],
+                          [FakeResponse(200, "b")]])
+        es.get("/x")
+        self.assertTrue(self.opened[0].closed)
+        es.get("/x")
+        self.assertEqual(len(self.opened), 2)
+
+    def test_poolsize (self):
+
+        es = self.client([[], [], []], poolsize = 2)
+        connections = [es._acquire()[0] for i in range(3)]
+        for connection in connections:
+            es._release(connection)
+        self.assertEqual(len(es.idle), 2)
+        self.assertTrue(connections[2].closed)
+        es.close()
+        self.assertEqual(es.idle, [])
+        self.assertTrue(all(connection.closed for connection in connections))
+
+    def test_auth (self):
+
+        es = self.client([[FakeResponse(200, "a")]],
+                         auth = ["user", "secret"])
+        es.get("/x")
+        headers = self.opened[0].requests[0][3]
+        self.assertEqual(headers["Authorization"], "Basic dXNlcjpzZWNyZXQ=")
+
+    def test_shared (self):
+
+        self.assertTrue(grimoireng_data.es_client("http://es:9200/") \
+                        is grimoireng_data.es_client("http://es:9200"))
+        self.assertFalse(grimoireng_data.es_client("http://es:9200") \
+                         is grimoireng_data.es_client("http://es:9200",
+                                                      ["user", "secret"]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for the Database class and its connection pools (no server needed)
+##   python -m unittest discover -s tests
+
+import os
+import sys
+import threading
+import time
+import unittest
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+class FakeCursor:
+    """Cursor answering any query with the rows of its connection.
+
+    """
+
+    def __init__ (self, connection):
+
+        self.connection = connection
+        self.description = None
+        self.rows = []
+
+    def execute (self, sql):
+
+        self.connection.statements.append(sql)
+        if sql in self.connection.failing:
+            raise self.connection.failing.pop(sql)
+        if sql.startswith("SET"):
+            self.description = None
+            self.rows = []
+        else:
+            self.description = [(name,) for name in self.connection.fields]
+            self.rows = list(self.connection.rows)
+        return len(self.rows)
+
+    def fetchall (self):
+
+        (rows, self.rows) = (self.rows, [])
+        return rows
+
+    def fetchmany (self, size):
+
+        (rows, self.rows) = (self.rows[:size], self.rows[size:])
+        return rows
+
+    def close (self):
+
+        pass
+
+class FakeConnection:
+    """MySQL connection recording the statements executed in it.
+
+    Statements in failing raise their error, only the first time they
+    are executed (failing may be shared by several connections).
+
+    """
+
+    def __init__ (self, fields, rows, failing):
+
+        self.fields = fields
+        self.rows = rows
+        self.failing = failing
+        self.statements = []
+        self.schemas = []
+        self.closed = False
+        self.dropped = False
+
+    def cursor (self, cursorclass = None):
+
+        return FakeCursor(self)
+
+    def select_db (self, schema):
+
+        self.schemas.append(schema)
+
+    def ping (self):
+
+        if self.dropped:
+            raise grimoireng_data.MySQLdb.OperationalError(2006, "gone away")
+
+    def close (self):
+
+        self.closed = True
+
+class FakePool (grimoireng_data.ConnectionPool):
+    """Pool opening fake connections, all answering with the same rows.
+
+    """
+
+    def __init__ (self, fields = [], rows = [], failing = None, **kwargs):
+
+        grimoireng_data.ConnectionPool.__init__(self, "user", "passwd",
+                                                "localhost", 3306, **kwargs)
+        self.fields = fields
+        self.rows = rows
+        self.failing = failing or {}
+        self.opened = []
+
+    def _open (self):
+
+        connection = FakeConnection(self.fields, self.rows, self.failing)
+        self.opened.append(connection)
+        return connection
+
+class FakeDatabase (grimoireng_data.Database):
+    """Database using a fake pool, with no cache.
+
+    """
+
+    def __init__ (self, pool):
+
+        self.host = "localhost"
+        self.port = 3306
+        self.maindb = "scm"
+        self.shdb = "sh"
+        self.prjdb = "prj"
+        self.stagingdb = "staging"
+        self.pool = pool
+        self.cache = None
+        self.fingerprint = None
+
+class TestExecuteChunks (unittest.TestCase):
+
+    def setUp (self):
+
+        self.pool = FakePool(["id", "name"],
+                             [(number, "n" + str(number))
+                              for number in range(10)])
+        self.db = FakeDatabase(self.pool)
+
+    def test_chunks (self):
+
+        chunks = list(self.db.execute_chunks("SELECT * FROM {main_db}.t",
+                                             "Rows", chunksize = 4))
+        self.assertEqual([len(chunk.index) for chunk in chunks], [4, 4, 2])
+        df = pandas.concat(chunks, ignore_index = True)
+        self.assertEqual(list(df.columns), ["id", "name"])
+        self.assertEqual(list(df["id"]), range(10))
+
+    def test_stream_timeout (self):
+
+        list(self.db.execute_chunks("SELECT * FROM {main_db}.t",
+                                    chunksize = 4))
+        (connection,) = self.pool.opened
+        self.assertEqual(connection.statements,
+                         ["SET SESSION net_write_timeout = " \
+                          + str(grimoireng_data.db_stream_timeout),
+                          "SELECT * FROM scm.t",
+                          "SET SESSION net_write_timeout = DEFAULT"])
+        # Completed: the connection is kept for reuse
+        self.assertFalse(connection.closed)
+        self.assertEqual(len(self.pool.idle), 1)
+
+    def test_schema (self):
+
+        chunks = self.db.execute_chunks("SELECT * FROM {main_db}.t",
+                                        chunksize = 4,
+                                        schema = {"name": "category"})
+        for chunk in chunks:
+            self.assertEqual(chunk["name"].dtype.name, "category")
+
+    def test_not_completed (self):
+
+        chunks = self.db.execute_chunks("SELECT * FROM {main_db}.t",
+                                        chunksize = 4)
+        chunks.next()
+        chunks.close()
+        # Results could still be pending: the connection is not reused
+        (connection,) = self.pool.opened
+        self.assertTrue(connection.closed)
+        self.assertEqual(self.pool.idle, [])
+
+    def test_query_failing (self):
+
+        error = grimoireng_data.MySQLdb.OperationalError(1054, "Unknown")
+        self.pool.failing = {"SELECT * FROM scm.t": error}
+        chunks = self.db.execute_chunks("SELECT * FROM {main_db}.t")
+        self.assertRaises(grimoireng_data.MySQLdb.OperationalError,
+                          list, chunks)
+        (connection,) = self.pool.opened
+        self.assertTrue(connection.closed)
+
+class TestConnectionPool (unittest.TestCase):
+
+    def test_reuse (self):
+
+        pool = FakePool()
+        (connection, reused) = pool.acquire("scm")
+        self.assertFalse(reused)
+        pool.release(connection)
+        self.assertEqual(pool.acquire("scm"), (connection, True))
+        pool.release(connection)
+        (connection, reused) = pool.acquire("sh")
+        self.assertTrue(reused)
+        # Schemas are only switched when needed
+        self.assertEqual(connection.schemas, ["scm", "sh"])
+        self.assertEqual(len(pool.opened), 1)
+
+    def test_dropped (self):
+
+        pool = FakePool()
+        (connection, reused) = pool.acquire("scm")
+        pool.release(connection)
+        connection.dropped = True
+        (other, reused) = pool.acquire("scm")
+        self.assertFalse(reused)
+        self.assertIsNot(other, connection)
+        self.assertTrue(connection.closed)
+
+    def test_poolsize (self):
+
+        pool = FakePool(poolsize = 1)
+        connections = [pool.acquire()[0] for number in range(3)]
+        for connection in connections:
+            pool.release(connection)
+        self.assertEqual([connection.closed for connection in connections],
+                         [False, True, True])
+        pool.close()
+        self.assertTrue(connections[0].closed)
+        self.assertEqual(pool.idle, [])
+
+    def test_workers (self):
+
+        pool = FakePool(poolsize = 1, workers = 3)
+        # Enough idle connections for all workers
+        self.assertEqual(pool.poolsize, 3)
+        for number in range(3):
+            self.assertTrue(pool.slots.acquire(False))
+        self.assertFalse(pool.slots.acquire(False))
+
+    def test_shared (self):
+
+        key = ("localhost", 3306, "test")
+        try:
+            pool = grimoireng_data.db_pool("test", "", "localhost", 3306,
+                                           workers = 2)
+            self.assertIs(grimoireng_data.db_pool("test", "", "localhost",
+                                                  3306), pool)
+            self.assertEqual(pool.workers, 2)
+        finally:
+            del grimoireng_data.db_pools[key]
+
+class TestExecute (unittest.TestCase):
+
+    def setUp (self):
+
+        self.pool = FakePool(["id"], [(1,), (2,)])
+        self.db = FakeDatabase(self.pool)
+
+    def test_execute (self):
+
+        (rows, fields) = self.db.execute("SELECT id FROM {main_db}.t")
+        self.assertEqual((rows, fields), ([(1,), (2,)], ["id"]))
+        (rows, fields) = self.db.execute("SET @a = 1")
+        self.assertEqual((rows, fields), ([], []))
+        self.assertEqual(len(self.pool.opened), 1)
+
+    def test_dropped_retried (self):
+
+        (connection, reused) = self.pool.acquire("scm")
+        self.pool.release(connection)
+        # Dropped by the server while running the query
+        self.pool.failing["SELECT id FROM scm.t"] = \
+            grimoireng_data.MySQLdb.OperationalError(2013, "lost")
+        (rows, fields) = self.db.execute("SELECT id FROM {main_db}.t")
+        self.assertEqual(rows, [(1,), (2,)])
+        self.assertTrue(connection.closed)
+        self.assertEqual(len(self.pool.opened), 2)
+
+    def test_dropped_new (self):
+
+        # Errors in new connections are not retried
+        self.pool.failing["SELECT id FROM scm.t"] = \
+            grimoireng_data.MySQLdb.OperationalError(2013, "lost")
+        self.assertRaises(grimoireng_data.MySQLdb.OperationalError,
+                          self.db.execute, "SELECT id FROM {main_db}.t")
+        self.assertTrue(self.pool.opened[0].closed)
+        self.assertEqual(self.pool.idle, [])
+
+class SlowDatabase (FakeDatabase):
+    """Database taking some time for each query, and maybe failing it.
+
+    Queries are delays (in seconds) to wait, before returning a
+    dataframe with the name of the query, or raising error.
+
+    """
+
+    def __init__ (self, pool):
+
+        FakeDatabase.__init__(self, pool)
+        self.running = 0
+        self.most = 0
+        self.lock = threading.Lock()
+
+    def execute_df (self, query, name = "", error = None):
+
+        with self.lock:
+            self.running = self.running + 1
+            self.most = max(self.most, self.running)
+        try:
+            time.sleep(query)
+            if error:
+                raise error
+            return pandas.DataFrame({"name": [name]})
+        finally:
+            with self.lock:
+                self.running = self.running - 1
+
+class TestExecuteDfs (unittest.TestCase):
+
+    def test_order (self):
+
+        db = SlowDatabase(FakePool(workers = 3))
+        dfs = db.execute_dfs([{"query": 0.05, "name": "a"},
+                              {"query": 0.03, "name": "b"},
+                              {"query": 0.04, "name": "c"}])
+        self.assertEqual([df["name"][0] for df in dfs], ["a", "b", "c"])
+        self.assertEqual(db.most, 3)
+
+    def test_sequential (self):
+
+        db = SlowDatabase(FakePool(workers = 1))
+        dfs = db.execute_dfs([{"query": 0, "name": "a"},
+                              {"query": 0, "name": "b"}])
+        self.assertEqual([df["name"][0] for df in dfs], ["a", "b"])
+        self.assertEqual(db.most, 1)
+
+    def test_first_error (self):
+
+        db = SlowDatabase(FakePool(workers = 3))
+        # The second query fails after the third one
+        queries = [{"query": 0, "name": "a"},
+                   {"query": 0.03, "error": KeyError("second")},
+                   {"query": 0, "error": ValueError("third")}]
+        try:
+            db.execute_dfs(queries)
+            self.fail("No error raised")
+        except KeyError as e:
+            self.assertEqual(e.args, ("second",))
+        # Errors are raised once all queries are done
+        self.assertEqual(db.running, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for uploading to ElasticSearch (no server needed)
+##   python -m unittest discover -s tests
+
+import os
+import re
+import sys
+import time
+import unittest
+import zlib
+from collections import OrderedDict
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+from fakes import FakeElasticSearch, bulk_lines
+
+def bulk_lines_rows (df, index, type, id):
+    """Bulk API lines for a dataframe, serializing row by row.
+
+    """
+
+    action = '{{ "index" : {{ "_index" : "{index}", "_type" : "{type}", ' \
+        + '"_id" : "{id}" }} }}\n'
+    lines = []
+    for values in df.astype(object).values.tolist():
+        row = OrderedDict(zip(df.columns, values))
+        lines.append((row[id], action.format(index = index, type = type,
+                                             id = row[id]) \
+                      + grimoireng_data.json_dumps(row) + "\n"))
+    return lines
+
+class TestBulkLines (unittest.TestCase):
+
+    def setUp (self):
+
+        self.df = pandas.DataFrame(OrderedDict([
+            ("id", range(7)),
+            ("date", pandas.date_range("2015-01-01", periods = 7)),
+            ("name", [u"Jes\u00fas", "Bob", None, 'a "b"', "c", "d", "e"]),
+            ("added", [1.5, numpy.nan, 3.0, 0.0, 1.0, 2.0, 3.0]),
+            ("bot", [0, 1, 0, 0, 1, 0, 0])
+            ]))
+
+    def test_rows (self):
+
+        expected = bulk_lines_rows(self.df, "i", "t", "id")
+        for blocksize in [1, 3, 7, 100]:
+            lines = list(grimoireng_data.es_bulk_lines(self.df, "i", "t", "id",
+                                                       blocksize = blocksize))
+            self.assertEqual(lines, expected)
+        # Integers stay integers, next to floats
+        self.assertTrue('"bot":1}' in lines[1][1])
+
+    def test_chunks (self):
+
+        chunks = [self.df.iloc[0:3], self.df.iloc[3:7]]
+        lines = list(grimoireng_data.es_bulk_lines(chunks, "i", "t", "id",
+                                                   blocksize = 2))
+        self.assertEqual(lines, bulk_lines_rows(self.df, "i", "t", "id"))
+
+class TestBatchController (unittest.TestCase):
+
+    def test_grows_when_fast (self):
+
+        controller = grimoireng_data.BatchController(1000, minimum = 100,
+                                                     maximum = 2000)
+        controller.accepted(1)
+        self.assertEqual(controller.target, 1250)
+        for i in range(10):
+            controller.accepted(1)
+        self.assertEqual(controller.target, 2000)
+
+    def test_shrinks_when_slow_or_rejected (self):
+
+        controller = grimoireng_data.BatchController(1000, minimum = 100,
+                                                     maximum = 2000)
+        controller.accepted(20)
+        self.assertEqual(controller.target, 750)
+        controller.rejected()
+        self.assertEqual(controller.target, 375)
+        for i in range(10):
+            controller.rejected()
+        self.assertEqual(controller.target, 100)
+
+    def test_keeps_when_normal (self):
+
+        controller = grimoireng_data.BatchController(1000)
+        controller.accepted(5)
+        self.assertEqual(controller.target, 1000)
+
+    def test_limits_include_target (self):
+
+        controller = grimoireng_data.BatchController(10, minimum = 100,
+                                                     maximum = 1000)
+        self.assertEqual(controller.minimum, 10)
+        controller = grimoireng_data.BatchController(5000, minimum = 100,
+                                                     maximum = 1000)
+        self.assertEqual(controller.maximum, 5000)
+
+    def test_batches_by_size (self):
+
+        controller = grimoireng_data.BatchController(10, minimum = 1)
+        lines = [(id, "x" * 4) for id in range(7)]
+        batches = list(grimoireng_data.es_bulk_batches(lines, 100,
+                                                       controller))
+        self.assertEqual([[id for (id, line) in batch] for batch in batches],
+                         [[0, 1, 2], [3, 4, 5], [6]])
+
+class FailingElasticSearch (FakeElasticSearch):
+    """Client failing bulk requests with some documents, by id.
+
+    Failures are answered after delay seconds.
+
+    """
+
+    def __init__ (self, failing, delay = 0):
+
+        FakeElasticSearch.__init__(self)
+        self.failing = failing
+        self.delay = delay
+
+    def request (self, method, path, body = None, headers = {}):
+
+        for (id, code) in self.failing.iteritems():
+            if '"_id" : "' + str(id) + '"' in body:
+                time.sleep(self.delay)
+                raise grimoireng_data.ElasticSearchError(method, path,
+                                                         code, "")
+        return FakeElasticSearch.request(self, method, path, body, headers)
+
+class TestSendBatches (unittest.TestCase):
+
+    def send (self, es, ids, workers, **options):
+
+        stats = grimoireng_data.BulkStats("test")
+        batches = grimoireng_data.es_bulk_batches(bulk_lines(ids), 2)
+        grimoireng_data.es_send_batches(es, batches, "test",
+                                        workers = workers, stats = stats,
+                                        backoff = 0, **options)
+        return stats
+
+    def sent_ids (self, es):
+
+        return sorted(int(id) for (method, path, body) in es.requests
+                      for id in re.findall(r'"_id" : "(\d+)"', body))
+
+    def test_workers (self):
+
+        for workers in [1, 3]:
+            es = FakeElasticSearch()
+            stats = self.send(es, range(21), workers)
+            self.assertEqual(self.sent_ids(es), range(21))
+            self.assertEqual(len(es.requests), 11)
+            self.assertEqual(stats.succeeded, 21)
+
+    def test_pushback (self):
+
+        es = FakeElasticSearch({("PUT", "/_bulk"): [429, 503]})
+        stats = self.send(es, range(4), 1)
+        self.assertEqual(len(es.requests), 4)
+        self.assertEqual(stats.succeeded, 4)
+
+    def test_pushback_exhausted (self):
+
+        es = FakeElasticSearch({("PUT", "/_bulk"): [429, 429, 429]})
+        self.assertRaises(grimoireng_data.ElasticSearchError,
+                          self.send, es, range(4), 1, retries = 2)
+        self.assertEqual(len(es.requests), 3)
+
+    def test_first_error (self):
+
+        # Batches 2 and 4 fail: the error for batch 2 is raised
+        es = FailingElasticSearch({3: 400, 7: 500}, delay = 0.1)
+        try:
+            self.send(es, range(20), 3)
+        except grimoireng_data.ElasticSearchError as e:
+            self.assertEqual(e.code, 400)
+        else:
+            self.fail("no error for failed batches")
+
+    def test_error_stops (self):
+
+        es = FailingElasticSearch({1: 400})
+        self.assertRaises(grimoireng_data.ElasticSearchError,
+                          self.send, es, range(1000), 2)
+        # Once failed, no more batches are queued
+        self.assertTrue(len(es.requests) < 20)
+
+class TestTooLarge (unittest.TestCase):
+
+    def send (self, es, ids, controller = None):
+
+        grimoireng_data.es_send_batches(es, [bulk_lines(ids)], "test",
+                                        controller = controller, backoff = 0)
+
+    def test_split (self):
+
+        es = FakeElasticSearch({("PUT", "/_bulk"): [413]})
+        controller = grimoireng_data.BatchController(1000, minimum = 100)
+        self.send(es, [1, 2, 3], controller)
+        bodies = [body for (method, path, body) in es.requests]
+        self.assertEqual([body.count('"_id"') for body in bodies], [3, 1, 2])
+        # Halved when rejected, grown for the two halves accepted
+        self.assertEqual(controller.target, int(int(500 * 1.25) * 1.25))
+
+    def test_single_document (self):
+
+        es = FakeElasticSearch({("PUT", "/_bulk"): [413, 413]})
+        try:
+            self.send(es, [1, 2])
+        except grimoireng_data.ElasticSearchError as e:
+            self.assertEqual(e.code, 413)
+            self.assertTrue("document 1," in str(e))
+        else:
+            self.fail("no error for a document too large")
+        # Not retried
+        self.assertEqual(len(es.requests), 2)
+
+class TestBulkBody (unittest.TestCase):
+
+    def test_plain (self):
+
+        batch = bulk_lines([1, 2, 3])
+        (body, size) = grimoireng_data.es_bulk_body(batch)
+        self.assertEqual(body, "".join(line for (id, line) in batch))
+        self.assertEqual(size, len(body))
+
+    def test_gzip (self):
+
+        batch = bulk_lines(range(100)) + [(100, u'{"name":"Jes\u00fas"}\n')]
+        (body, size) = grimoireng_data.es_bulk_body(batch, compression = 6)
+        raw = "".join(line.encode("utf-8") if isinstance(line, unicode)
+                      else line for (id, line) in batch)
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), raw)
+        self.assertEqual(size, len(raw))
+        self.assertTrue(len(body) < size)
+
+class TestBulkResults (unittest.TestCase):
+
+    def test_items (self):
+
+        response = '{"took":3,"errors":true,"items":[' \
+            + '{"index":{"_id":"1","status":201}},\n' \
+            + ' {"delete":{"_id":"2","status":404,"found":false}},' \
+            + '{"index":{"_id":"3","status":429,' \
+            + '"error":{"type":"es_rejected_execution_exception"}}}]}'
+        results = list(grimoireng_data.es_bulk_results(response))
+        self.assertEqual(results, [
+            (201, None),
+            (404, None),
+            (429, {"type": "es_rejected_execution_exception"})
+            ])
+
+    def test_items_first (self):
+
+        response = '{"items": [ {"index": {"_id": "1", "status": 200}} ],' \
+            + ' "errors": false, "took": 3}'
+        results = list(grimoireng_data.es_bulk_results(response))
+        self.assertEqual(results, [(200, None)])
+
+    def test_no_items (self):
+
+        response = '{"took":3,"errors":false,"items":[]}'
+        self.assertEqual(list(grimoireng_data.es_bulk_results(response)), [])
+        response = '{"error":"x","status":500}'
+        self.assertEqual(list(grimoireng_data.es_bulk_results(response)), [])
+
+    def test_no_status (self):
+
+        response = '{"items":[{"index":{"_id":"1","error":"failed"}}]}'
+        results = list(grimoireng_data.es_bulk_results(response))
+        self.assertEqual(results, [(0, "failed")])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for selecting fields and columns (no database needed)
+##   python -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+class TestDocumentFields (unittest.TestCase):
+
+    def test_all (self):
+
+        fields = grimoireng_data.document_fields(
+            grimoireng_data.scm_mapping_commit)
+        self.assertEqual(fields[:4], ["id", "author_date", "commit_date",
+                                      "utc_author"])
+        self.assertEqual(fields[-1], "dashboard")
+        self.assertEqual(fields, grimoireng_data.mapping_fields(
+            grimoireng_data.scm_mapping_commit))
+
+    def test_requested (self):
+
+        # Mapping order, not requested order; id always; unknown ignored
+        fields = grimoireng_data.document_fields(
+            grimoireng_data.scm_mapping_commit,
+            ["org_name", "author_date", "nonexistent"])
+        self.assertEqual(fields, ["id", "author_date", "org_name"])
+
+    def test_reviews (self):
+
+        fields = grimoireng_data.document_fields(
+            grimoireng_data.scr_mapping_review, ["status"])
+        self.assertEqual(fields, ["id", "status"])
+
+class TestSqlSelect (unittest.TestCase):
+
+    expressions = OrderedDict([
+        ("id", "scmlog.id"),
+        ("date", "scmlog.author_date"),
+        ("hash", "scmlog.rev")
+        ])
+
+    def test_all (self):
+
+        self.assertEqual(grimoireng_data.sql_select(self.expressions),
+                         "scmlog.id AS id,\n  scmlog.author_date AS date,\n" \
+                         + "  scmlog.rev AS hash")
+
+    def test_columns (self):
+
+        # Expressions order, not columns order
+        self.assertEqual(grimoireng_data.sql_select(self.expressions,
+                                                    ["hash", "id"]),
+                         "scmlog.id AS id,\n  scmlog.rev AS hash")
+
+    def test_commits (self):
+
+        columns = grimoireng_data.scm_commits_required
+        sql = grimoireng_data.sql_commits(True, None, columns = columns)
+        for column in columns:
+            self.assertTrue(" AS " + column + "," in sql \
+                            or " AS " + column + "\n" in sql)
+        self.assertFalse(" AS message" in sql)
+        # Branches not needed for all branches, without branch_name
+        self.assertFalse("{main_db}.branches" in sql)
+        sql = grimoireng_data.sql_commits(True, None)
+        self.assertTrue(" AS branch_name" in sql)
+        self.assertTrue("{main_db}.branches" in sql)
+
+if __name__ == "__main__":
+    unittest.main()
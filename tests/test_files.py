@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for producing JSON files
+##   python -m unittest discover -s tests
+
+import codecs
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+def write_file_json_all (filename, data, compact = True, dateformat = "utime"):
+    """Write JSON content serializing it all at once (as it used to be).
+
+    """
+
+    json_dict = OrderedDict()
+    json_dict['names'] = list(data.columns.values)
+    json_dict['values'] = data.values.tolist()
+    data_json = grimoireng_data.json_dumps(json_dict, compact,
+                                           dateformat = dateformat)
+    with codecs.open(filename, "w", "utf-8") as file:
+        file.write(data_json)
+
+class TestWriteFileJson (unittest.TestCase):
+
+    def setUp (self):
+
+        self.directory = tempfile.mkdtemp()
+        self.data = pandas.DataFrame(OrderedDict([
+            ("id", [1, 2, 3, 4, 5]),
+            ("date", [datetime.datetime(2015, 1, 1, 10, 30),
+                      datetime.datetime(2015, 2, 1),
+                      datetime.datetime(1970, 1, 1),
+                      datetime.datetime(1999, 12, 31, 23, 59, 59),
+                      datetime.datetime(2015, 3, 1)]),
+            ("name", [u"Jes\u00fas", "Bob", u"\u674e", 'a "quote"', None]),
+            ("added", [1.5, numpy.nan, 3.0, 0.0, -2.25])
+            ]))
+
+    def tearDown (self):
+
+        shutil.rmtree(self.directory)
+
+    def read (self, name):
+
+        with open(os.path.join(self.directory, name), "rb") as file:
+            return file.read()
+
+    def check (self, data, **options):
+
+        write_file_json_all(os.path.join(self.directory, "all.json"),
+                            data, **options)
+        expected = self.read("all.json")
+        for chunksize in range(1, len(data.index) + 2):
+            grimoireng_data.write_file_json(
+                os.path.join(self.directory, "chunks.json"), data,
+                chunksize = chunksize, **options)
+            self.assertEqual(self.read("chunks.json"), expected)
+
+    def test_utime (self):
+
+        self.check(self.data)
+
+    def test_iso (self):
+
+        self.check(self.data, dateformat = "iso")
+
+    def test_not_compact (self):
+
+        self.check(self.data, compact = False)
+
+    def test_empty (self):
+
+        self.check(self.data.iloc[0:0])
+
+    def test_no_columns (self):
+
+        self.check(pandas.DataFrame())
+
+if __name__ == "__main__":
+    unittest.main()
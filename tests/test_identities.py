@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for the SortingHat identity index (no database needed)
+##   python -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+import datetime
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+D = datetime.datetime
+
+class FakeDatabase:
+    """Database answering SortingHat queries with fixed data.
+
+    """
+
+    host = "localhost"
+    port = 3306
+    user = "test"
+    shdb = "sortinghat"
+
+    def __init__ (self, enrollments = []):
+
+        self.enrollments = enrollments
+        self.loads = 0
+
+    def execute_dfs (self, queries):
+
+        self.loads = self.loads + 1
+        persons_df = pandas.DataFrame({"uuid": ["u1", "u2", "u3"],
+                                       "name": ["A", "B", "C"],
+                                       "bot": [0, 0, 1]})
+        enrollments_df = pandas.DataFrame.from_records(
+            self.enrollments, columns = ["uuid", "org_id", "start", "end"])
+        orgs_df = pandas.DataFrame({"org_id": [1, 2, 3],
+                                    "org_name": ["Org1", "Org2", "Org3"]})
+        return (persons_df[["uuid", "name", "bot"]], enrollments_df,
+                orgs_df[["org_id", "org_name"]])
+
+def affiliate_slow (enrollments, uuid, date):
+    """Organization for a person at a date, checking all enrollments.
+
+    """
+
+    found = None
+    for (person, org_id, start, end) in enrollments:
+        if person == uuid and date is not None \
+           and (start is None or start < date) \
+           and (end is None or date < end) \
+           and (found is None or start > found[0]):
+            found = (start, org_id)
+    if found:
+        return found[1]
+
+class TestIdentityIndex (unittest.TestCase):
+
+    def setUp (self):
+
+        self.index = grimoireng_data.IdentityIndex(FakeDatabase())
+
+    def test_persons (self):
+
+        persons_df = self.index.persons()
+        self.assertEqual(list(persons_df["uuid"]), ["u1", "u2", "u3"])
+        # A copy, which can be changed by the analyses
+        persons_df["name"] = "X"
+        self.assertEqual(list(self.index.persons()["name"]), ["A", "B", "C"])
+
+    def test_persons_some (self):
+
+        persons_df = self.index.persons(["u3", "u9", "u1"])
+        self.assertEqual(list(persons_df["uuid"]), ["u1", "u3"])
+        self.assertEqual(list(persons_df["bot"]), [0, 1])
+        self.assertEqual(list(persons_df.index), [0, 1])
+
+    def test_person_codes (self):
+
+        codes = self.index.person_codes(pandas.Series(["u2", "u9", "u1"]))
+        self.assertEqual(list(codes), [1, -1, 0])
+
+    def test_shared (self):
+
+        db = FakeDatabase()
+        key = (db.host, db.port, db.user, db.shdb)
+        try:
+            index = grimoireng_data.identity_index(db)
+            self.assertIs(grimoireng_data.identity_index(db), index)
+            self.assertEqual(db.loads, 1)
+        finally:
+            del grimoireng_data.identity_indexes[key]
+
+class TestAffiliate (unittest.TestCase):
+
+    enrollments = [
+        ("u1", 1, D(2010, 1, 1), D(2012, 1, 1)),
+        ("u1", 2, D(2011, 1, 1), D(2011, 6, 1)),
+        ("u1", 3, D(2014, 1, 1), D(2015, 1, 1)),
+        ("u2", 2, None, None)
+        ]
+
+    def affiliate (self, rows):
+
+        index = grimoireng_data.IdentityIndex(FakeDatabase(self.enrollments))
+        df = pandas.DataFrame.from_records(rows, columns = ["uuid", "date"])
+        return index.affiliate(df, "uuid", "date")
+
+    def test_enrollments (self):
+
+        df = self.affiliate([
+            ("u1", D(2010, 6, 1)),   # one enrollment
+            ("u1", D(2011, 3, 1)),   # two enrollments, latest start wins
+            ("u1", D(2011, 9, 1)),   # after the latest start ended
+            ("u1", D(2013, 1, 1)),   # between enrollments
+            ("u1", D(2010, 1, 1)),   # at the start, not included
+            ("u1", D(2012, 1, 1)),   # at the end, not included
+            ("u2", D(1990, 1, 1)),   # enrollment with no start or end
+            ("u3", D(2011, 1, 1)),   # no enrollments
+            ("u9", D(2011, 1, 1)),   # unknown person
+            ("u1", None)             # no date
+            ])
+        self.assertEqual(list(df["org_id"].fillna(0)),
+                         [1, 2, 1, 0, 0, 0, 2, 0, 0, 0])
+        self.assertEqual(list(df["org_name"].fillna("")),
+                         ["Org1", "Org2", "Org1", "", "", "", "Org2",
+                          "", "", ""])
+        self.assertEqual(list(df.columns), ["uuid", "date",
+                                            "org_id", "org_name"])
+
+    def test_random (self):
+
+        random = numpy.random.RandomState(7)
+        dates = [D(2010 + year, month, 1)
+                 for year in range(4) for month in (1, 4, 7, 10)]
+        self.enrollments = []
+        for i in range(40):
+            (start, end) = sorted(random.choice(len(dates), 2,
+                                                replace = False))
+            # Different starts, so that the latest one is well defined
+            self.enrollments.append(("u" + str(random.randint(1, 4)),
+                                     random.randint(1, 4),
+                                     dates[start] \
+                                     + datetime.timedelta(hours = i),
+                                     dates[end]))
+        rows = [("u" + str(random.randint(1, 4)),
+                 dates[random.randint(len(dates))] \
+                 + datetime.timedelta(days = random.randint(-1, 2)))
+                for i in range(200)]
+        df = self.affiliate(rows)
+        expected = [affiliate_slow(self.enrollments, uuid, date) or 0
+                    for (uuid, date) in rows]
+        self.assertEqual(list(df["org_id"].fillna(0)), expected)
+
+if __name__ == "__main__":
+    unittest.main()
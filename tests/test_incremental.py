@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for incremental extraction (no database needed)
+##   python -m unittest discover -s tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+class TestIncrementMerge (unittest.TestCase):
+
+    def test_no_previous (self):
+
+        new_df = pandas.DataFrame({"hash": ["a", "b"], "id": [1, 2]})
+        merged_df = grimoireng_data.increment_merge(None, new_df, "hash")
+        self.assertTrue(merged_df is new_df)
+
+    def test_appends_new_rows (self):
+
+        old_df = pandas.DataFrame({"hash": ["a", "b"], "id": [1, 2]})
+        new_df = pandas.DataFrame({"hash": ["c"], "id": [3]})
+        merged_df = grimoireng_data.increment_merge(old_df, new_df, "hash")
+        self.assertEqual(list(merged_df["hash"]), ["a", "b", "c"])
+        self.assertEqual(list(merged_df.index), [0, 1, 2])
+
+    def test_keeps_saved_rows (self):
+
+        # Commit b saved before, seen again with a new id (eg, in other
+        # repository), and retrieved twice
+        old_df = pandas.DataFrame({"hash": ["a", "b"], "id": [1, 2],
+                                   "repo": ["r1", "r1"]})
+        new_df = pandas.DataFrame({"hash": ["b", "c", "c"], "id": [5, 6, 7],
+                                   "repo": ["r2", "r2", "r3"]})
+        merged_df = grimoireng_data.increment_merge(old_df, new_df, "hash",
+                                                    keep = "first")
+        self.assertEqual(list(merged_df["hash"]), ["a", "b", "c"])
+        self.assertEqual(list(merged_df["id"]), [1, 2, 6])
+        self.assertEqual(list(merged_df["repo"]), ["r1", "r1", "r2"])
+
+    def test_replaced_by_id (self):
+
+        old_df = pandas.DataFrame({"id": [1, 2], "status": ["NEW", "NEW"]})
+        new_df = pandas.DataFrame({"id": [2, 3],
+                                   "status": ["MERGED", "NEW"]})
+        merged_df = grimoireng_data.increment_merge(old_df, new_df, "id")
+        self.assertEqual(list(merged_df["id"]), [1, 2, 3])
+        # Rows retrieved again replace those saved
+        self.assertEqual(list(merged_df["status"]), ["NEW", "MERGED", "NEW"])
+
+class TestIncrementalState (unittest.TestCase):
+
+    def setUp (self):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown (self):
+
+        shutil.rmtree(self.directory)
+
+    def test_runs (self):
+
+        state = grimoireng_data.IncrementalState(self.directory, "dash-scm")
+        self.assertEqual(state.watermark("scmlog.id"), None)
+        self.assertEqual(state.frame("commits"), None)
+        first_df = pandas.DataFrame({"hash": ["a", "b"], "id": [1, 2]})
+        state.save({"commits": first_df}, {"scmlog.id": 2})
+        # Next run
+        state = grimoireng_data.IncrementalState(self.directory, "dash-scm")
+        self.assertEqual(state.watermark("scmlog.id"), 2)
+        new_df = pandas.DataFrame({"hash": ["b", "c"], "id": [2, 3]})
+        merged_df = grimoireng_data.increment_merge(state.frame("commits"),
+                                                    new_df, "hash")
+        self.assertEqual(list(merged_df["hash"]), ["a", "b", "c"])
+        self.assertEqual(list(merged_df["id"]), [1, 2, 3])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for running uploads in a pipeline (no servers needed)
+##   python -m unittest discover -s tests
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+class JobError (Exception):
+    pass
+
+class TestPipeline (unittest.TestCase):
+
+    def setUp (self):
+
+        self.done = []
+
+    def job (self, name, fail = False, event = None):
+
+        def run ():
+            if event:
+                event.wait()
+            if fail:
+                raise JobError(name)
+            self.done.append(name)
+        return run
+
+    def test_order (self):
+
+        pipeline = grimoireng_data.Pipeline()
+        for name in ["a", "b", "c", "d"]:
+            pipeline.submit(self.job(name), name)
+        pipeline.join()
+        self.assertEqual(self.done, ["a", "b", "c", "d"])
+
+    def test_failed (self):
+
+        pipeline = grimoireng_data.Pipeline()
+        event = threading.Event()
+        pipeline.submit(self.job("a", fail = True, event = event), "a")
+        pipeline.submit(self.job("b"), "b")
+        event.set()
+        self.assertRaises(JobError, pipeline.wait)
+        # Once failed, no more jobs are accepted, or run
+        self.assertRaises(JobError, pipeline.submit, self.job("c"), "c")
+        self.assertRaises(JobError, pipeline.check)
+        self.assertRaises(JobError, pipeline.join)
+        self.assertEqual(self.done, [])
+
+    def test_close (self):
+
+        pipeline = grimoireng_data.Pipeline()
+        pipeline.submit(self.job("a", fail = True), "a")
+        pipeline.close()
+        self.assertRaises(JobError, pipeline.check)
+
+class FakeUpload:
+    """Upload recording what is done with it.
+
+    """
+
+    def __init__ (self, event, done):
+
+        self.event = event
+        self.done = done
+
+    def upload (self, data):
+
+        self.event.wait()
+        self.done.append(("upload", data))
+
+    def finish (self):
+
+        self.done.append("finish")
+
+    def abort (self):
+
+        self.done.append("abort")
+
+class TestProcessAllFailing (unittest.TestCase):
+    """Producing data fails while uploads are pending.
+
+    """
+
+    def setUp (self):
+
+        self.event = threading.Event()
+        self.done = []
+        self.saved = dict((name, getattr(grimoireng_data, name))
+                          for name in ["Database", "IndexUpload",
+                                       "analyze_scm", "analyze_scr"])
+        grimoireng_data.Database = lambda **kwargs: None
+        grimoireng_data.IndexUpload = \
+            lambda **kwargs: FakeUpload(self.event, self.done)
+        grimoireng_data.analyze_scm = lambda **kwargs: "scm"
+
+        def analyze_scr (**kwargs):
+            # Upload of SCM data still pending
+            self.event.set()
+            raise JobError("scr")
+        grimoireng_data.analyze_scr = analyze_scr
+
+    def tearDown (self):
+
+        for (name, value) in self.saved.iteritems():
+            setattr(grimoireng_data, name, value)
+
+    def test_uploads_done (self):
+
+        self.assertRaises(JobError, grimoireng_data.process_all,
+                          user = "u", scmdb = "scm", scrdb = "scr",
+                          shdb = "sh", elasticsearch = ["http://es", "i"])
+        self.assertEqual(self.done, [("upload", "scm"), "abort"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for rebuilding indexes in ElasticSearch (no server needed)
+##   python -m unittest discover -s tests
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+from fakes import FakeElasticSearch
+
+def index_settings (settings):
+    """Answer to GET _settings for some indexes, with their settings.
+
+    """
+
+    return json.dumps(dict((name, {"settings": {"index": index}})
+                           for (name, index) in settings.iteritems()))
+
+class TestSwapAlias (unittest.TestCase):
+
+    new = "a-20160102000000"
+
+    def swap (self, current = None, keep = 0):
+
+        answers = {}
+        if current is not None:
+            answers[("GET", "/a/_settings")] = index_settings(current)
+        es = FakeElasticSearch(answers)
+        grimoireng_data.es_swap_alias(es, "a", self.new, keep = keep)
+        return es
+
+    def body (self, es, method, path):
+
+        return [json.loads(body) for (request_method, request_path, body)
+                in es.requests
+                if request_method == method and request_path == path]
+
+    def test_first (self):
+
+        es = self.swap()
+        self.assertEqual(self.body(es, "PUT", "/" + self.new + "/_settings"),
+                         [{"index": {"refresh_interval": "1s",
+                                     "number_of_replicas": 1}}])
+        self.assertEqual(self.body(es, "POST", "/_aliases"),
+                         [{"actions": [{"add": {"index": self.new,
+                                                "alias": "a"}}]}])
+        self.assertEqual(es.paths("DELETE"), [])
+
+    def test_previous (self):
+
+        es = self.swap({"a-20160101000000": {"number_of_replicas": "2",
+                                             "refresh_interval": "30s"}})
+        self.assertEqual(self.body(es, "PUT", "/" + self.new + "/_settings"),
+                         [{"index": {"refresh_interval": "30s",
+                                     "number_of_replicas": "2"}}])
+        self.assertEqual(self.body(es, "POST", "/_aliases"),
+                         [{"actions": [{"remove": {"index": "a-20160101000000",
+                                                   "alias": "a"}},
+                                       {"add": {"index": self.new,
+                                                "alias": "a"}}]}])
+        self.assertEqual(es.paths("DELETE"), ["/a-20160101000000"])
+        # Alias moved before deleting the index
+        self.assertTrue(es.paths().index("/_aliases") \
+                        < es.paths().index("/a-20160101000000"))
+
+    def test_previous_default_refresh (self):
+
+        es = self.swap({"a-20160101000000": {"number_of_replicas": "0"}})
+        self.assertEqual(self.body(es, "PUT", "/" + self.new + "/_settings"),
+                         [{"index": {"refresh_interval": "1s",
+                                     "number_of_replicas": "0"}}])
+
+    def test_legacy_index (self):
+
+        es = self.swap({"a": {"number_of_replicas": "1"}})
+        self.assertEqual(self.body(es, "POST", "/_aliases"),
+                         [{"actions": [{"add": {"index": self.new,
+                                                "alias": "a"}}]}])
+        self.assertEqual(es.paths("DELETE"), ["/a"])
+        self.assertTrue(es.paths().index("/a") \
+                        < es.paths().index("/_aliases"))
+
+    def test_keep (self):
+
+        es = self.swap({"a-20151201000000": {}, "a-20160101000000": {}},
+                       keep = 1)
+        self.assertEqual(es.paths("DELETE"), ["/a-20151201000000"])
+
+    def test_other_rebuilds_left (self):
+
+        # An index being loaded by another upload is not behind the alias
+        es = self.swap({"a-20160101000000": {}})
+        self.assertEqual(es.paths("DELETE"), ["/a-20160101000000"])
+        self.assertFalse("/a-*/_settings" in es.paths())
+
+class TestRebuildIndex (unittest.TestCase):
+
+    def test_create (self):
+
+        es = FakeElasticSearch()
+        data = {"t": {"mapping": '{"t": {"properties": {}}}'}}
+        index = grimoireng_data.es_create_rebuild_index(es, "a", data)
+        self.assertTrue(index.startswith("a-"))
+        self.assertEqual(len(index), len("a-20160101000000"))
+        (method, path, body) = es.requests[0]
+        self.assertEqual((method, path), ("PUT", "/" + index))
+        self.assertEqual(json.loads(body),
+                         {"settings": {"index": {"refresh_interval": "-1",
+                                                 "number_of_replicas": 0}},
+                          "mappings": {"t": {"properties": {}}}})
+
+if __name__ == "__main__":
+    unittest.main()
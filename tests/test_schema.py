@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for typed extraction with schemas (no database needed)
+##   python -m unittest discover -s tests
+
+import datetime
+import os
+import sys
+import unittest
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+class TestApplySchema (unittest.TestCase):
+
+    def setUp (self):
+
+        self.df = pandas.DataFrame.from_records(
+            [(1, 3, "master", datetime.datetime(2015, 1, 1)),
+             (2, None, "master", None),
+             (3, 5, "devel", datetime.datetime(2015, 2, 1))],
+            columns = ["id", "lines", "branch", "date"])
+
+    def test_types (self):
+
+        grimoireng_data.apply_schema(self.df, {"id": "int32",
+                                               "branch": "category",
+                                               "date": "datetime"})
+        self.assertEqual(self.df["id"].dtype.name, "int32")
+        self.assertEqual(self.df["branch"].dtype.name, "category")
+        self.assertEqual(sorted(self.df["branch"].cat.categories),
+                         ["devel", "master"])
+        self.assertEqual(self.df["date"].dtype.name, "datetime64[ns]")
+        self.assertTrue(pandas.isnull(self.df["date"][1]))
+
+    def test_nulls_and_missing (self):
+
+        lines = self.df["lines"].copy()
+        grimoireng_data.apply_schema(self.df, {"lines": "int64",
+                                               "missing": "int64"})
+        # No integer NaN: columns with NULLs are left as they are
+        pandas.util.testing.assert_series_equal(self.df["lines"], lines)
+        self.assertNotIn("missing", self.df.columns)
+
+    def test_same_documents (self):
+
+        df = self.df.copy()
+        grimoireng_data.apply_schema(df, {"id": "int64",
+                                          "branch": "category",
+                                          "date": "datetime"})
+        self.assertEqual(
+            list(grimoireng_data.es_bulk_lines(df, "i", "t", "id")),
+            list(grimoireng_data.es_bulk_lines(self.df, "i", "t", "id")))
+
+class TestCategories (unittest.TestCase):
+
+    def test_fillna_category (self):
+
+        series = pandas.Series(["a", None, "b"]).astype("category")
+        filled = grimoireng_data.fillna_category(series, "none")
+        self.assertEqual(list(filled), ["a", "none", "b"])
+        self.assertIn("none", filled.cat.categories)
+        filled = grimoireng_data.fillna_category(filled, "a")
+        self.assertEqual(list(filled), ["a", "none", "b"])
+
+    def test_fillna_other (self):
+
+        series = pandas.Series(["a", None])
+        filled = grimoireng_data.fillna_category(series, "none")
+        self.assertEqual(list(filled), ["a", "none"])
+
+    def test_constant_column (self):
+
+        column = grimoireng_data.constant_column("dash", 3)
+        self.assertEqual(list(column), ["dash"] * 3)
+        self.assertEqual(list(column.categories), ["dash"])
+        self.assertEqual(column.codes.dtype, numpy.int8)
+
+if __name__ == "__main__":
+    unittest.main()
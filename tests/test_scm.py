@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for completing SCM commits (no database needed)
+##   python -m unittest discover -s tests
+
+import datetime
+import os
+import re
+import sys
+import unittest
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+D = datetime.datetime
+
+class FakeDatabase:
+    """Database answering SortingHat queries with fixed data.
+
+    """
+
+    shdb = "sortinghat"
+
+    def execute_dfs (self, queries):
+
+        persons_df = pandas.DataFrame({"uuid": ["u1", "u2", "u3"],
+                                       "name": ["A", "B", "C"],
+                                       "bot": [0, 0, 1]})
+        enrollments_df = pandas.DataFrame.from_records(
+            [("u1", 1, D(2010, 1, 1), D(2012, 1, 1)),
+             ("u3", 2, None, None)],
+            columns = ["uuid", "org_id", "start", "end"])
+        orgs_df = pandas.DataFrame({"org_id": [1, 2, 3],
+                                    "org_name": ["Org1", "Org2", "Org3"]})
+        return (persons_df[["uuid", "name", "bot"]], enrollments_df,
+                orgs_df[["org_id", "org_name"]])
+
+def commits ():
+    """Commits, as obtained from the database.
+
+    """
+
+    return pandas.DataFrame.from_records(
+        [(1, D(2011, 1, 1), D(2011, 1, 2), "u1", 10),
+         (2, D(2011, 1, 1), D(2011, 1, 2), "u2", 20),
+         (3, D(2011, 1, 1), D(2011, 1, 2), "u9", 10),
+         (4, D(2013, 1, 1), D(2013, 1, 2), "u1", 30)],
+        columns = ["id", "date", "commit_date", "author_uuid", "repo_id"])
+
+class TestPersonsOrgs (unittest.TestCase):
+
+    def setUp (self):
+
+        self.identities = grimoireng_data.IdentityIndex(FakeDatabase())
+        self.commits_df = grimoireng_data.scm_commits_prepare(
+            commits(), self.identities, "dash")
+
+    def test_prepare (self):
+
+        # Commits by unknown authors are dropped
+        self.assertEqual(list(self.commits_df["id"]), [1, 2, 4])
+        self.assertEqual(list(self.commits_df["org_id"]), [1, 0, 0])
+        self.assertEqual(list(self.commits_df["name"]),
+                         ["A (Org1)", "B (Unknown)", "A (Unknown)"])
+        self.assertEqual(list(self.commits_df["author_name"]),
+                         ["A", "B", "A"])
+        self.assertEqual(list(self.commits_df["dashboard"]), ["dash"] * 3)
+
+    def test_persons_orgs (self):
+
+        (persons_df, orgs_df) = grimoireng_data.scm_commits_persons_orgs(
+            self.commits_df, self.identities)
+        self.assertEqual(list(persons_df["uuid"]), ["u1", "u2"])
+        self.assertEqual(list(persons_df["id"]), [0, 1])
+        self.assertEqual(list(persons_df["name"]), ["A", "B"])
+        # Unknown always first, then organizations authoring commits
+        self.assertEqual(list(orgs_df["org_id"]), [0, 1])
+        self.assertEqual(list(orgs_df["org_name"]), ["Unknown", "Org1"])
+
+    def test_no_commits (self):
+
+        (persons_df, orgs_df) = grimoireng_data.scm_commits_persons_orgs(
+            self.commits_df.iloc[:0], self.identities)
+        self.assertEqual(len(persons_df.index), 0)
+        self.assertEqual(list(orgs_df["org_name"]), ["Unknown"])
+
+class TestTakeCodes (unittest.TestCase):
+
+    def test_integers (self):
+
+        values = pandas.Series([10, 20, 30])
+        taken = grimoireng_data.take_codes(values, numpy.array([2, 0]))
+        self.assertEqual(taken.dtype, values.dtype)
+        self.assertEqual(list(taken), [30, 10])
+        # Missing values only when needed
+        taken = grimoireng_data.take_codes(values, numpy.array([1, -1]))
+        self.assertEqual(taken[0], 20)
+        self.assertTrue(numpy.isnan(taken[1]))
+
+    def test_categorical (self):
+
+        values = pandas.Series(["a", "b", "a"]).astype("category")
+        taken = grimoireng_data.take_codes(values, numpy.array([1, -1, 2]))
+        self.assertIsInstance(taken, pandas.Categorical)
+        self.assertEqual(list(taken.astype(object)), ["b", numpy.nan, "a"])
+
+class TestDimensions (unittest.TestCase):
+
+    def setUp (self):
+
+        identities = grimoireng_data.IdentityIndex(FakeDatabase())
+        self.commits_df = grimoireng_data.scm_commits_prepare(
+            commits(), identities, "dash")
+        self.commits_df["tz"] = [1, 2, 3]
+        (persons_df, orgs_df) = grimoireng_data.scm_commits_persons_orgs(
+            self.commits_df, identities)
+        # Lines may be repeated (one row per branch), and be missing
+        lines_df = pandas.DataFrame({"id": [1, 1, 2],
+                                     "added": [3, 3, 5],
+                                     "removed": [1, 1, 0]})
+        repos_df = pandas.DataFrame({"repo_id": [10, 20],
+                                     "repo_name": ["r10", "r20"],
+                                     "project_id": [1, 2],
+                                     "project_name": ["p1", "p2"]})
+        self.dimensions = grimoireng_data.ScmDimensions(lines_df, repos_df,
+                                                        persons_df)
+
+    def test_comprehensive (self):
+
+        fields = ["id", "author_date", "bot", "added", "removed",
+                  "repo_name", "project_name", "org_name", "dashboard"]
+        df = grimoireng_data.scm_commits_comprehensive(
+            self.commits_df, self.dimensions, fields)
+        self.assertEqual(list(df.columns), fields)
+        # Same as merging with the dimensions
+        merged = self.commits_df.rename(columns = {"date": "author_date"}) \
+            .merge(self.dimensions.persons_df[["uuid", "bot"]],
+                   left_on = "author_uuid", right_on = "uuid", how = "left") \
+            .merge(self.dimensions.lines_df, on = "id", how = "left") \
+            .merge(self.dimensions.repos_df, on = "repo_id", how = "left")
+        for name in fields:
+            self.assertEqual(list(df[name].astype(object).fillna("-")),
+                             list(merged[name].astype(object).fillna("-")),
+                             name)
+
+    def test_all_fields (self):
+
+        for name in grimoireng_data.scm_commits_optional:
+            if name not in self.commits_df.columns:
+                self.commits_df[name] = "x"
+        df = grimoireng_data.scm_commits_comprehensive(self.commits_df,
+                                                       self.dimensions)
+        self.assertEqual(list(df.columns), grimoireng_data.mapping_fields(
+            grimoireng_data.scm_mapping_commit))
+
+    def test_packed (self):
+
+        df = grimoireng_data.scm_commits_packed(self.commits_df,
+                                                self.dimensions)
+        self.assertEqual(list(df.columns),
+                         ["id", "date", "author", "org", "repo", "tz"])
+        self.assertEqual(list(df["author"]), [0, 1, 0])
+        self.assertEqual(list(df["org"]), [1, 0, 0])
+
+class PartitionDatabase (FakeDatabase):
+    """Database answering queries for commits in ranges of repositories.
+
+    Queries for ranges including a repository in failing raise an error.
+
+    """
+
+    host = "localhost"
+    port = 3306
+    user = "test"
+    commits = pandas.DataFrame.from_records(
+        [(1, D(2011, 1, 3), D(2011, 1, 3), "u1", 1, "h1"),
+         (2, D(2011, 1, 1), D(2011, 1, 1), "u2", 2, "h2"),
+         (3, D(2011, 1, 2), D(2011, 1, 2), "u1", 3, "h3"),
+         (4, D(2011, 1, 4), D(2011, 1, 4), "u1", 4, "h1"),
+         (5, D(2011, 1, 5), D(2011, 1, 5), "u9", 4, "h5")],
+        columns = ["id", "date", "commit_date", "author_uuid", "repo_id",
+                   "hash"])
+    failing = None
+
+    def __init__ (self, **params):
+
+        self.passwd = ""
+        self.maindb = "scm"
+        self.prjdb = "prj"
+        self.stagingdb = None
+        self.cache = None
+        self.fingerprint = None
+        self.__dict__.update(params)
+
+    def execute_df (self, query, name = "", schema = None):
+
+        (first, last) = [int(number) for number in
+                         re.search(r"BETWEEN (\d+) AND (\d+)", query).groups()]
+        if self.failing is not None and first <= self.failing <= last:
+            raise ValueError("Failing " + name)
+        repos = self.commits["repo_id"]
+        return self.commits[(repos >= first) & (repos <= last)] \
+            .reset_index(drop = True)
+
+class TestPartitioned (unittest.TestCase):
+
+    def setUp (self):
+
+        self.database = grimoireng_data.Database
+        grimoireng_data.Database = PartitionDatabase
+        self.db = PartitionDatabase()
+
+    def tearDown (self):
+
+        grimoireng_data.Database = self.database
+        PartitionDatabase.failing = None
+        grimoireng_data.identity_indexes.clear()
+
+    def test_partitions (self):
+
+        commits_df = grimoireng_data.scm_commits_partitioned(
+            self.db, True, None, [4, 1, 2, 3, 4], "dash", 2)
+        # In date order, keeping the first commit for each hash
+        self.assertEqual(list(commits_df["id"]), [2, 3, 1])
+        self.assertEqual(list(commits_df["org_id"]), [0, 1, 1])
+        self.assertEqual(list(commits_df.index), [0, 1, 2])
+
+    def test_more_partitions (self):
+
+        commits_df = grimoireng_data.scm_commits_partitioned(
+            self.db, True, None, [1, 2], "dash", 4)
+        self.assertEqual(list(commits_df["id"]), [2, 1])
+
+    def test_failing (self):
+
+        PartitionDatabase.failing = 3
+        self.assertRaises(ValueError,
+                          grimoireng_data.scm_commits_partitioned,
+                          self.db, True, None, [1, 2, 3, 4], "dash", 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for the analysis of SCR (review) data (no database needed)
+##   python -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+def changes (issue_ids):
+    """Changes for the given issue ids, with ids in order.
+
+    """
+
+    return pandas.DataFrame({"issue_id": issue_ids,
+                             "id": range(len(issue_ids))})
+
+class TestChangesChunks (unittest.TestCase):
+
+    def regroup (self, issue_ids, chunksize):
+
+        df = changes(issue_ids)
+        chunks = [df.iloc[start:start + chunksize]
+                  for start in range(0, len(df), chunksize)]
+        return list(grimoireng_data.scr_changes_chunks(chunks))
+
+    def test_reviews_not_split (self):
+
+        issue_ids = [1, 1, 2, 2, 2, 2, 3, 4, 4, 5]
+        for chunksize in range(1, len(issue_ids) + 1):
+            chunks = self.regroup(issue_ids, chunksize)
+            seen = set()
+            for chunk in chunks:
+                reviews = set(chunk["issue_id"])
+                self.assertFalse(reviews & seen)
+                seen.update(reviews)
+            produced = pandas.concat(chunks, ignore_index = True)
+            self.assertEqual(list(produced["id"]), range(len(issue_ids)))
+
+    def test_review_spanning_chunks (self):
+
+        chunks = self.regroup([1, 2, 2, 2, 2, 2, 3], 2)
+        self.assertEqual([list(chunk["issue_id"]) for chunk in chunks],
+                         [[1], [2, 2, 2, 2, 2], [3]])
+
+    def test_empty (self):
+
+        self.assertEqual(list(grimoireng_data.scr_changes_chunks([])), [])
+
+if __name__ == "__main__":
+    unittest.main()
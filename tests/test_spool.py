@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for spooling uploads to ElasticSearch (no server needed)
+##   python -m unittest discover -s tests
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+from fakes import FakeElasticSearch, bulk_lines
+
+class TestSpool (unittest.TestCase):
+
+    def setUp (self):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown (self):
+
+        shutil.rmtree(self.directory)
+
+    def manifest (self):
+
+        with open(os.path.join(self.directory, "manifest.json")) as file:
+            return json.load(file)
+
+    def send (self, es, ids, batchsize = 2):
+
+        spool = grimoireng_data.Spool(self.directory)
+        batches = grimoireng_data.es_bulk_batches(bulk_lines(ids), batchsize)
+        grimoireng_data.es_send_batches(es, batches, "test", spool = spool,
+                                        retries = 0)
+        return spool
+
+    def test_acked_removed (self):
+
+        spool = grimoireng_data.Spool(self.directory)
+        batches = list(spool.store("test", [bulk_lines([1]),
+                                            bulk_lines([2])]))
+        spool.ack(batches[0].name)
+        self.assertEqual([entry["file"] for entry in
+                          self.manifest()["batches"]], [batches[1].name])
+        self.assertFalse(os.path.exists(os.path.join(self.directory,
+                                                     batches[0].name)))
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    batches[1].name)))
+
+    def test_uploaded (self):
+
+        self.send(FakeElasticSearch(), range(5))
+        self.assertEqual(self.manifest()["batches"], [])
+        self.assertFalse(grimoireng_data.spool_pending(self.directory))
+        self.assertEqual(os.listdir(self.directory), ["manifest.json"])
+
+    def test_failed (self):
+
+        es = FakeElasticSearch({("PUT", "/_bulk"): [None, 400]})
+        self.assertRaises(grimoireng_data.ElasticSearchError,
+                          self.send, es, range(5))
+        # First batch uploaded, the rest pending
+        self.assertEqual(len(self.manifest()["batches"]), 2)
+        self.assertTrue(grimoireng_data.spool_pending(self.directory))
+
+    def test_new_upload_refused (self):
+
+        es = FakeElasticSearch({("PUT", "/_bulk"): 400})
+        self.assertRaises(grimoireng_data.ElasticSearchError,
+                          self.send, es, range(5))
+        es = FakeElasticSearch()
+        upload = grimoireng_data.IndexUpload(es, "i", False, 2,
+                                             spooldir = self.directory)
+        data = {"t": {"df": pandas.DataFrame({"id": [1]}), "id": "id",
+                      "mapping": None}}
+        self.assertRaises(ValueError, upload.upload, data)
+        self.assertEqual(es.requests, [])
+
+    def test_resume (self):
+
+        es = FakeElasticSearch({("PUT", "/_bulk"): 400})
+        self.assertRaises(grimoireng_data.ElasticSearchError,
+                          self.send, es, range(5))
+        spool = grimoireng_data.Spool(self.directory)
+        spool.add_mapping("i", "t", '{"t": {"properties": {}}}')
+        es = FakeElasticSearch()
+        grimoireng_data.resume_upload(es, self.directory)
+        self.assertEqual(es.paths("PUT"), ["/i/_mapping/t"] \
+                         + ["/_bulk"] * 3)
+        self.assertEqual(sum(body.count('"_id"') for (method, path, body)
+                             in es.requests if path == "/_bulk"), 5)
+        self.assertFalse(grimoireng_data.spool_pending(self.directory))
+
+    def test_acked_in_old_manifest (self):
+
+        with open(os.path.join(self.directory, "manifest.json"), "w") as file:
+            json.dump({"batches": [{"file": "00000001.ndjson", "label": "t",
+                                    "items": 1, "acked": True}],
+                       "swaps": [], "last": 1}, file)
+        self.assertFalse(grimoireng_data.spool_pending(self.directory))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for staging tables for commits (no database needed)
+##   python -m unittest discover -s tests
+
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+
+class FakeDatabase:
+    """Database recording statements, keeping the state of staging tables.
+
+    """
+
+    stagingdb = "staging"
+
+    def __init__ (self, fingerprint, state = None, error = 1146):
+
+        self.fingerprint = fingerprint
+        self.state = state
+        self.error = error
+        self.statements = []
+
+    def execute (self, query):
+
+        self.statements.append(query)
+        if query == grimoireng_data.sql_scm_staging_state:
+            if self.state is None:
+                raise grimoireng_data._mysql_exceptions.ProgrammingError(
+                    self.error, "Table doesn't exist")
+            return ([(self.state,)], ["state"])
+        match = re.search(r'SELECT "(.*)" AS state', query)
+        if match:
+            self.state = match.group(1)
+        return ([], [])
+
+class TestStaging (unittest.TestCase):
+
+    def build (self, db, since = None, ids = None):
+
+        grimoireng_data.scm_staging(db, since, ids)
+        return db.statements[1:]
+
+    def test_missing (self):
+
+        db = FakeDatabase("10")
+        statements = self.build(db, "2015-01-01")
+        self.assertEqual(statements[0], "DROP TABLE IF EXISTS " \
+                         + "{staging_db}.`{main_db}_staging`")
+        self.assertEqual(statements[1:-1],
+                         grimoireng_data.sql_scm_staging("2015-01-01"))
+        # State recorded last, once tables are built
+        self.assertEqual(db.state, repr(("10", "2015-01-01", None)))
+
+    def test_up_to_date (self):
+
+        db = FakeDatabase("10", repr(("10", None, (5, 10))))
+        self.assertEqual(self.build(db, ids = (5, 10)), [])
+
+    def test_changed (self):
+
+        for (fingerprint, since, ids) in [("11", None, (5, 10)),
+                                          ("10", "2015-01-01", (5, 10)),
+                                          ("10", None, None)]:
+            db = FakeDatabase(fingerprint, repr(("10", None, (5, 10))))
+            self.assertNotEqual(self.build(db, since, ids), [])
+            self.assertEqual(db.state, repr((fingerprint, since, ids)))
+
+    def test_no_fingerprint (self):
+
+        # Data could have changed: tables are always built
+        db = FakeDatabase(None, repr((None, None, None)))
+        self.assertNotEqual(self.build(db), [])
+
+    def test_error (self):
+
+        db = FakeDatabase("10", error = 1142)
+        self.assertRaises(grimoireng_data._mysql_exceptions.ProgrammingError,
+                          grimoireng_data.scm_staging, db, None)
+        self.assertEqual(len(db.statements), 1)
+
+class TestStagingSql (unittest.TestCase):
+
+    def test_selection (self):
+
+        (drop_lines, drop_branches, branches, lines) = \
+            grimoireng_data.sql_scm_staging("2015-01-01", (5, 10))
+        self.assertIn("_commits_lines", drop_lines)
+        self.assertIn("_commits_branches", drop_branches)
+        self.assertIn('scmlog.author_date >= "2015-01-01"', branches)
+        self.assertIn("scmlog.id > 5", branches)
+        self.assertIn("scmlog.id <= 10", branches)
+        # Lines are built from branches, not from all commits again
+        self.assertIn("JOIN {staging_db}.`{main_db}_commits_branches`", lines)
+        self.assertNotIn("scmlog", lines)
+
+    def test_all (self):
+
+        branches = grimoireng_data.sql_scm_staging(None)[2]
+        self.assertNotIn("scmlog", branches)
+        self.assertNotIn("WHERE", branches)
+
+    def test_commits (self):
+
+        sql = grimoireng_data.sql_commits(False, None, staging = True)
+        self.assertIn("{staging_db}.`{main_db}_commits_branches`", sql)
+        self.assertIn("branches.in_master = 1", sql)
+        self.assertNotIn("{main_db}.actions", sql)
+
+if __name__ == "__main__":
+    unittest.main()
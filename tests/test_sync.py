@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2015 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Tests for uploading only changed documents (no server needed)
+##   python -m unittest discover -s tests
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import grimoireng_data
+from fakes import FakeElasticSearch, bulk_lines
+
+class TestBulkChanges (unittest.TestCase):
+
+    def test_changes (self):
+
+        lines = bulk_lines([1, 2, 3])
+        current = {}
+        list(grimoireng_data.es_bulk_changes(lines, "i", "t", {}, current))
+        # Document 2 changed, 3 removed, 4 new
+        known = dict(current)
+        known["2"] = "changed"
+        lines = bulk_lines([1, 2, 4])
+        current = {}
+        changes = list(grimoireng_data.es_bulk_changes(lines, "i", "t",
+                                                       known, current))
+        self.assertEqual([id for (id, line) in changes], [2, 4, "3"])
+        self.assertTrue(changes[2][1].startswith('{ "delete"'))
+        self.assertTrue('"_id" : "3"' in changes[2][1])
+        self.assertEqual(sorted(current.keys()), ["1", "2", "4"])
+        self.assertEqual(current["1"], known["1"])
+
+class TestSyncState (unittest.TestCase):
+
+    def setUp (self):
+
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "state.json")
+
+    def tearDown (self):
+
+        shutil.rmtree(self.directory)
+
+    def test_save (self):
+
+        state = grimoireng_data.SyncState(self.filename)
+        self.assertEqual(state.hashes("i", "t"), {})
+        state.update("i", "t", {"1": "a"})
+        state.save()
+        state = grimoireng_data.SyncState(self.filename)
+        self.assertEqual(state.hashes("i", "t"), {"1": "a"})
+        self.assertEqual(state.hashes("i", "other"), {})
+
+    def upload (self, df, deleteold = False):
+
+        es = FakeElasticSearch()
+        upload = grimoireng_data.IndexUpload(es, "i", deleteold, 100,
+                                             syncstate = self.filename)
+        upload.upload({"t": {"df": df, "id": "id", "mapping": None}})
+        upload.finish()
+        return [re.findall(r'^{ "(\w+)" : .*"_id" : "(\w+)"', body, re.M)
+                for (method, path, body) in es.requests
+                if path == "/_bulk"]
+
+    def test_uploads (self):
+
+        df = pandas.DataFrame({"id": [1, 2, 3], "name": ["a", "b", "c"]})
+        self.assertEqual(self.upload(df), [[("index", "1"), ("index", "2"),
+                                            ("index", "3")]])
+        self.assertEqual(self.upload(df), [])
+        df = pandas.DataFrame({"id": [1, 2, 4], "name": ["a", "B", "d"]})
+        self.assertEqual(self.upload(df), [[("index", "2"), ("index", "4"),
+                                            ("delete", "3")]])
+        self.assertEqual(self.upload(df), [])
+        # Deleting the index uploads everything
+        self.assertEqual(len(self.upload(df, deleteold = True)[0]), 3)
+
+if __name__ == "__main__":
+    unittest.main()